@@ -0,0 +1,164 @@
+# Runs the whole analysis of many FLIM stacks at once, without opening any windows. Each file is read, transformed,
+# filtered, thresholded and saved by a pool of worker processes, so a batch uses all the cores of the computer, and
+# the files of each stack are written at the same time by the writer threads of ExportPipeline. With the 'container'
+# export format each stack is saved as a single OME-TIFF container instead, and run_batch can also gather the whole
+# batch into one container.
+
+# imports
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PhasorDataset import PhasorDataset, DEFAULT_HARMONICS
+import ExportPipeline
+import PhasorCache
+import Instrumentation
+
+# The parameters applied to every file of a batch. Phi is in degrees, M and the fraction range are given as fractions
+# of 1, as they are typed in the front panel. Only the time bins [Gate Start, Gate Stop) are summed, where a Gate Stop
+# of None is the end of the stack. The decays of the Binning x Binning square or circle around every pixel are summed,
+# where a Binning of 1 is no binning and the size must be odd. Every pixel is unmixed into the fractions of the species at the (g, s) coordinates of
+# Unmixing, and the pixels whose fraction of a species is outside of its (min, max) in Unmixing Ranges are masked. With
+# Clusters above 0, that many clusters are fitted to the phasor plot of each file with the Cluster Method. The phasor
+# coordinates are cached in Cache Dir, where None is the default cache and '0' reads every stack without a cache. The
+# g, s, TauP and TauM maps of the other harmonics in Harmonics are saved along with the maps of Harmonic
+DEFAULT_SETTINGS = {"Phi Cal": 0.0, "M Cal": 1.0, "Bin Width": 0.2208, "Freq": 80.0, "Harmonic": 1.0, "Filters": 0,
+					"Intensity Min": 0, "Intensity Max": 1000000, "Phi Min": 0, "Phi Max": 90, "M Min": 0, "M Max": 1.2,
+					"FractionX": 0.0, "FractionY": 0.0, "Fraction Min": 0, "Fraction Max": 1.2, "Save Type": 'all',
+					"Export Format": 'files', "Gate Start": 0, "Gate Stop": None,
+					"Binning": 1, "Binning Shape": 'square', "Unmixing": [], "Unmixing Ranges": [],
+					"Clusters": 0, "Cluster Method": 'kmeans', "Cache Dir": None,
+					"Harmonics": []}
+
+
+def apply_settings(dataset, settings):
+	"""Applies the filters and thresholds of settings to the PhasorDataset dataset"""
+	dataset.convolution(int(settings['Filters']))
+	dataset.update_threshold(settings['Intensity Min'], settings['Intensity Max'])
+	dataset.update_angle_range(settings['Phi Min'], settings['Phi Max'])
+	dataset.update_circle_range(settings['M Min'] * 100, settings['M Max'] * 100)
+	dataset.fraction_coor_map(settings['FractionX'], settings['FractionY'])
+	dataset.update_fraction_range(settings['Fraction Min'] * 100, settings['Fraction Max'] * 100)
+	dataset.set_unmixing(settings['Unmixing'])
+	for index, (min, max) in enumerate(settings['Unmixing Ranges']):
+		dataset.update_unmixing_range(index, min, max)
+	dataset.cluster(int(settings['Clusters']), settings['Cluster Method'])
+	dataset.set_colormap(4)
+	dataset.apply_masks()
+
+
+def settings_harmonics(settings):
+	"""Returns the harmonics of settings which are read from the stack"""
+	if not settings['Harmonics']:
+		return DEFAULT_HARMONICS
+	return (settings['Harmonic'],) + tuple(settings['Harmonics'])
+
+
+def settings_gate(settings):
+	"""Returns the time gate of settings, or None if every time bin is summed"""
+	if settings['Gate Start'] == 0 and settings['Gate Stop'] is None:
+		return None
+	return settings['Gate Start'], settings['Gate Stop']
+
+
+def settings_binning(settings):
+	"""Returns the radius of the binning of settings, whose Binning is the odd size of the binned square or circle.
+	Raises a ValueError for the sizes which aren't odd and positive, rather than rounding them"""
+	size = settings['Binning']
+	if int(size) != size or size < 1 or size % 2 == 0:
+		raise ValueError(f'The binning size must be an odd number of pixels, e.g. 1, 3 or 5, not {size}')
+	return int(size) // 2
+
+
+def gate_scan(file_name, gates, settings):
+	"""Applies settings to the stack at file_name with each of the (start, stop) time gates, and returns the lines of
+	the parameters file of each gate, e.g. to compare the average lifetimes. The stack is read once, and each gate
+	only subtracts the cumulative sums over the time bins"""
+	settings = dict(DEFAULT_SETTINGS, **settings)
+	dataset = PhasorDataset(file_name, settings['Phi Cal'], settings['M Cal'], settings['Bin Width'], settings['Freq'],
+							settings['Harmonic'], cache=PhasorCache.cache_from_setting(settings['Cache Dir']),
+							gating=True, binning=settings_binning(settings), binning_shape=settings['Binning Shape'])
+	apply_settings(dataset, settings)
+	results = []
+	for start, stop in gates:
+		with Instrumentation.span('batch/gate', file=file_name):
+			dataset.set_gate(start, stop)
+			results.append(dataset.get_save_params(dataset.get_mask()))
+	return results
+
+
+def load_file(file_name, settings):
+	"""Reads the stack at file_name, and returns its PhasorDataset with settings applied to it"""
+	with Instrumentation.span('batch/load', file=file_name):
+		dataset = PhasorDataset(file_name, settings['Phi Cal'], settings['M Cal'], settings['Bin Width'],
+								settings['Freq'], settings['Harmonic'], harmonics=settings_harmonics(settings),
+								cache=PhasorCache.cache_from_setting(settings['Cache Dir']), gate=settings_gate(settings),
+								binning=settings_binning(settings), binning_shape=settings['Binning Shape'])
+		apply_settings(dataset, settings)
+	return dataset
+
+
+def process_file(file_name, save_folder, settings):
+	"""Reads the stack at file_name, applies settings to it, and saves all the data in save_folder"""
+	settings = dict(DEFAULT_SETTINGS, **settings)
+	dataset = load_file(file_name, settings)
+	with Instrumentation.span('batch/save', file=file_name):
+		if settings['Export Format'] == 'container':
+			ExportPipeline.run_tasks([ExportPipeline.container_task(dataset, save_folder)])
+		else:
+			ExportPipeline.export(dataset, save_folder, settings['Save Type'], harmonics=bool(settings['Harmonics']))
+
+
+def container_data(file_name, settings):
+	"""Reads the stack at file_name, applies settings to it, and returns the name, layers and parameters which are
+	written into the container of the batch"""
+	dataset = load_file(file_name, dict(DEFAULT_SETTINGS, **settings))
+	return (dataset.name,) + dataset.container_layers()
+
+
+def _process_file(function, file_name, *args):
+	"""Runs function(file_name, *args) in a worker. Errors are returned instead of raised, so that one bad file
+	doesn't stop the rest of the batch"""
+	try:
+		return file_name, function(file_name, *args), None
+	except Exception:
+		return file_name, None, traceback.format_exc()
+
+
+def run_batch(file_names, save_folder, settings, workers=None, progress=None, container=None):
+	"""Processes all of file_names with a pool of workers processes (one per core by default). progress(done, total,
+	file_name, error) is called each time a file is finished, where error is None if the file was saved. Returns a
+	list of the (file_name, error) of the files which failed. If container is given, the data of all the files is
+	written into that single OME-TIFF container by this process, as the workers finish the files, instead of being
+	saved in save_folder"""
+	# check the settings once, rather than failing every file
+	settings_binning(dict(DEFAULT_SETTINGS, **settings))
+	failed = []
+	tif = ExportPipeline.open_container(container) if container is not None else None
+	# spawn the workers, so they don't inherit the state of the Qt application that started the batch
+	context = multiprocessing.get_context('spawn')
+	try:
+		with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+			if tif is None:
+				futures = [pool.submit(_process_file, process_file, file_name, save_folder, settings)
+						   for file_name in file_names]
+			else:
+				futures = [pool.submit(_process_file, container_data, file_name, settings) for file_name in file_names]
+			for done, future in enumerate(as_completed(futures), 1):
+				try:
+					file_name, data, error = future.result()
+				except Exception:
+					# the worker itself died, e.g. it ran out of memory
+					file_name, data, error = file_names[futures.index(future)], None, traceback.format_exc()
+				if tif is not None and error is None:
+					try:
+						ExportPipeline.write_container(tif, *data)
+					except Exception:
+						error = traceback.format_exc()
+				if error is not None:
+					failed.append((file_name, error))
+				if progress is not None:
+					progress(done, len(file_names), file_name, error)
+	finally:
+		if tif is not None:
+			tif.close()
+	return failed
@@ -2,22 +2,16 @@
 
 # imports
 import numpy as np
-from skimage import io
+import PhasorCache
 
 
-def get_calibration_parameters(filename, bin_width=0.2208, freq=80, harmonic=1, tau_ref = 4):
+def get_calibration_parameters(filename, bin_width=0.2208, freq=80, harmonic=1, tau_ref = 4,
+							   cache=PhasorCache.DEFAULT_CACHE):
 	"""Opens the tiff image file and calculates the fft and gets the center coordinates of the g and s. Returns
 	the angle and distance that these values need to be translated by to place the calibration measurement
-	at the position expected by the user"""
-	im = io.imread(filename)
-	image = np.moveaxis(im, 0, 2)
-	bins = image.shape[2]
-	t_arr = np.linspace(bin_width / 2, bin_width * (bins - 1 / 2), bins)
-
-	integral = np.sum(image, axis=2).astype(float)
-	integral[integral == 0] = 0.00001
-	g = np.sum(image[:, ...] * np.cos(2 * np.pi * freq / 1000 * harmonic * t_arr[:]), axis=2) / integral
-	s = np.sum(image[:, ...] * np.sin(2 * np.pi * freq / 1000 * harmonic * t_arr[:]), axis=2) / integral
+	at the position expected by the user. The coordinates are read from the cache if the file was opened before"""
+	intensity, g, s = PhasorCache.read_phasor_coordinates(filename, bin_width, freq, (harmonic,), cache=cache)
+	g, s = g[0], s[0]
 
 	g_coor = g.flatten()
 	s_coor = s.flatten()
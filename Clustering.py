@@ -0,0 +1,129 @@
+# Finds the populations of the phasor plot automatically, instead of picking them by hand with the cursor circles. The
+# clusters are fitted on the histogram of the phasor plot, with the bins weighted by their counts, rather than on every
+# pixel, so the cost of the fit doesn't depend on the size of the image. Every bin of the plot is then given the label
+# of its cluster, and the pixels take the label of the bin they are in, through the plot bins the dataset already
+# keeps for every pixel.
+
+# imports
+import numpy as np
+import PhasorPlot
+
+# methods the clusters can be fitted with
+METHODS = ('kmeans', 'gmm')
+# The fit stops once the labels of k-means or the log likelihood of the Gaussian mixture stop changing, or after
+# MAX_ITERATIONS
+MAX_ITERATIONS = 200
+TOLERANCE = 1e-7
+
+
+def bin_centres():
+	"""Returns the (BINS * BINS, 2) g and s coordinates of the centres of the bins of the phasor plot, in the order of
+	the flat bin indices of PhasorPlot.histogram_bins"""
+	g_edges = np.linspace(*PhasorPlot.G_RANGE, PhasorPlot.BINS + 1)
+	s_edges = np.linspace(*PhasorPlot.S_RANGE, PhasorPlot.BINS + 1)
+	g, s = np.meshgrid((g_edges[:-1] + g_edges[1:]) / 2, (s_edges[:-1] + s_edges[1:]) / 2, indexing='ij')
+	return np.stack([g.reshape(-1), s.reshape(-1)], axis=1)
+
+
+def squared_distances(points, centres):
+	"""Returns the (n_points, n_centres) squared distances between the points and the centres"""
+	return ((points[:, None, :] - centres[None, :, :]) ** 2).sum(axis=2)
+
+
+def kmeans(points, weights, k, seed=0):
+	"""Returns the (k, 2) centres of the weighted k-means of points, which are started from weighted k-means++"""
+	rng = np.random.default_rng(seed)
+	centres = [points[rng.choice(len(points), p=weights / weights.sum())]]
+	for _ in range(1, k):
+		chance = weights * squared_distances(points, np.array(centres)).min(axis=1)
+		centres.append(points[rng.choice(len(points), p=chance / chance.sum())])
+	centres = np.array(centres)
+	labels = None
+	for _ in range(MAX_ITERATIONS):
+		new_labels = squared_distances(points, centres).argmin(axis=1)
+		if labels is not None and np.array_equal(labels, new_labels):
+			break
+		labels = new_labels
+		total = np.bincount(labels, weights, minlength=k)
+		for axis in range(2):
+			mean = np.bincount(labels, weights * points[:, axis], minlength=k)
+			# a cluster which lost all its points keeps its centre
+			np.divide(mean, total, out=centres[:, axis], where=total > 0)
+	return centres
+
+
+def log_densities(points, means, covariances, proportions):
+	"""Returns the (n_points, k) logs of the proportion times the density of each Gaussian at the points"""
+	inverse = np.linalg.inv(covariances)
+	offsets = points[:, None, :] - means[None, :, :]
+	mahalanobis = np.einsum('nki,kij,nkj->nk', offsets, inverse, offsets)
+	return np.log(proportions) - np.log(2 * np.pi) - np.log(np.linalg.det(covariances)) / 2 - mahalanobis / 2
+
+
+def gaussian_mixture(points, weights, k, seed=0):
+	"""Returns the (means, covariances, proportions) of the weighted Gaussian mixture of points, fitted by expectation
+	maximisation from the centres of k-means. The covariances are kept at least as wide as a bin of the plot"""
+	bin_width = np.array([np.diff(PhasorPlot.G_RANGE)[0], np.diff(PhasorPlot.S_RANGE)[0]]) / PhasorPlot.BINS
+	floor = np.diag(bin_width ** 2 / 12)
+	means = kmeans(points, weights, k, seed)
+	labels = squared_distances(points, means).argmin(axis=1)
+	responsibility = np.eye(k)[labels]
+	total_weight = weights.sum()
+	likelihood = -np.inf
+	for _ in range(MAX_ITERATIONS):
+		# maximisation
+		mass = responsibility * weights[:, None]
+		total = mass.sum(axis=0) + 1e-300
+		proportions = np.maximum(total / total_weight, 1e-300)
+		means = (mass.T @ points) / total[:, None]
+		offsets = points[:, None, :] - means[None, :, :]
+		covariances = np.einsum('nk,nki,nkj->kij', mass, offsets, offsets) / total[:, None, None] + floor
+		# expectation
+		log_density = log_densities(points, means, covariances, proportions)
+		peak = log_density.max(axis=1, keepdims=True)
+		log_total = peak[:, 0] + np.log(np.exp(log_density - peak).sum(axis=1))
+		responsibility = np.exp(log_density - log_total[:, None])
+		new_likelihood = (weights * log_total).sum() / total_weight
+		if new_likelihood - likelihood < TOLERANCE:
+			break
+		likelihood = new_likelihood
+	return means, covariances, proportions
+
+
+class PhasorClusters:
+	"""The clusters fitted to a histogram of the phasor plot. labels is the lookup table of the cluster (1 to k) of
+	every flat bin index of the plot, with 0 for the points outside of the plot, so the labels of the pixels are
+	labels[plot bins]. The clusters are numbered in the order of their g coordinate"""
+
+	def __init__(self, method, centres, covariances=None, proportions=None):
+		self.method = method
+		order = np.lexsort((centres[:, 1], centres[:, 0]))
+		self.centres = centres[order]
+		self.covariances = None if covariances is None else covariances[order]
+		self.proportions = None if proportions is None else proportions[order]
+		points = bin_centres()
+		if covariances is None:
+			nearest = squared_distances(points, self.centres).argmin(axis=1)
+		else:
+			nearest = log_densities(points, self.centres, self.covariances, self.proportions).argmax(axis=1)
+		self.labels = np.zeros(len(points) + 1, dtype=np.uint8)
+		self.labels[:-1] = nearest + 1
+		self.labels.setflags(write=False)
+
+	def __len__(self):
+		return len(self.centres)
+
+
+def fit(histogram, k, method='kmeans', seed=0):
+	"""Returns the PhasorClusters of k clusters fitted to the (BINS, BINS) histogram of the phasor plot with method,
+	'kmeans' or 'gmm' (a Gaussian mixture). Only the bins with counts are fitted, weighted by their counts"""
+	if method not in METHODS:
+		raise ValueError(f'The clustering method must be one of {", ".join(METHODS)}')
+	weights = np.asarray(histogram, dtype=float).reshape(-1)
+	filled = np.flatnonzero(weights > 0)
+	if k < 1 or len(filled) < k:
+		raise ValueError(f'{k} clusters need at least {k} filled bins of the phasor plot, which has {len(filled)}')
+	points, weights = bin_centres()[filled], weights[filled]
+	if method == 'kmeans':
+		return PhasorClusters(method, kmeans(points, weights, k, seed))
+	return PhasorClusters(method, *gaussian_mixture(points, weights, k, seed))
@@ -0,0 +1,103 @@
+# Runs the calculations triggered by the front panel on a pool of threads, so that changing a parameter never waits for
+# the images to be recalculated, and the selected images are recalculated at the same time (numpy releases the GIL
+# while it works on the arrays). Requests are kept by key, and a new request replaces the one of the same key which is
+# still waiting, so only the latest position of a slider is calculated however fast it moves.
+
+# imports
+import os
+import threading
+import traceback
+from PyQt5 import QtCore
+
+
+class ComputeWorker(QtCore.QObject):
+	"""Calculates the submitted jobs on a pool of threads, running at most one job of each key at a time. The result
+	of each job is passed to its callback in the GUI thread, and the traceback of a job which failed is sent with the
+	failed signal along with its key"""
+	done = QtCore.pyqtSignal(object)
+	failed = QtCore.pyqtSignal(object, str)
+
+	def __init__(self, threads=None):
+		super().__init__()
+		self.condition = threading.Condition()
+		# key: (function, callback) of the jobs waiting to run, in the order they were first submitted
+		self.pending = {}
+		# keys of the jobs being calculated
+		self.running = set()
+		# key: (callback, result) of the finished jobs waiting for the GUI thread
+		self.results = {}
+		self.stopped = False
+		self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(threads or os.cpu_count() or 1)]
+		# the worker object lives in the GUI thread, so the signal is delivered there
+		self.done.connect(self.deliver)
+
+	def start(self):
+		for thread in self.threads:
+			thread.start()
+
+	def submit(self, key, function, callback):
+		"""Runs function() in a worker thread and then callback(result) in the GUI thread. A job of key which is
+		still waiting is replaced"""
+		with self.condition:
+			self.pending[key] = (function, callback)
+			self.condition.notify()
+
+	def flush(self, key):
+		"""Runs the waiting job of key straight away in the calling thread, e.g. before another change is made to the
+		same data"""
+		with self.condition:
+			job = self.pending.pop(key, None)
+		if job is not None:
+			function, callback = job
+			callback(function())
+
+	def next_key(self):
+		"""Returns the first waiting key which isn't being calculated already, or None"""
+		for key in self.pending:
+			if key not in self.running:
+				return key
+		return None
+
+	def run(self):
+		while True:
+			with self.condition:
+				while not self.stopped and self.next_key() is None:
+					self.condition.wait()
+				if self.stopped:
+					return
+				key = self.next_key()
+				function, callback = self.pending.pop(key)
+				self.running.add(key)
+			try:
+				result = function()
+				error = None
+			except Exception:
+				error = traceback.format_exc()
+			with self.condition:
+				self.running.discard(key)
+				if error is None:
+					self.results[key] = (callback, result)
+				# a job of the same key may have been waiting for this one
+				self.condition.notify_all()
+			if error is None:
+				self.done.emit(key)
+			else:
+				self.failed.emit(key, error)
+
+	def deliver(self, key):
+		"""Passes the latest result of key to its callback. Results which were already passed on are skipped"""
+		with self.condition:
+			job = self.results.pop(key, None)
+		if job is not None:
+			callback, result = job
+			callback(result)
+
+	def stop(self):
+		"""Stops the threads once the running jobs are finished, dropping the waiting ones"""
+		with self.condition:
+			self.stopped = True
+			self.pending.clear()
+			self.condition.notify_all()
+		for thread in self.threads:
+			if thread.is_alive():
+				thread.join()
@@ -2,51 +2,167 @@
 # and the ranges specified by the user
 
 #imports
-from PyQt5 import QtWidgets
+from PyQt5 import QtWidgets, QtCore
 from PyQt5 import uic
-from PyQt5.QtGui import QImage, QPixmap
-from PyQt5.QtWidgets import QLabel
+from PyQt5.QtGui import QImage, QPainter
 from PyQt5.QtCore import Qt
 import numpy as np
-import cv2
-import matplotlib.patches as patches
 import matplotlib
 matplotlib.use('Qt5Agg')
 import os
-from matplotlib.image import NonUniformImage
 import MplWidget
+import PhasorPlot
+import Instrumentation
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
+class ImageView(QtWidgets.QWidget):
+	"""Shows the part of an image of the given (height, width) shape which is in view. The view is zoomed with the
+	mouse wheel, panned by dragging and fitted to the window again by double clicking. The view only holds the pixels
+	it was given last, and emits viewport_changed when other pixels, or the same ones at another level of detail, are
+	needed. viewport is the (top, left, bottom, right, step) of the image pixels in view, where only every step-th
+	pixel is needed at the zoom of the view"""
+	viewport_changed = QtCore.pyqtSignal()
+	MAX_ZOOM = 32
+
+	def __init__(self, shape):
+		super(ImageView, self).__init__()
+		self.shape = shape[:2]
+		self.zoom = None
+		self.centre = (self.shape[1] / 2, self.shape[0] / 2)
+		self.viewport = None
+		self.image = None
+		self.region = (0, 0, 1)
+		self.drag_start = None
+		self.setMinimumSize(100, 100)
+		self.resize(self.sizeHint())
+		self.update_viewport()
+
+	def sizeHint(self):
+		return QtCore.QSize(300, 300)
+
+	def scale(self):
+		"""Returns the number of screen pixels per image pixel. Until the user zooms, the image fits the window"""
+		height, width = self.shape
+		fit = min(self.width() / width, self.height() / height)
+		return fit if self.zoom is None else max(self.zoom, fit)
+
+	def update_viewport(self):
+		"""Finds the pixels in view, and asks for them if they changed"""
+		height, width = self.shape
+		scale = self.scale()
+		x, y = self.centre
+		half_width, half_height = self.width() / scale / 2, self.height() / scale / 2
+		step = 1 if scale >= 1 else 2 ** int(np.floor(np.log2(1 / scale)))
+		viewport = (max(int(y - half_height), 0), max(int(x - half_width), 0),
+					min(int(np.ceil(y + half_height)), height), min(int(np.ceil(x + half_width)), width), step)
+		if viewport != self.viewport:
+			self.viewport = viewport
+			self.viewport_changed.emit()
+		self.update()
+
+	def set_image(self, im, region):
+		"""Displays the RGB image im, which covers the image from the (row, column) of its top left pixel, with step
+		pixels of the image per pixel of im"""
+		height, width = im.shape[:2]
+		self.image = QImage(im.data, width, height, 3 * width, QImage.Format_RGB888)
+		# the QImage doesn't copy the data, so the array is kept
+		self.image_data = im
+		self.region = region
+		self.update()
+
+	def paintEvent(self, event):
+		with Instrumentation.span('picture/paint'):
+			self.paint()
+
+	def paint(self):
+		painter = QPainter(self)
+		painter.fillRect(self.rect(), Qt.black)
+		if self.image is None:
+			return
+		scale = self.scale()
+		row, column, step = self.region
+		x, y = self.centre
+		target = QtCore.QRectF((column - x) * scale + self.width() / 2, (row - y) * scale + self.height() / 2,
+							   self.image.width() * step * scale, self.image.height() * step * scale)
+		# the pixels are only blurred when zoomed out, so that they are shown as squares when zoomed in
+		painter.setRenderHint(QPainter.SmoothPixmapTransform, step * scale < 1)
+		painter.drawImage(target, self.image, QtCore.QRectF(self.image.rect()))
+
+	def set_centre(self, x, y):
+		height, width = self.shape
+		self.centre = (min(max(x, 0), width), min(max(y, 0), height))
+
+	def wheelEvent(self, event):
+		"""Zooms in or out around the pixel under the mouse"""
+		scale = self.scale()
+		zoom = scale * 1.25 ** (event.angleDelta().y() / 120)
+		zoom = min(zoom, self.MAX_ZOOM)
+		position = event.pos()
+		x, y = self.centre
+		# image coordinates of the pixel under the mouse, which stays under the mouse
+		px = x + (position.x() - self.width() / 2) / scale
+		py = y + (position.y() - self.height() / 2) / scale
+		self.zoom = zoom
+		scale = self.scale()
+		self.set_centre(px - (position.x() - self.width() / 2) / scale, py - (position.y() - self.height() / 2) / scale)
+		self.update_viewport()
+
+	def mousePressEvent(self, event):
+		self.drag_start = (event.pos(), self.centre)
+
+	def mouseMoveEvent(self, event):
+		"""Pans the view while the mouse is dragged"""
+		if self.drag_start is None:
+			return
+		start, (x, y) = self.drag_start
+		scale = self.scale()
+		self.set_centre(x - (event.pos().x() - start.x()) / scale, y - (event.pos().y() - start.y()) / scale)
+		self.update_viewport()
+
+	def mouseReleaseEvent(self, event):
+		self.drag_start = None
+
+	def mouseDoubleClickEvent(self, event):
+		"""Fits the whole image in the window again"""
+		self.zoom = None
+		self.centre = (self.shape[1] / 2, self.shape[0] / 2)
+		self.update_viewport()
+
+	def resizeEvent(self, event):
+		self.update_viewport()
+
+
 class Picture(QtWidgets.QMainWindow):
-	"""Creates the picture window, and displays the images supplied by ImageHandler"""
-	def __init__(self, name):
-		super(Picture, self).__init__()
+	"""Creates the picture window, and displays the images supplied by ImageHandler. Only the part of the image in
+	view is displayed, see ImageView. closed is emitted when the window is closed"""
+	closed = QtCore.pyqtSignal()
 
-		height, width, channel = 300, 300, 3
-		bytesPerLine = 3 * width
+	def __init__(self, name, shape):
+		super(Picture, self).__init__()
 
-		self.widget = QLabel("HelloWorld")
-		self.widget.setScaledContents(True)
-		font = self.widget.font()
-		font.setPointSize(30)
-		self.widget.setFont(font)
-		self.widget.setAlignment(Qt.AlignHCenter | Qt.AlignVCenter)
+		self.view = ImageView(shape)
+		self.viewport_changed = self.view.viewport_changed
 
-		self.setCentralWidget(self.widget)
+		self.setCentralWidget(self.view)
 		self.name = name
 
 		self.dead = False
 
-	def set_image(self, im):
-		"""Displays the image im"""
-		im = cv2.resize(im, (300, 300))
-		qImg = QImage(im.data, 300,300, QImage.Format_RGB888)
-		self.widget.setPixmap(QPixmap(qImg))
+	@property
+	def viewport(self):
+		"""(top, left, bottom, right, step) of the image pixels which are in view"""
+		return self.view.viewport
+
+	def set_image(self, im, region=(0, 0, 1)):
+		"""Displays the image im, which covers the image from the (row, column, step) of region"""
+		with Instrumentation.span('picture/set_image'):
+			self.view.set_image(im, region)
 
 	def closeEvent(self, event):
 		"""Ran when the window is closed"""
 		self.dead = True
+		self.closed.emit()
 
 	def set_window_number(self, num):
 		"""Sets the title of the window to match the number in the table on the front panel"""
@@ -81,292 +197,142 @@ class SaveWindow(QtWidgets.QMainWindow):
 		uic.loadUi(dir_path + "/ui files/SaveData.ui", self)
 
 
-class Graph(QtWidgets.QMainWindow):
-	"""Displays the MplWidget plot based on the thresholding parameters that the user enters"""
+class Graph(QtWidgets.QMainWindow, PhasorPlot.PhasorPlot):
+	"""Displays the MplWidget plot based on the thresholding parameters that the user enters. closed is emitted when
+	the window is closed"""
+	closed = QtCore.pyqtSignal()
+
 	def __init__(self, name, MHz):
 		super(Graph, self).__init__()
 
 		self.ui = uic.loadUi(dir_path + "/ui files/Graph.ui", self)
-
-		x = np.linspace(0, 1, 1000)
-		y = np.sqrt(0.5 * 0.5 - (x - 0.5) * (x - 0.5))
-		self.Plot.canvas.ax.set_xlim([0, 1])
-		self.Plot.canvas.ax.set_ylim([0, 0.6])
-		self.Plot.canvas.ax.plot(x, y, 'r')
-		self.Plot.canvas.ax.set_xlabel('g', fontsize=12, weight='bold')
-		self.Plot.canvas.ax.set_ylabel('s', fontsize=12, weight='bold')
-
-		self.MHz = '{0:.0f}'.format(MHz)
-
-		# load the range lines horizontally and vertically
-		y = np.tan((np.radians(0)) * x - 0.001)
-		self.min_line, = self.Plot.canvas.ax.plot(x,y)
-
-		y = np.tan(np.radians(90)) * x
-		self.max_line, = self.Plot.canvas.ax.plot(x, y)
-
-		self.min_circle, = self.Plot.canvas.ax.plot(x, y)
-		self.max_circle, = self.Plot.canvas.ax.plot(x, y)
-
-		self.circle_coors = np.full((4, 2),-3.0)
-		self.circle_radius = [0.05, 0.05, 0.05, 0.05]
-
-		self.circler = patches.Circle((-2, -2), 0.05, ec='r', alpha=0.7, lw=2.5)
-		self.circleg = patches.Circle((-2, -2), 0.05, ec='g', alpha=0.7, lw=2.5)
-		self.circleb = patches.Circle((-2, -2), 0.05, ec='b', alpha=0.7, lw=2.5)
-		self.circley = patches.Circle((-2, -2), 0.05, ec='y', alpha=0.7, lw=2.5)
-
-		self.Plot.canvas.ax.add_patch(self.circler)
-		self.Plot.canvas.ax.add_patch(self.circleg)
-		self.Plot.canvas.ax.add_patch(self.circleb)
-		self.Plot.canvas.ax.add_patch(self.circley)
-
-		self.circle_fraction_min = patches.Circle((0, 0), 0, ec='r', fill=0, lw=1.5)
-		self.circle_fraction_max = patches.Circle((0, 0), 1.2, ec='r', fill=0, lw=1.5)
-
-		self.Plot.canvas.ax.add_patch(self.circle_fraction_min)
-		self.Plot.canvas.ax.add_patch(self.circle_fraction_max)
+		self.setup_plot(self.Plot.canvas.ax, MHz, blit=True)
 
 		self.name = name
 
-		self.angle_min_val = 0
-		self.angle_max_val = 90
-		self.circle_min_val = 0
-		self.circle_max_val = 120
-		self.fraction_min = 0
-		self.fraction_max = 1.2
-		self.line_alpha = 1.0
-
-		self.image_min_ang, self.image_max_ang = 0, 90
-		self.image_min_M, self.image_max_M = 0, 120
-
-		self.color_map = 0 #0=densitymap, 1=TauM, 2=TauP, 3=densitymap, 4=fractionBound
-
-		self.cmap = matplotlib.cm.jet.copy()
-		self.cmap_r = matplotlib.cm.jet_r.copy()
-		self.cmap.set_bad('k', alpha=0)
-		self.cmap_noir = matplotlib.cm.Greys.copy()
-
-		self.x_fraction = 0
-		self.y_fraction = 0
-
 		self.dead = False
 
 	def resizeEvent(self, event):
 		self.Plot.setGeometry(0, 0, event.size().width(), event.size().height())
 
-	def plot_data(self, x_data, y_data):
-		"""Plots the xy data given by image handler, and colors based on the thresholds and colormap selected by the
-		user"""
-		# Placing the data into a histogram with reasonably sized binning helps speed up the plotting significantly
-		H, xedges, yedges = np.histogram2d(x_data, y_data, bins=150, range=[[0, 1], [0, 0.6]])
-		H = H.T
-		xcenters = (xedges[:-1] + xedges[1:]) / 2
-		ycenters = (yedges[:-1] + yedges[1:]) / 2
-		x = np.tile(xcenters, (150,1))
-		y = np.tile(ycenters, (150,1)).T
-		# pre calculate distance D, fraction bound F, and angle A maps for the data
-		D = np.sqrt(x**2+y**2)
-		F = np.sqrt((x-self.x_fraction)**2+(y-self.y_fraction)**2)
-		A = y/x
-		min = np.tan(np.deg2rad(self.angle_min_val))
-		max = np.tan(np.deg2rad(self.angle_max_val))
-		# Convert the plot to an image, which makes it faster to plot than the raw data
-		im = NonUniformImage(self.Plot.canvas.ax, interpolation='bilinear', cmap=self.cmap)
-		im2 = NonUniformImage(self.Plot.canvas.ax, interpolation='bilinear', cmap=self.cmap_noir)
-		im.set_data(xcenters, ycenters, A)
-		# These if statements color the top image based on the thresholds, and then sets areas outside the thresholding
-		# to be black.
-		if self.color_map == 0:
-			H = np.ma.masked_where(H < 0.005, H)
-			im.set_data(xcenters, ycenters, H)
-			H[H != 0] = 1
-			im2.set_data(xcenters, ycenters, H)
-		elif self.color_map == 1:
-			im = NonUniformImage(self.Plot.canvas.ax, interpolation='bilinear', cmap=self.cmap_r)
-			D = np.ma.masked_where((D < self.circle_min_val / 100) | (D > self.circle_max_val / 100) | (H < 0.01) |
-								   (A < min) | (A > max) | (F<self.fraction_min) | (F>self.fraction_max),D)
-			H[H != 0] = 1
-			if not False in D.mask:
-				D.mask[0, 0] = False
-			im.set_data(xcenters, ycenters, D)
-			im.set_clim(self.circle_min_val / 100, self.circle_max_val / 100)
-			im2.set_data(xcenters, ycenters, H)
-		elif self.color_map == 2:
-			A[(A > self.image_max_ang) & (A < max)] = self.image_max_ang
-			A[(A < self.image_min_ang) & (A > min)] = self.image_min_ang
-			A = np.ma.masked_where((D < self.circle_min_val / 100) | (D > self.circle_max_val / 100) | (H < 0.01) |
-								   (A < min) | (A > max) | (F<self.fraction_min) | (F>self.fraction_max),A)
-			if not False in A.mask:
-				A.mask[0, 0] = False
-			im.set_data(xcenters, ycenters, A)
-			im.set_clim(min, max)
-			H[H != 0] = 1
-			im2.set_data(xcenters, ycenters, H)
-		elif self.color_map == 4:
-			F = np.ma.masked_where((D < self.circle_min_val / 100) | (D > self.circle_max_val / 100) | (H < 0.01) |
-								   (A < min) | (A > max) | (F<self.fraction_min) | (F>self.fraction_max),F)
-			H[H != 0] = 1
-			if not False in F.mask:
-				F.mask[0, 0] = False
-			im.set_data(xcenters, ycenters, F)
-			im.set_clim(self.fraction_min, self.fraction_max)
-			im2.set_data(xcenters, ycenters, H)
-		for item in self.Plot.canvas.ax.get_images():
-			item.remove()
-		# Plot one image on top which has all the colours, and one image on the bottom which is just black to show the
-		# points which are outside of the thresholding
-		self.Plot.canvas.ax.add_image(im2)
-		self.Plot.canvas.ax.add_image(im)
-		if len(self.MHz) <= 2:
-			self.Plot.canvas.ax.text(0.8, 0.55, self.MHz + " MHz", fontsize=12)
-		else:
-			self.Plot.canvas.ax.text(0.75, 0.55, self.MHz + " MHz", fontsize=12)
-		# list = self.Plot.canvas.ax.get_images()
-
-
-	def set_circle(self, selection):
-		"""Changes the colour of the circle seleted for when the user clicks the plot based on the value in the
-		enumerated dropdown box on the front panel"""
-		self.circleSelect = selection
-
-	def clear_circles(self):
-		"""Sends all the circles to far outside the plot coordinates"""
-		self.circle_coors[:] = -3.0
-		self.draw_circles()
-
-	def update_circle(self, event):
-		"""Moves the selected circles"""
-		self.circle_coors[self.circleSelect][0] = event.xdata
-		self.circle_coors[self.circleSelect][1] = event.ydata
-		self.draw_circles()
-
-	def draw_circles(self):
-		"""Draws the circles. Using patches as opposed to plotting them is far more efficient, otherwise the program
-		hangs for a while"""
-		self.circler.remove()
-		self.circler = patches.Circle((self.circle_coors[0][0], self.circle_coors[0][1]), self.circle_radius[0],
-									  ec='r', fill=0, alpha=0.7, lw=2.5)
-		self.Plot.canvas.ax.add_patch(self.circler)
-
-		self.circleg.remove()
-		self.circleg = patches.Circle((self.circle_coors[1][0], self.circle_coors[1][1]), self.circle_radius[1],
-									  ec='g', fill=0, alpha=0.7, lw=2.5)
-		self.Plot.canvas.ax.add_patch(self.circleg)
-
-		self.circleb.remove()
-		self.circleb = patches.Circle((self.circle_coors[2][0], self.circle_coors[2][1]), self.circle_radius[2],
-									  ec='b', fill=0, alpha=0.7, lw=2.5)
-		self.Plot.canvas.ax.add_patch(self.circleb)
-
-		self.circley.remove()
-		self.circley = patches.Circle((self.circle_coors[3][0], self.circle_coors[3][1]), self.circle_radius[3],
-									  ec='y', fill=0, alpha=0.7, lw=2.5)
-		self.Plot.canvas.ax.add_patch(self.circley)
-
-		self.Plot.canvas.draw()
-
-	def update_fraction_range(self, min, max, *args, **kwargs):
-		"""Draws the circles for fraction range. Need to clear plot and then redraw it. This is why it's far more
-		efficient to work with images rather than the raw histogram data"""
-		self.fraction_min = min
-		self.fraction_max = max
-		self.circle_fraction_min.remove()
-		self.circle_fraction_max.remove()
-		self.circle_fraction_min = patches.Circle((self.x_fraction, self.y_fraction), min, ec='b', fill=0, lw=1.5, alpha = self.line_alpha)
-		self.circle_fraction_max = patches.Circle((self.x_fraction, self.y_fraction), max, ec='b', fill=0, lw=1.5, alpha = self.line_alpha)
-		self.Plot.canvas.ax.add_patch(self.circle_fraction_min)
-		self.Plot.canvas.ax.add_patch(self.circle_fraction_max)
-		self.Plot.canvas.draw()
-
-	def update_angle_range(self, min, max, *args, **kwargs):
-		"""Draws the lines for angle range. Need to clear plot and then redraw it. This is why it's far more
-		efficient to work with images rather than the raw histogram data"""
-		self.min_line.remove()
-		self.max_line.remove()
-		x = np.linspace(0,2,3)
-		y = np.tan((np.deg2rad(min)))*x
-		if y[-1] == 0:
-			y = [-1, -1, -1]
-
-		self.min_line, = self.Plot.canvas.ax.plot(x, y, color='r', alpha = self.line_alpha)
-
-		y = np.tan(np.radians(max))*x
-		self.max_line, = self.Plot.canvas.ax.plot(x, y, color = 'r', alpha = self.line_alpha)
-
-		self.angle_min_val = min
-		self.angle_max_val = max
-
-	def update_circle_range(self, min, max, *args, **kwargs):
-		"""Draws the circles for modulation range. Need to clear plot and then redraw it. This is why it's far more
-		efficient to work with images rather than the raw histogram data"""
-		self.min_circle.remove()
-		self.max_circle.remove()
-
-		x1 = np.linspace(0, min/100, 100)
-		y1 = np.sqrt((min/100)**2 - x1**2)
-		self.min_circle, = self.Plot.canvas.ax.plot(x1, y1, color='r', alpha = self.line_alpha)
-
-		x2 = np.linspace(0, max/100, 100)
-		y2 = np.sqrt((max/100)**2 - x2**2)
-		self.max_circle, = self.Plot.canvas.ax.plot(x2, y2, color='r', alpha = self.line_alpha)
-
-		self.circle_min_val = min
-		self.circle_max_val = max
-
-	def change_circle_radius(self, radius):
-		"""Makes the click circles of radius = radius"""
-		self.circle_radius[self.circleSelect] = radius
-		self.draw_circles()
-
 	def closeEvent(self, event):
 		"""Ran when the window is closed"""
 		self.dead = True
-
-	def update_data(self, x, y, col_map = 0):
-		"""plots new data, and adds the thresholding lines and circles to a new plot"""
-		self.plot_data(x.flatten(),y.flatten())
-		self.update_angle_range(self.angle_min_val, self.angle_max_val)
-		self.update_circle_range(self.circle_min_val, self.circle_max_val)
-		self.draw_circles()
+		self.closed.emit()
 
 	def set_window_number(self, num):
 		"""Sets the title of the window"""
 		self.setWindowTitle(str(num) +': ' + self.name)
 
-	def set_colormap(self, val):
-		"""updates the colormap value"""
-		self.color_map = val
-
-	def set_image_props(self, min_ang, max_ang, min_m, max_m):
-		"""Changes the thresholding parameters for angle and modulation"""
-		self.image_min_ang = min_ang
-		self.image_max_ang = max_ang
-		self.image_min_M = min_m
-		self.image_max_M = max_m
-
-	def set_lifetime_points(self, *args):
-		"""Adds the lifetime values to the universal circle"""
-		lifetime_x = args[0][0]
-		lifetime_y = args[0][1]
-		lifetimes = [0.5, 1, 2, 3, 4, 8]
-		self.Plot.canvas.ax.scatter(lifetime_x, lifetime_y, color='r', s=10)
-		for i in range(6):
-			self.Plot.canvas.ax.text(lifetime_x[i]-0.05, lifetime_y[i]+0.03, str(lifetimes[i]) + " ns", color='r', fontsize=9)
-
-	def set_fraction(self, x, y):
-		"""Changes the thresholding parameters for the fraction bound circles"""
-		self.x_fraction = x
-		self.y_fraction = y
-
-	def save_fig(self, file):
-		"""Saves a picture of the plot in file path"""
-		self.Plot.canvas.save_fig(file)
-
-	def set_alpha(self, value):
-		self.line_alpha = value
-		self.update_circle_range(self.circle_min_val, self.circle_max_val)
-		self.update_angle_range(self.angle_min_val, self.angle_max_val)
-		self.update_fraction_range(self.fraction_min, self.fraction_max)
-
+	def plot_data(self, x_data, y_data):
+		with Instrumentation.span('graph/plot_data'):
+			PhasorPlot.PhasorPlot.plot_data(self, x_data, y_data)
+
+	def plot_histogram(self, H):
+		with Instrumentation.span('graph/plot_histogram'):
+			PhasorPlot.PhasorPlot.plot_histogram(self, H)
+
+	def draw_plot(self):
+		with Instrumentation.span('graph/draw'):
+			PhasorPlot.PhasorPlot.draw_plot(self)
+
+	def redraw(self):
+		with Instrumentation.span('graph/redraw'):
+			PhasorPlot.PhasorPlot.redraw(self)
+
+
+class StatusPanel(QtWidgets.QMainWindow):
+	"""Shows how often and how long each stage of the calculations and the windows ran, and the memory held by the
+	arrays of the open images, see Instrumentation. images() returns the open ImageHandlers. The instrumentation is
+	enabled while the panel is open, unless it was enabled already, and the tables are refreshed every second"""
+	closed = QtCore.pyqtSignal()
+	STAGE_COLUMNS = ['Stage', 'Calls', 'Mean (ms)', 'Longest (ms)', 'Last (ms)', 'Total (s)']
+	MEMORY_COLUMNS = ['Image', 'Arrays (MB)', 'Largest arrays']
+
+	def __init__(self, images):
+		super(StatusPanel, self).__init__()
+		self.setWindowTitle('Performance')
+		self.images = images
+		self.enabled_here = False
+		self.traced_here = False
+
+		self.stages = QtWidgets.QTableWidget(0, len(self.STAGE_COLUMNS))
+		self.stages.setHorizontalHeaderLabels(self.STAGE_COLUMNS)
+		self.memory = QtWidgets.QTableWidget(0, len(self.MEMORY_COLUMNS))
+		self.memory.setHorizontalHeaderLabels(self.MEMORY_COLUMNS)
+		self.memory.horizontalHeader().setStretchLastSection(True)
+		reset = QtWidgets.QPushButton('Reset')
+		reset.clicked.connect(self.reset)
+		self.trace_button = QtWidgets.QPushButton('Write trace...')
+		self.trace_button.clicked.connect(self.write_trace)
+
+		buttons = QtWidgets.QHBoxLayout()
+		buttons.addWidget(reset)
+		buttons.addWidget(self.trace_button)
+		buttons.addStretch()
+		layout = QtWidgets.QVBoxLayout()
+		layout.addWidget(self.stages, 2)
+		layout.addWidget(self.memory, 1)
+		layout.addLayout(buttons)
+		widget = QtWidgets.QWidget()
+		widget.setLayout(layout)
+		self.setCentralWidget(widget)
+		self.resize(600, 500)
+
+		self.timer = QtCore.QTimer(self)
+		self.timer.timeout.connect(self.refresh)
+
+	def showEvent(self, event):
+		if not Instrumentation.enabled():
+			Instrumentation.enable()
+			self.enabled_here = True
+		self.refresh()
+		self.timer.start(1000)
 
+	def closeEvent(self, event):
+		"""Stops the instrumentation again, if the panel started it, or only finishes the trace the panel started"""
+		self.timer.stop()
+		if self.enabled_here:
+			Instrumentation.disable()
+			self.enabled_here = False
+		elif self.traced_here:
+			# the profiling was turned on before the panel, e.g. by FLUTE_PROFILE, so it carries on without the trace
+			Instrumentation.disable()
+			Instrumentation.enable()
+		self.traced_here = False
+		self.trace_button.setEnabled(True)
+		self.closed.emit()
+
+	def reset(self):
+		Instrumentation.reset()
+		self.refresh()
+
+	def write_trace(self):
+		"""Writes the spans from now on to a trace file, which is finished when the panel or FLUTE is closed"""
+		file_name, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Write trace', 'flute_trace.json',
+															 'Trace files (*.json)')
+		if file_name:
+			Instrumentation.disable()
+			Instrumentation.enable(file_name)
+			self.traced_here = True
+			self.trace_button.setEnabled(False)
+
+	def refresh(self):
+		"""Shows the statistics recorded so far, the slowest stages first"""
+		statistics = sorted(Instrumentation.statistics().items(), key=lambda item: -item[1][1])
+		self.stages.setRowCount(len(statistics))
+		for row, (name, (count, total, longest, last)) in enumerate(statistics):
+			values = [name, str(count), f'{total / count * 1000:.1f}', f'{longest * 1000:.1f}', f'{last * 1000:.1f}',
+					  f'{total:.2f}']
+			for column, value in enumerate(values):
+				self.stages.setItem(row, column, QtWidgets.QTableWidgetItem(value))
+
+		images = list(self.images())
+		self.memory.setRowCount(len(images))
+		for row, image in enumerate(images):
+			memory = image.memory_usage()
+			largest = sorted(memory.items(), key=lambda item: -item[1])[:3]
+			values = [image.name, f'{sum(memory.values()) / 1024 ** 2:.1f}',
+					  ', '.join(f'{name} {size / 1024 ** 2:.1f}' for name, size in largest)]
+			for column, value in enumerate(values):
+				self.memory.setItem(row, column, QtWidgets.QTableWidgetItem(value))
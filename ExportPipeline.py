@@ -0,0 +1,147 @@
+# Saves the data of a PhasorDataset: the images of the colormaps, the g, s and lifetime maps, the phasor plots and the
+# parameters file. Every file is rendered, encoded and written as a task of its own on a pool of writer threads, which
+# run at the same time as numpy, PIL, tifffile and matplotlib release the GIL while they work. The tasks only read the
+# dataset, so a snapshot of it is exported while the windows keep changing the dataset itself. The data can also be
+# written into a single chunked and compressed OME-TIFF container, instead of a dozen files per dataset.
+
+# imports
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+import numpy as np
+import tifffile
+import PhasorPlot
+
+# number of files written at the same time
+WRITER_THREADS = min(8, os.cpu_count() or 1)
+# The layers of the containers are written in TILE x TILE tiles, so that parts of them are read without the rest, and
+# compressed with zlib (the floating point predictor would need imagecodecs)
+CONTAINER_SUFFIX = '.ome.tif'
+CONTAINER_TILE = 256
+CONTAINER_COMPRESSION = 'zlib'
+CONTAINER_LEVEL = 6
+
+
+def once(function):
+	"""Returns a function which calls function the first time it is called, from whichever thread, and returns the
+	same result every time after that. Used for the data shared by several files"""
+	lock = threading.Lock()
+	result = []
+
+	def wrapper():
+		with lock:
+			if not result:
+				result.append(function())
+		return result[0]
+	return wrapper
+
+
+def export_tasks(dataset, file, save_type='all', colormap=None, name=None, harmonics=False):
+	"""Returns the (path, function) of every file saved for dataset in the folder file, including the phasor plots,
+	where function() renders and writes the file. With harmonics the maps of the other harmonics are saved too"""
+	return dataset.export_tasks(file, save_type, colormap, name, harmonics) + \
+		PhasorPlot.plot_tasks(dataset, file, save_type, colormap, name)
+
+
+def open_container(file_name):
+	"""Returns a TiffWriter of a new OME-TIFF container at file_name, which datasets are written into with
+	write_container, and which must be closed"""
+	return tifffile.TiffWriter(file_name, bigtiff=True, ome=True)
+
+
+def ome_array(array):
+	"""Returns array in a data type of OME-TIFF, which has no 64 bit integers. They are stored as 32 bit integers if
+	the values fit, and as doubles otherwise"""
+	if array.dtype.kind not in 'iu' or array.dtype.itemsize < 8:
+		return array
+	dtype = np.dtype(array.dtype.kind + '4')
+	info = np.iinfo(dtype)
+	if array.size == 0 or (info.min <= array.min() and array.max() <= info.max):
+		return array.astype(dtype)
+	return array.astype(np.float64)
+
+
+def write_container(tif, name, layers, parameters, threads=None):
+	"""Writes the layers of the dataset name, a list of (layer name, 2D array), into the open container tif. Each
+	layer is an image series named <name>/<layer name>, with the parameters text as its description. The tiles are
+	compressed by threads at the same time"""
+	for layer, array in layers:
+		tile = (CONTAINER_TILE, CONTAINER_TILE) if min(array.shape) >= CONTAINER_TILE else None
+		tif.write(ome_array(array), tile=tile, compression=CONTAINER_COMPRESSION, compressionargs={'level': CONTAINER_LEVEL},
+				  maxworkers=threads or WRITER_THREADS,
+				  metadata={'axes': 'YX', 'Name': f'{name}/{layer}', 'Description': parameters})
+
+
+def container_task(dataset, file, name=None):
+	"""Returns the (path, function) which writes all the data of dataset into a container of its own in the folder
+	file, see PhasorDataset.container_layers"""
+	name = dataset.name if name is None else name
+	path = file + '/' + name + CONTAINER_SUFFIX
+
+	def save():
+		layers, parameters = dataset.container_layers()
+		with open_container(path) as tif:
+			write_container(tif, name, layers, parameters)
+	return path, save
+
+
+class Export:
+	"""Runs the tasks, a list of (path, function), on a pool of writer threads, which starts straight away.
+	progress(done, total, path, error) is called from the writer threads each time a file is finished, where error is
+	the traceback of a file which failed, or None. cancel() skips the files which haven't started"""
+
+	def __init__(self, tasks, threads=None, progress=None):
+		self.tasks = list(tasks)
+		self.progress = progress
+		self.cancelled = False
+		self.lock = threading.Lock()
+		self.done = 0
+		self.errors = []
+		pool = ThreadPoolExecutor(max_workers=threads or WRITER_THREADS)
+		self.futures = [pool.submit(self.run_task, path, function) for path, function in self.tasks]
+		# the threads are stopped once the tasks are finished
+		pool.shutdown(wait=False)
+
+	def run_task(self, path, function):
+		if self.cancelled:
+			return
+		try:
+			function()
+			error = None
+		except Exception:
+			error = traceback.format_exc()
+		with self.lock:
+			self.done += 1
+			done = self.done
+			if error is not None:
+				self.errors.append((path, error))
+		if self.progress is not None:
+			self.progress(done, len(self.tasks), path, error)
+
+	def cancel(self):
+		"""Stops the export once the files being written are finished"""
+		self.cancelled = True
+		for future in self.futures:
+			future.cancel()
+
+	def wait(self):
+		"""Waits for the files to be written, and returns the list of (path, error) of the files which failed"""
+		for future in self.futures:
+			try:
+				future.result()
+			except CancelledError:
+				pass
+		return self.errors
+
+
+def run_tasks(tasks, threads=None, progress=None):
+	"""Writes the files of tasks and waits for them. Raises an error if any of them failed"""
+	errors = Export(tasks, threads, progress).wait()
+	if errors:
+		raise RuntimeError('\n'.join(f'Saving {path} failed:\n{error}' for path, error in errors))
+
+
+def export(dataset, file, save_type='all', colormap=None, name=None, threads=None, progress=None, harmonics=False):
+	"""Saves all the data and phasor plots of dataset in the folder file, and waits for the files to be written"""
+	run_tasks(export_tasks(dataset, file, save_type, colormap, name, harmonics), threads, progress)
@@ -1,248 +1,200 @@
-# Handles all the calculations for the data, such as taking the fft and applying the convolutional filters
+# Connects the data of a FLIM stack with the windows that display it. All the calculations, such as taking the fft and
+# applying the convolutional filters, are done by the PhasorDataset class
 
 
 # imports
-from skimage import io
+import threading
+from contextlib import contextmanager
 import DataWindows
-import numpy as np
-from PIL import Image
-import os
-from matplotlib import cm
-from scipy import signal
-import tifffile
-
-np.seterr(divide='ignore', invalid='ignore')
+import ExportPipeline
+import Instrumentation
+from ImagePyramid import ImagePyramid
+from PhasorDataset import PhasorDataset
 
 
 class ImageHandler:
-	"""Handles the calculations for the images, taken in as tiff stacks located at filename"""
-
-	def __init__(self, filename, phi_cal=0, m_cal=1, bin_width=0.2208, freq=80, harmonic=1):
-		im = io.imread(filename)
-		self.name = os.path.splitext(os.path.basename(filename))[0]
-		self.original_image = np.sum(im, axis=0)
-		self.max = np.max(self.original_image)
-		self.min = np.min(self.original_image)
-		self.compress_image(self.original_image)
-
-		self.phi_cal = float(phi_cal)
-		self.m_cal = float(m_cal)
-		self.bin_width = float(bin_width)
-		self.freq = float(freq)
-		self.harmonic = float(harmonic)
-
-		# Record the fft coordinates as g and s
-		self.g, self.s = self.perform_fft(im)
-		self.xcoor_map = self.g.reshape(self.original_image.shape)
-		self.x_adjusted = self.xcoor_map.copy()
-
-		self.ycoor_map = self.s.reshape(self.original_image.shape)
-		self.y_adjusted = self.ycoor_map.copy()
-
-		self.graph_window = DataWindows.Graph(self.name, self.freq * self.harmonic)
-		self.graph_window.set_lifetime_points(self.get_phasor_lifetime_coordinates())
+	"""Displays the data of the tiff stack located at filename in a graph and a picture window, and passes the user
+	interactions through to the PhasorDataset which holds the data. When a ComputeWorker is given, the changes made
+	from the front panel are calculated by the worker, and only the latest position of each slider is calculated"""
+
+	def __init__(self, filename, phi_cal=0, m_cal=1, bin_width=0.2208, freq=80, harmonic=1, worker=None):
+		with Instrumentation.span('load', file=filename):
+			self.dataset = PhasorDataset(filename, phi_cal, m_cal, bin_width, freq, harmonic)
+		self.name = self.dataset.name
+
+		# The dataset is only changed while holding the lock, as the worker changes it from its own thread. Every change
+		# increments the version, so that the results of the worker which are older than the image shown are dropped
+		self.worker = worker
+		self.lock = threading.RLock()
+		# (kind, operation) of the changes waiting to be applied to the dataset, and whether the data of the plot changed
+		self.pending_operations = []
+		self.pending_replot = False
+		self.pending_lock = threading.Lock()
+		self.version = 0
+		self.shown_version = 0
+
+		self.graph_window = DataWindows.Graph(self.name, self.dataset.freq * self.dataset.harmonic)
+		self.graph_window.set_lifetime_points(self.dataset.get_phasor_lifetime_coordinates())
 		self.graph_window.show()
-		self.graph_window.plot_data(self.g, self.s)
+		self.graph_window.plot_data(self.dataset.g, self.dataset.s)
 
 		self.graph_window.Plot.canvas.mpl_connect('button_press_event', self.update_circle)
 
-		self.plot_angle_mask = np.zeros(self.original_image.shape, dtype=bool)
-		self.plot_circle_mask = np.zeros(self.original_image.shape, dtype=bool)
-		self.plot_fraction_mask = np.zeros(self.original_image.shape, dtype=bool)
-		self.intensity_mask = np.zeros(self.original_image.shape, dtype=bool)
-
-		self.angle_arr = self.ycoor_map / self.xcoor_map
-		self.distance_arr = np.sqrt(self.ycoor_map ** 2 + self.xcoor_map ** 2)
-		self.fraction_arr = self.distance_arr
-		self.color_map = np.zeros((im.shape[1], im.shape[2], 4), dtype=bool)
-
 		self.selected_circle = 0
-		self.color_map_select = 0
-		self.min_thresh = 0
-		self.max_thresh = 1000000
-		self.x_fraction = 0
-		self.y_fraction = 0
-		self.num_filter = 0
 		self.active = True
 		self.binding_id = None
 
-		self.image_min_ang, self.image_max_ang = 0, 90
-		self.applied_min_ang, self.applied_max_ang = 0, 90
-		self.image_min_M, self.image_max_M = 0, 120
-		self.applied_min_M, self.applied_max_M = 0, 120
-		self.fraction_min, self.fraction_max = 0, 1
-
-		self.image_window = DataWindows.Picture(self.name)
+		# Only the part of the image in view is coloured, at the resolution of the screen
+		data = self.dataset
+		self.pyramid = ImagePyramid(data.original_image.shape, lambda index: data.colour_region(index, data.get_mask()))
+		self.image_window = DataWindows.Picture(self.name, data.original_image.shape)
+		self.image_window.viewport_changed.connect(self.update_view)
 		self.image_window.show()
-		self.image_window.set_image(self.displayImage)
 		self.change_colormap(0)
 
-	def colormaps(self, mask):
-		"""applies the colormap selected to the image"""
-		#Greyscale Intensity colourmap
-		if self.color_map_select == 0:
-			im = self.original_image.copy()
-			if len(im[~mask]) != 0:
-				im = ((im - np.min(im[~mask])) * (1 / (np.max(im[~mask]) - np.min(im[~mask])) * 255))
-			im = im.astype('uint8')
-			im[mask] = 0
-			im = np.stack((im,) * 3, axis=-1)
-			self.displayImage = im
-
-		#TauM colourmap
-		elif self.color_map_select == 1:
-			viridis = cm.get_cmap('jet_r', 20)
-			arr = self.distance_arr.copy()
-			arr[arr < 0] = 0
-			arr[mask] = 0
-			if len(arr[~mask]) != 0:
-				self.image_min_M = np.min(arr[~mask])
-				self.image_max_M = np.max(arr[~mask])
-				arr = (arr - self.applied_min_M/100) * (1 / (self.applied_max_M/100 - self.applied_min_M/100))
+		self.graph_window.closed.connect(self.kill)
+		self.image_window.closed.connect(self.kill)
+
+	@contextmanager
+	def synced(self):
+		"""Holds the lock of the dataset, after applying the changes which are still waiting for the worker, so that
+		the changes are made in the order the user made them"""
+		with self.lock:
+			if self.worker is not None:
+				self.worker.flush(self)
+			yield
+
+	def submit(self, kind, operation, replot=False):
+		"""Applies operation(dataset) and then colours the image again. With a worker, this is done in a worker thread
+		along with the other operations submitted since it last ran, in the order they were submitted. An operation
+		of the same kind as the one before it replaces it, e.g. the positions a slider was dragged through, unless
+		kind is None. replot is set when the data of the plot changes, rather than just the ranges. If operation is
+		None only the part of the image in view is coloured"""
+		with self.pending_lock:
+			if kind is not None and self.pending_operations and self.pending_operations[-1][0] == kind:
+				self.pending_operations[-1] = (kind, operation)
 			else:
-				self.image_min_M = np.min(arr)
-				self.image_max_M = np.max(arr)
-			col_map = viridis(arr)[..., :3]
-			self.displayImage[..., 0] = np.asarray(col_map[..., 0] * 255).astype(int)
-			self.displayImage[..., 1] = np.asarray(col_map[..., 1] * 255).astype(int)
-			self.displayImage[..., 2] = np.asarray(col_map[..., 2] * 255).astype(int)
-			self.displayImage[mask] = [0, 0, 0]
-
-		# TauP colourmap
-		elif self.color_map_select == 2:
-			viridis = cm.get_cmap('jet', 20)
-			arr = self.angle_arr.copy()
-			arr[arr < 0] = 0
-			np.nan_to_num(arr, copy=False)
-			if len(arr[~mask]) != 0:
-				self.image_min_ang =  np.tan(np.deg2rad(self.applied_min_ang))
-				self.image_max_ang = np.tan(np.deg2rad(self.applied_max_ang))
-				arr = (arr - self.image_min_ang) * (1 / (self.image_max_ang - self.image_min_ang))
-			else:
-				self.image_min_ang = np.min(arr)
-				self.image_max_ang = np.max(arr)
-			arr[mask] = 0
-			col_map = viridis(arr)[..., :3]
-			self.displayImage[..., 0] = np.asarray(col_map[..., 0] * 255).astype(int)
-			self.displayImage[..., 1] = np.asarray(col_map[..., 1] * 255).astype(int)
-			self.displayImage[..., 2] = np.asarray(col_map[..., 2] * 255).astype(int)
-			self.displayImage[mask] = [0, 0, 0]
-
-		#Jet instensity colourmap
-		elif self.color_map_select == 3:
-			viridis = cm.get_cmap('jet', 20)
-			im = np.array(self.original_image.copy(), dtype = np.int64)
-			if len(im[~mask]) != 0:
-				im = ((im - np.min(im[~mask])) * (1 / (np.max(im[~mask]) - np.min(im[~mask]))))
-			im[mask] = 0
-			col_map = viridis(im)[..., :3]
-			self.displayImage[..., 0] = np.asarray(col_map[..., 0] * 255).astype(int)
-			self.displayImage[..., 1] = np.asarray(col_map[..., 1] * 255).astype(int)
-			self.displayImage[..., 2] = np.asarray(col_map[..., 2] * 255).astype(int)
-			self.displayImage[mask] = [0, 0, 0]
-
-		# Fraction Bound colourmap.
-		elif self.color_map_select == 4:
-			viridis = cm.get_cmap('jet', 20)
-			arr = self.fraction_arr.copy()
-			arr[arr < 0] = 0
-			if len(arr[~mask]) != 0:
-				arr = (arr - self.fraction_min) * (1 / (self.fraction_max - self.fraction_min))
+				self.pending_operations.append((kind, operation))
+			self.pending_replot = self.pending_replot or replot
+		if self.worker is None:
+			self.show_result(self.compute())
+		else:
+			self.worker.submit(self, self.compute, self.show_result)
+
+	def compute(self):
+		"""Applies the waiting operations to the dataset and colours the part of the image in view. Returns the
+		image, the colormap ranges and the histogram of the plot, along with the version of the data they show. The
+		ranges and the histogram are None if only the view moved"""
+		with self.lock, Instrumentation.span('compute', image=self.name):
+			with self.pending_lock:
+				operations, self.pending_operations = self.pending_operations, []
+				replot, self.pending_replot = self.pending_replot, False
+			data = self.dataset
+			changed = False
+			for kind, operation in operations:
+				if operation is not None:
+					with Instrumentation.span('operation' if kind is None else f'operation/{kind}'):
+						operation(data)
+					changed = True
+			if changed:
+				self.scale_colours()
+			self.version += 1
+			with Instrumentation.span('colour_view'):
+				view = self.pyramid.view(*self.image_window.viewport)
+			if not changed:
+				return self.version, view, None, None, False
+			props = data.image_min_ang, data.image_max_ang, data.image_min_M, data.image_max_M
+			with Instrumentation.span('phasor_histogram'):
+				histogram = data.phasor_histogram()
+			if Instrumentation.enabled():
+				Instrumentation.counter(f'memory/{self.name}', {'bytes': sum(self.memory_usage().values())})
+			return self.version, view, props, histogram, replot
+
+	def scale_colours(self):
+		"""Finds the range of the colormap again, after the data or the thresholds changed. The tiles of the image
+		are only coloured again when they are shown"""
+		with Instrumentation.span('colormap_scale'):
+			self.dataset.colormap_scale(self.dataset.get_mask())
+		self.pyramid.clear()
+
+	def show_result(self, result):
+		"""Shows the result of compute in the windows, unless a newer image is already shown"""
+		version, view, props, histogram, replot = result
+		if version < self.shown_version or self.graph_window.dead or self.image_window.dead:
+			return
+		with Instrumentation.span('show_result', image=self.name):
+			self.shown_version = version
+			self.image_window.set_image(*view)
+			if props is None:
+				return
+			self.graph_window.set_image_props(*props)
+			if replot:
+				self.graph_window.update_histogram(histogram)
 			else:
-				self.fraction_min = np.min(arr)
-				self.fraction_max = np.max(arr)
-			arr[mask] = 0
-			col_map = viridis(arr)[..., :3]
-			self.displayImage[..., 0] = np.asarray(col_map[..., 0] * 255).astype(int)
-			self.displayImage[..., 1] = np.asarray(col_map[..., 1] * 255).astype(int)
-			self.displayImage[..., 2] = np.asarray(col_map[..., 2] * 255).astype(int)
-			self.displayImage[mask] = [0, 0, 0]
-
-	def compress_image(self, im):
-		"""Converts the image to be normalized and in the proper format to be displayed"""
-		im = ((im - self.min) * (1 / (self.max - self.min) * 255)).astype('uint8')
-		im = np.stack((im,) * 3, axis=-1)
-		self.displayImage = im
+				self.update_graph_ranges(histogram)
+
+	def update_graph(self):
+		"""Plots the data inside the intensity thresholds on the graph"""
+		with self.synced(), Instrumentation.span('phasor_histogram'):
+			histogram = self.dataset.phasor_histogram()
+		self.graph_window.update_histogram(histogram)
+
+	def update_graph_ranges(self, histogram):
+		"""Shows the moved range lines on the graph. The density plot doesn't depend on the ranges, so only the lines
+		are drawn again over it, while the other colormaps colour the data by the ranges and are plotted again"""
+		if self.graph_window.color_map == 0:
+			self.graph_window.redraw()
+		else:
+			self.graph_window.update_histogram(histogram)
+
+	def update_image_props(self):
+		"""Passes the colormap ranges of the image to the graph"""
+		data = self.dataset
+		self.graph_window.set_image_props(data.image_min_ang, data.image_max_ang, data.image_min_M, data.image_max_M)
 
 	def update_circle(self, event=0):
 		"""Colors the image based on the coordinates of the circles where the user clicks on the plot"""
 		if self.active == True:
 			if event != 0:
 				self.graph_window.update_circle(event)
-			circle_coor = self.graph_window.circle_coors
-			radii = self.graph_window.circle_radius
-			self.color_map[...] = False
-			self.color_map[..., 0][
-				(circle_coor[0, 0] - self.xcoor_map) ** 2 + (circle_coor[0, 1] - self.ycoor_map) ** 2 < radii[
-					0] ** 2] = True
-			self.color_map[..., 1][
-				(circle_coor[1, 0] - self.xcoor_map) ** 2 + (circle_coor[1, 1] - self.ycoor_map) ** 2 < radii[
-					1] ** 2] = True
-			self.color_map[..., 2][
-				(circle_coor[2, 0] - self.xcoor_map) ** 2 + (circle_coor[2, 1] - self.ycoor_map) ** 2 < radii[
-					2] ** 2] = True
-			self.color_map[..., 3][
-				(circle_coor[3, 0] - self.xcoor_map) ** 2 + (circle_coor[3, 1] - self.ycoor_map) ** 2 < radii[
-					3] ** 2] = True
-			self.apply_masks()
+			coors, radii = self.graph_window.circle_coors.copy(), list(self.graph_window.circle_radius)
+			self.submit('circles', lambda data: data.set_circles(coors, radii))
 
 	def update_circle_range(self, min, max):
 		"""Updates thresholding and colormaps based on the TauM modulation thresholds"""
 		self.graph_window.update_circle_range(min, max)
-		self.applied_min_M, self.applied_max_M = min, max
-		self.plot_circle_mask = np.logical_or(self.distance_arr > (max / 100), self.distance_arr < (min / 100))
-		self.apply_masks()
-		thresh = np.logical_or(self.original_image < self.min_thresh, self.original_image > self.max_thresh)
-		self.graph_window.set_image_props(self.image_min_ang, self.image_max_ang, self.image_min_M, self.image_max_M)
-		self.graph_window.update_data(self.x_adjusted[~thresh], self.y_adjusted[~thresh])
+		self.submit('circle', lambda data: data.update_circle_range(min, max))
 
 	def update_fraction_range(self, min, max):
 		"""Updates thresholding and colormaps based on the fraction bound thresholds"""
-		self.fraction_min = min / 100
-		self.fraction_max = max / 100
-		self.graph_window.update_fraction_range(self.fraction_min, self.fraction_max)
-		self.plot_fraction_mask = np.logical_or(self.fraction_arr > max / 100, self.fraction_arr < min / 100)
-		self.apply_masks()
-		thresh = np.logical_or(self.original_image < self.min_thresh, self.original_image > self.max_thresh)
-		self.graph_window.update_data(self.x_adjusted[~thresh], self.y_adjusted[~thresh])
+		self.graph_window.update_fraction_range(min / 100, max / 100)
+		self.submit('fraction', lambda data: data.update_fraction_range(min, max))
 
 	def update_angle_range(self, min, max):
 		"""Updates thresholding and colormaps based on the TauP angle thresholds"""
 		self.graph_window.update_angle_range(min, max)
-		self.applied_min_ang, self.applied_max_ang = min, max
-		min = np.tan(np.deg2rad(min))
-		max = np.tan(np.deg2rad(max))
-		self.plot_angle_mask = np.logical_or(self.angle_arr > max, self.angle_arr < min)
-		self.apply_masks()
-		self.graph_window.set_image_props(self.image_min_ang, self.image_max_ang, self.image_min_M, self.image_max_M)
-		thresh = np.logical_or(self.original_image < self.min_thresh, self.original_image > self.max_thresh)
-		self.graph_window.update_data(self.x_adjusted[~thresh], self.y_adjusted[~thresh])
+		self.submit('angle', lambda data: data.update_angle_range(min, max))
 
 	def apply_masks(self):
 		"""Sets parts of the image outside the thresholds on the plot to black"""
-		mask = self.plot_angle_mask | self.plot_circle_mask | self.intensity_mask | self.plot_fraction_mask
-		mask = np.logical_or(mask, self.x_adjusted < 0)
-		self.colormaps(mask)
-		self.displayImage[..., :][self.color_map[..., 0]] = [255, 0, 0]
-		self.displayImage[..., :][self.color_map[..., 1]] = [0, 255, 0]
-		self.displayImage[..., :][self.color_map[..., 2]] = [0, 0, 255]
-		self.displayImage[..., :][self.color_map[..., 3]] = [255, 255, 0]
-		self.displayImage[mask] = [0, 0, 0]
-		self.image_window.set_image(self.displayImage)
-		self.graph_window.set_image_props(self.image_min_ang, self.image_max_ang, self.image_min_M, self.image_max_M)
-		return mask
+		with self.synced(), Instrumentation.span('apply_masks', image=self.name):
+			self.scale_colours()
+			self.version += 1
+			self.shown_version = self.version
+			self.image_window.set_image(*self.pyramid.view(*self.image_window.viewport))
+			self.update_image_props()
+			return self.dataset.get_mask()
+
+	def update_view(self):
+		"""Colours the part of the image which came into view"""
+		self.submit('view', None)
 
 	def show_lines(self, show):
 		self.graph_window.set_alpha(int(show))
 
 	def update_threshold(self, min, max):
 		"""Creates an intensity mask based on the threshold by the user through min and max"""
-		self.min_thresh = min
-		self.max_thresh = max
-		intensity_mask = np.logical_or(self.original_image < min, self.original_image > max)
-		self.graph_window.update_data(self.x_adjusted[~intensity_mask], self.y_adjusted[~intensity_mask])
-		self.intensity_mask = np.logical_or(self.original_image < min, self.original_image > max)
-		self.apply_masks()
+		self.submit('threshold', lambda data: data.update_threshold(min, max), replot=True)
 
 	def set_circle(self, selection):
 		"""Selects which color circle is currently active"""
@@ -251,58 +203,24 @@ class ImageHandler:
 
 	def clear_circles(self):
 		"""Removes the circles from the plot and the colormap"""
-		self.color_map[...] = False
 		self.graph_window.clear_circles()
-		self.apply_masks()
+		self.submit('circles', lambda data: data.clear_circles())
 
 	def get_image_params(self):
 		"""Returns image parameters"""
-		return self.name, self.original_image.shape
-
-	def perform_fft(self, image):
-		"""Performs fft on the image data to get the g and s coordinates. see https://doi.org/10.1073/pnas.1108161108"""
-		image = np.moveaxis(image, 0, 2)
-		bins = image.shape[2]
-		t_arr = np.linspace(self.bin_width / 2, self.bin_width * (bins - 1 / 2), bins)
-
-		integral = np.sum(image, axis=2).astype(float)
-		integral[integral == 0] = 0.00001
-		g = np.sum(image[:, ...] * np.cos(2 * np.pi * self.freq / 1000 * self.harmonic * t_arr[:]), axis=2) / integral
-		s = np.sum(image[:, ...] * np.sin(2 * np.pi * self.freq / 1000 * self.harmonic * t_arr[:]), axis=2) / integral
-
-		R = np.array(((np.cos(self.phi_cal), -np.sin(self.phi_cal)), (np.sin(self.phi_cal), np.cos(self.phi_cal))))
-		mask = np.ones(image.shape[:2]).astype(bool)
-		arr = R.dot([g[mask], s[mask]]) * self.m_cal
-
-		g_coor = arr[0].flatten()
-		s_coor = arr[1].flatten()
-		return g_coor, s_coor
-
-	def dead(self):
-		"""Detects if one window is dead, and then kills the other one so that they both close."""
-		if self.graph_window.dead:
-			self.image_window.close()
-		if self.image_window.dead:
-			self.graph_window.close()
-		return np.logical_or(self.graph_window.dead, self.image_window.dead)
+		return self.dataset.get_image_params()
 
 	def kill(self):
-		"""Closes the other window if it's dead"""
-		self.image_window.close()
-		self.graph_window.close()
+		"""Closes both windows. Runs when either of them is closed, so that they close together"""
+		for window in (self.image_window, self.graph_window):
+			if not window.dead:
+				window.close()
 
 	def change_colormap(self, val):
 		"""Changes the colormap to the value val. 0=densitymap, 1=TauM, 2=TauP, 3=densitymap, 4=fractionBound"""
 		self.graph_window.set_colormap(val)
-		if val == 0 and self.color_map_select == 0:
-			self.color_map_select = 3
-		elif val == 0 and self.color_map_select != 3:
-			self.color_map_select = 3
-		else:
-			self.color_map_select = val
-		self.apply_masks()
-		thresh = np.logical_or(self.original_image < self.min_thresh, self.original_image > self.max_thresh)
-		self.graph_window.update_data(self.x_adjusted[~thresh], self.y_adjusted[~thresh])
+		# not replaced by the next colormap, as selecting the density map switches between two maps
+		self.submit(None, lambda data: data.set_colormap(val), replot=True)
 
 	def set_radius(self, size):
 		"""Changes the size of the selection circles"""
@@ -311,162 +229,104 @@ class ImageHandler:
 
 	def set_active(self, state):
 		"""Changes the state of the data, which controls if the red circles should be drawn or not when the window is
-		clicked"""
+		clicked. The data which isn't selected is compacted, as it isn't changed until it's selected again"""
+		if self.active and not state:
+			with self.synced():
+				self.dataset.compact()
+				self.pyramid.clear()
 		self.active = state
 
 	def fraction_lifetime_map(self, lifetime):
 		"""Creates the mapping of the coordinates in the plot based on their distance from the lifetime of the
 		fluorophore entered by the user. For example, 0.4ns for NADH."""
-		self.x_fraction = 1 / (1 + np.power(2 * np.pi * self.freq / 1000 * self.harmonic * lifetime, 2))
-		self.y_fraction = 2 * np.pi * self.freq / 1000 * self.harmonic * lifetime / (
-			1 + np.power(2 * np.pi * self.freq / 1000 * self.harmonic * lifetime, 2))
-		self.fraction_arr = np.sqrt((self.ycoor_map - self.y_fraction) ** 2 + (self.xcoor_map - self.x_fraction) ** 2)
-		self.graph_window.set_fraction(self.x_fraction, self.y_fraction)
+		with self.synced():
+			x_fraction, y_fraction = self.dataset.fraction_lifetime_map(lifetime)
+		self.graph_window.set_fraction(x_fraction, y_fraction)
 		self.change_colormap(4)
-		return self.x_fraction, self.y_fraction
+		return x_fraction, y_fraction
 
 	def fraction_coor_map(self, x_coor, y_coor):
 		"""Creates the mapping of the coordinates in the plot based on their distance from the lifetime of the
 		fluorophore entered by the user. For example, 0.4ns for NADH."""
-		self.x_fraction = x_coor
-		self.y_fraction = y_coor
-		self.fraction_arr = np.sqrt((self.ycoor_map - self.y_fraction) ** 2 + (self.xcoor_map - self.x_fraction) ** 2)
-		self.graph_window.set_fraction(self.x_fraction, self.y_fraction)
+		with self.synced():
+			self.dataset.fraction_coor_map(x_coor, y_coor)
+		self.graph_window.set_fraction(x_coor, y_coor)
 		self.change_colormap(4)
 
 	def set_fraction_coordinates(self, x_coor, y_coor):
-		self.x_fraction = x_coor
-		self.y_fraction = y_coor
-
-	def get_phasor_lifetime_coordinates(self):
-		"""Gets the coordinates for the points along the universal circles, which are used a reference when looking
-		at the plots"""
-		points = np.asarray([0.5, 1, 2, 3, 4, 8])
-		omega = 2 * np.pi * self.freq / 1000 * self.harmonic
-		x_coors = 1 / (1 + np.power(omega * points, 2))
-		y_coors = omega * points / (1 + np.power(omega * points, 2))
-		return x_coors, y_coors
+		with self.synced():
+			self.dataset.set_fraction_coordinates(x_coor, y_coor)
 
 	def convolution(self, num_filter):
 		"""Applies a 3x3 convolutional median filter to the graph data num_filter times. See:
 		https://doi.org/10.1038/s41596-018-0026-5"""
-		self.num_filter = num_filter
-		self.x_adjusted = self.g.copy()
-		self.x_adjusted = self.x_adjusted.reshape(self.original_image.shape)
-		self.y_adjusted = self.s.copy()
-		self.y_adjusted = self.y_adjusted.reshape(self.original_image.shape)
-		for i in range(num_filter):
-			self.x_adjusted = signal.medfilt(self.x_adjusted)
-			self.y_adjusted = signal.medfilt(self.y_adjusted)
-		self.x_adjusted[self.x_adjusted == 0] = -0.1
-		thresh = np.logical_or(self.original_image < self.min_thresh, self.original_image > self.max_thresh)
-		self.graph_window.update_data(self.x_adjusted[~thresh], self.y_adjusted[~thresh])
-
-		self.angle_arr = self.y_adjusted / self.x_adjusted
-		self.distance_arr = np.sqrt(self.y_adjusted ** 2 + self.x_adjusted ** 2)
-		self.fraction_arr = np.sqrt((self.ycoor_map - self.y_fraction) ** 2 + (self.xcoor_map - self.x_fraction) ** 2)
+		self.submit('filter', lambda data: data.convolution(num_filter), replot=True)
+
+	def set_harmonic(self, harmonic):
+		"""Switches the data and the plot to another harmonic"""
+		data = self.dataset
+		with self.synced():
+			data.set_harmonic(harmonic)
+		self.graph_window.set_frequency(data.freq * data.harmonic)
+		self.graph_window.set_lifetime_points(data.get_phasor_lifetime_coordinates())
+		self.apply_masks()
+		self.update_graph()
+
+	def set_gate(self, start, stop=None, gating=False):
+		"""Sums only the time bins [start, stop) of the decays, where a stop of None is the end of the stack. With
+		gating, the first gate reads the stack once more to keep its cumulative sums, and after that the gate is changed
+		without reading it. Otherwise every gate reads the stack, or the cache, again. Raises a ValueError if the gate
+		is outside of the stack"""
+		with self.synced():
+			if gating:
+				self.dataset.enable_gating()
+			else:
+				self.dataset.disable_gating()
+			self.dataset.set_gate(start, stop)
+		self.apply_masks()
+		self.update_graph()
+
+	def disable_gating(self):
+		"""Drops the cumulative sums kept for changing the gate, see PhasorDataset.disable_gating"""
+		with self.synced():
+			self.dataset.disable_gating()
+
+	def set_binning(self, radius, shape='square'):
+		"""Sums the decays of the (2 * radius + 1) square, or the circle of radius, around every pixel, see
+		PhasorDataset.set_binning"""
+		with self.synced():
+			self.dataset.set_binning(radius, shape)
+		self.apply_masks()
+		self.update_graph()
+
+	def cluster(self, k, method='kmeans'):
+		"""Fits k clusters to the phasor plot and shows the pixels of each cluster in its colour over the image, see
+		PhasorDataset.cluster. Raises a ValueError if the clusters can't be fitted"""
+		with self.synced():
+			self.dataset.cluster(k, method)
+		self.apply_masks()
 
 	def set_data_num(self, num):
 		"""Updates the titles of the windows to keep track of the window number"""
 		self.image_window.set_window_number(num)
 		self.graph_window.set_window_number(num)
 
-	def save_data(self, file, save_type):
-		"""Saves all the images of the various colormaps, the g and s coordinates, and a file that contains all the
-		parameters used to create the data."""
-		self.graph_window.update_fraction_range(self.fraction_min, self.fraction_max)
-		colormap = self.color_map_select
-		self.color_map_select = 3
-		self.change_colormap(0)
-		mask = self.apply_masks()
-		image = Image.fromarray(self.displayImage)
-		if save_type == 'all' or (save_type == 'current' and colormap == 0):
-			image.save(file + '/' + self.name + '_image_Intensity.tif')
-			self.graph_window.save_fig(file + '/' + self.name + '_graph_density.png')
-		if save_type == 'all' or (save_type == 'current' and colormap == 3):
-			self.graph_window.save_fig(file + '/' + self.name + '_graph_density.png')
-		self.color_map_select = 1
-		self.change_colormap(self.color_map_select)
-		self.apply_masks()
-		image = Image.fromarray(self.displayImage)
-		if save_type == 'all' or (save_type == 'current' and colormap == 1):
-			image.save(file + '/' + self.name + '_image_TauM.tif')
-			self.graph_window.save_fig(file + '/' + self.name + '_graph_TauM.png')
-		self.color_map_select = 2
-		self.change_colormap(self.color_map_select)
-		self.apply_masks()
-		image = Image.fromarray(self.displayImage)
-		if save_type == 'all' or (save_type == 'current' and colormap == 2):
-			image.save(file + '/' + self.name + '_image_TauP.tif')
-			self.graph_window.save_fig(file + '/' + self.name + '_graph_TauP.png')
-		self.color_map_select = 3
-		self.apply_masks()
-		image = Image.fromarray(self.displayImage)
-		if save_type == 'all' or (save_type == 'current' and colormap == 3):
-			image.save(file + '/' + self.name + '_image_Jet.tif')
-			# self.graph_window.save_fig(file + '/' + self.name + '_graph_density.png')
-		self.color_map_select = 4
-		self.change_colormap(self.color_map_select)
-		self.apply_masks()
-		image = Image.fromarray(self.displayImage)
-
-		if save_type == 'all' or (save_type == 'current' and colormap == 4):
-			image.save(file + '/' + self.name + '_image_Distance.tif')
-			self.graph_window.save_fig(file + '/' + self.name + '_graph_Distance.png')
-		# When you select the colormaps between intensity (0) and Jet (3), the old code changed the value inside of
-		# the function self.change_colormap(). Now, it causes an error if you plug in the same values as what's currenty
-		# displayed. Therefore, for some reason, you need to change the value of self.color_map_select before running
-		# the function
-		if colormap == 3:
-			self.color_map_select = 0
-			self.change_colormap(0)
-		else:
-			self.color_map_select = 3
-			self.change_colormap(colormap)
-
-		coors = self.x_adjusted.copy()
-		coors[mask] = float("nan")
-		x_avg = np.average(coors[~mask])
-		tifffile.imsave(file + '/' + self.name + '_g.tiff', coors.reshape(self.original_image.shape))
-		coors = self.y_adjusted.copy()
-		coors[mask] = float("nan")
-		y_avg = np.average(coors[~mask])
-		tifffile.imsave(file + '/' + self.name + '_s.tiff', coors.reshape(self.original_image.shape))
-
-		arr = self.angle_arr.copy()
-		omega = 2 * np.pi * self.freq / 1000 * self.harmonic
-		tau_p = 1 / omega * arr
-		tau_p[mask] = float("nan")
-		if save_type == 'all' or (save_type == 'current' and colormap == 2):
-			tifffile.imsave(file + '/' + self.name + '_TauP.tiff', tau_p)
-
-		arr = self.distance_arr.copy()
-		omega = 2 * np.pi * self.freq / 1000 * self.harmonic
-		tau_m = 1 / omega * np.sqrt(1 / np.power(arr, 2) - 1)
-		tau_m[mask] = float("nan")
-		if save_type == 'all' or (save_type == 'current' and colormap == 1):
-			tifffile.imsave(file + '/' + self.name + '_TauM.tiff', tau_m)
-
-		frac = self.fraction_arr.copy()
-		frac[mask] = float("nan")
-		if save_type == 'all' or (save_type == 'current' and colormap == 4):
-			tifffile.imsave(file + '/' + self.name + '_Dist.tiff', frac)
-
-		save_params = [f'number Of 3x3 Median Filters: {self.num_filter}\n',
-					   f'Intensity Min: {self.min_thresh:.3f}\n',
-					   f'Intensity Max: {self.max_thresh:.3f}\n',
-					   f'Phi Min (Deg, ns): ({self.applied_min_ang:.3f}, {1 / omega * np.tan(np.deg2rad(self.applied_min_ang)):.3f}) \n',
-					   f'Phi Max (Deg, ns): ({self.applied_max_ang:.3f}, {1 / omega * np.tan(np.deg2rad(self.applied_max_ang)):.3f})\n',
-					   f'Modulation Min (M, ns): ({self.applied_min_M/100:.3f}, {1 / omega * np.sqrt(1 / np.power(self.applied_min_M/100, 2) - 1):.3f})\n',
-					   f'Modulation Max (M, ns): ({self.applied_max_M/100:.3f}, {1 / omega * np.sqrt(1 / np.power(self.applied_max_M/100, 2) - 1):.3f})\n',
-					   f'Distance From Coordinates (g,s): {self.x_fraction:.3f}, {self.y_fraction:.3f}\n',
-					   f'Distance Min: {self.fraction_min:.3f}\n',
-					   f'Distance Max: {self.fraction_max:.3f}\n\n\n',
-					   f'Average g Coordinate: {x_avg:.3f}\n',
-					   f'Average s Coordinate: {y_avg:.3f}\n',
-					   f'Average TauP (ns): {np.nanmean(tau_p):.3f}\n',
-					   f'Average TauM (ns): {np.nanmean(tau_m):.3f}\n',
-					   f'Average distance: {np.nanmean(frac):.3f}\n']
-
-		with open(file + '/' + self.name + '_Parameters.txt', 'w') as f:
-			f.writelines(save_params)
+	def export_tasks(self, file, save_type, harmonics=False):
+		"""Returns the tasks which save all the images of the various colormaps, the g and s coordinates, the phasor
+		plots, and a file that contains all the parameters used to create the data, see ExportPipeline. With
+		harmonics the maps of the other harmonics are saved too. The tasks export a snapshot of the data, so they run
+		in the background while the data keeps changing, and the windows are left as they are"""
+		with self.synced(), Instrumentation.span('snapshot', image=self.name):
+			data = self.dataset.snapshot()
+		return ExportPipeline.export_tasks(data, file, save_type, harmonics=harmonics)
+
+	def save_data(self, file, save_type, harmonics=False):
+		"""Saves all the data, and waits for the files to be written"""
+		ExportPipeline.run_tasks(self.export_tasks(file, save_type, harmonics))
+
+	def memory_usage(self):
+		"""Returns a dictionary of attribute: bytes of the arrays held by the dataset and the tiles of the image"""
+		with self.lock:
+			memory = self.dataset.memory_usage()
+			memory['pyramid'] = sum(tile.nbytes for tile in self.pyramid.tiles.values())
+		return memory
@@ -0,0 +1,57 @@
+# Keeps the coloured image as square tiles at power of two levels of detail, so that the picture window only colours
+# the part of the image which is in view, at the resolution of the screen. Zoomed out, a level only colours every
+# n-th pixel, and the tiles which were coloured already are reused while panning, until the colours change.
+
+# imports
+from collections import OrderedDict
+import numpy as np
+
+
+class ImagePyramid:
+	"""Tiles of the RGB image of the given (height, width) shape. render(index) returns the colours of the pixels
+	index of the image, where index is a pair of (possibly strided) slices. Tiles are kept until clear is called, up
+	to max_tiles of them, dropping the least recently used ones"""
+
+	def __init__(self, shape, render, tile=256, max_tiles=128):
+		self.shape = shape[:2]
+		self.render = render
+		self.tile = tile
+		self.max_tiles = max_tiles
+		# (step, tile row, tile column): RGB tile
+		self.tiles = OrderedDict()
+
+	def clear(self):
+		"""Drops the tiles, after the colours of the image changed"""
+		self.tiles.clear()
+
+	def get_tile(self, step, row, column):
+		"""Returns the tile at row, column of the level which has every step-th pixel of the image"""
+		key = (step, row, column)
+		tile = self.tiles.get(key)
+		if tile is None:
+			size = self.tile * step
+			height, width = self.shape
+			index = (slice(row * size, min((row + 1) * size, height), step),
+					 slice(column * size, min((column + 1) * size, width), step))
+			tile = self.render(index)
+			self.tiles[key] = tile
+			if len(self.tiles) > self.max_tiles:
+				self.tiles.popitem(last=False)
+		else:
+			self.tiles.move_to_end(key)
+		return tile
+
+	def view(self, top, left, bottom, right, step=1):
+		"""Returns the image of the tiles which cover the pixels [top, bottom) x [left, right) of the image at the
+		level of step, along with the (row, column) of the image pixel at its top left corner and step. Each pixel of
+		the returned image covers step x step pixels of the image"""
+		height, width = self.shape
+		size = self.tile * step
+		top = min(max(int(top), 0), height - 1) // size
+		left = min(max(int(left), 0), width - 1) // size
+		bottom = max(-(-min(int(np.ceil(bottom)), height) // size), top + 1)
+		right = max(-(-min(int(np.ceil(right)), width) // size), left + 1)
+		rows = [np.concatenate([self.get_tile(step, row, column) for column in range(left, right)], axis=1)
+				for row in range(top, bottom)]
+		image = np.ascontiguousarray(np.concatenate(rows, axis=0))
+		return image, (top * size, left * size, step)
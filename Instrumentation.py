@@ -0,0 +1,212 @@
+# Measures where the time goes while FLUTE is used. The stages of the calculations and of the windows are wrapped in
+# named spans, which add up how often and how long each stage ran, and can be written to a trace file that is opened
+# in chrome://tracing or https://ui.perfetto.dev to attach to performance reports. The memory held by the arrays of a
+# dataset is counted the same way. While it is disabled a span is a shared object which does nothing, so the
+# instrumentation costs no more than a function call.
+#
+# It is enabled by the status panel of the GUI, or from the start by setting the FLUTE_PROFILE environment variable to
+# 1, or to the path of the trace file to write.
+
+# imports
+import atexit
+import json
+import os
+import threading
+import time
+from functools import wraps
+import numpy as np
+
+_enabled = False
+_lock = threading.Lock()
+# name: [count, total seconds, longest seconds, last seconds]
+_statistics = {}
+_trace = None
+_trace_started = False
+_start = time.perf_counter()
+
+
+class _NullSpan:
+	"""The span returned while the instrumentation is disabled"""
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span:
+	"""Times the code of a with block under name. fields are written to the trace along with it"""
+
+	def __init__(self, name, fields):
+		self.name = name
+		self.fields = fields
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *args):
+		record(self.name, self.start, time.perf_counter() - self.start, self.fields)
+		return False
+
+
+def enabled():
+	return _enabled
+
+
+def enable(trace_file=None):
+	"""Starts recording the spans, and writing them to trace_file if it is given"""
+	global _enabled, _trace, _trace_started
+	with _lock:
+		if trace_file is not None and _trace is None:
+			# line buffered, so that the events are written even if the process is ended without closing the file
+			_trace = open(trace_file, 'w', buffering=1)
+			_trace.write('[\n')
+			_trace_started = False
+		_enabled = True
+
+
+def disable():
+	"""Stops recording the spans, and finishes the trace file"""
+	global _enabled, _trace
+	with _lock:
+		_enabled = False
+		if _trace is not None:
+			_trace.write(']\n')
+			_trace.close()
+			_trace = None
+
+
+def span(name, **fields):
+	"""Returns a context manager which times the code it wraps as the stage name, e.g.
+	with Instrumentation.span('histogram'): ..."""
+	if not _enabled:
+		return NULL_SPAN
+	return Span(name, fields)
+
+
+def timed(name):
+	"""Decorator which times every call of the function as the stage name"""
+	def decorator(function):
+		@wraps(function)
+		def wrapper(*args, **kwargs):
+			if not _enabled:
+				return function(*args, **kwargs)
+			with Span(name, {}):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorator
+
+
+def _write_event(event):
+	"""Writes an event of the Trace Event Format to the trace file. Must be called with the lock held"""
+	global _trace_started
+	if _trace is None:
+		return
+	_trace.write((',' if _trace_started else '') + json.dumps(event) + '\n')
+	_trace_started = True
+
+
+def record(name, start, seconds, fields=None):
+	"""Adds a span of name which started at start (time.perf_counter) and took seconds"""
+	with _lock:
+		statistics = _statistics.get(name)
+		if statistics is None:
+			_statistics[name] = [1, seconds, seconds, seconds]
+		else:
+			statistics[0] += 1
+			statistics[1] += seconds
+			statistics[2] = max(statistics[2], seconds)
+			statistics[3] = seconds
+		_write_event({'name': name, 'ph': 'X', 'ts': (start - _start) * 1e6, 'dur': seconds * 1e6, 'pid': os.getpid(),
+					  'tid': threading.get_ident(), 'args': fields or {}})
+
+
+def counter(name, values):
+	"""Writes the dictionary of numbers values to the trace as a counter, e.g. the bytes held by the arrays of a
+	dataset, which is drawn as a graph over time"""
+	if not _enabled:
+		return
+	with _lock:
+		_write_event({'name': name, 'ph': 'C', 'ts': (time.perf_counter() - _start) * 1e6, 'pid': os.getpid(),
+					  'args': values})
+
+
+def statistics():
+	"""Returns a dictionary of name: (count, total seconds, longest seconds, last seconds) of the stages"""
+	with _lock:
+		return {name: tuple(values) for name, values in _statistics.items()}
+
+
+def reset():
+	"""Forgets the statistics recorded so far"""
+	with _lock:
+		_statistics.clear()
+
+
+def _owner(array):
+	"""Returns the array which owns the memory of array, so that views of the same memory are only counted once"""
+	while isinstance(array.base, np.ndarray):
+		array = array.base
+	return array
+
+
+def _arrays(obj, prefix, seen):
+	"""Yields the (attribute path, array) of the numpy arrays held by obj"""
+	if id(obj) in seen:
+		return
+	seen.add(id(obj))
+	if isinstance(obj, np.ndarray):
+		yield prefix, obj
+		return
+	if isinstance(obj, dict):
+		items = obj.items()
+	elif isinstance(obj, (list, tuple)):
+		items = enumerate(obj)
+	elif hasattr(obj, '__dict__') and not callable(obj) and type(obj).__module__ not in ('builtins', 'numpy'):
+		items = vars(obj).items()
+	else:
+		return
+	for key, value in list(items):
+		if isinstance(obj, (dict, list, tuple)):
+			path = f'{prefix}[{key!r}]'
+		else:
+			path = f'{prefix}.{key}' if prefix else key
+		yield from _arrays(value, path, seen)
+
+
+def array_memory(obj):
+	"""Returns a dictionary of attribute path: bytes of the numpy arrays held by obj, including the arrays in its
+	lists, tuples, dictionaries and the objects it holds. Arrays which share their memory are only counted once,
+	under the path of the array which owns the memory if obj holds it, and otherwise under the first path of its
+	views. Memory mapped files are left out, as they are read from the disk rather than held in memory"""
+	paths = {}
+	for path, array in _arrays(obj, '', set()):
+		owner = _owner(array)
+		if isinstance(owner, np.memmap):
+			continue
+		if id(owner) not in paths or array is owner:
+			paths[id(owner)] = (path, owner.nbytes)
+	return dict(paths.values())
+
+
+def _enable_from_environment():
+	setting = os.environ.get('FLUTE_PROFILE', '')
+	if setting in ('', '0'):
+		return
+	if setting == '1':
+		enable()
+		return
+	# the worker processes of a batch, which inherit the environment, each write a trace file of their own
+	if os.environ.setdefault('FLUTE_PROFILE_PID', str(os.getpid())) != str(os.getpid()):
+		root, extension = os.path.splitext(setting)
+		setting = f'{root}_{os.getpid()}{extension}'
+	enable(setting)
+
+
+atexit.register(disable)
+_enable_from_environment()
@@ -0,0 +1,115 @@
+# Keeps the maps derived from the phasor coordinates of the open datasets, such as the filtered coordinates, the angle
+# and distance maps and the bins of the phasor plot. A map is calculated the first time it is needed, and kept while
+# the maps of every dataset fit in a shared memory budget. Past the budget, the least recently used maps are dropped,
+# and calculated again the next time they are needed, so that many more datasets can be open at once. The maps are
+# never changed once they are made, so the snapshots of a dataset share its store.
+
+# imports
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_BUDGET_BYTES = 1024 ** 3
+
+
+def map_bytes(value):
+	"""Returns the bytes of a map, which is an array or a tuple of arrays. Views of other arrays, such as the
+	coordinates before any filters, take no memory of their own"""
+	return sum(item.nbytes for item in (value if isinstance(value, tuple) else (value,)) if item.flags.owndata)
+
+
+def read_only(value):
+	"""Makes the arrays of a map read only, so that they aren't changed while they are shared"""
+	for item in value if isinstance(value, tuple) else (value,):
+		if isinstance(item, np.ndarray):
+			item.setflags(write=False)
+	return value
+
+
+class MapBudget:
+	"""Memory budget shared by the stores. Keeps the maps of every store in the order they were last used, and drops
+	the least recently used ones once they take more than max_bytes"""
+
+	def __init__(self, max_bytes=DEFAULT_BUDGET_BYTES):
+		self.max_bytes = max_bytes
+		self.lock = threading.RLock()
+		# (store id, key): (store reference, bytes)
+		self.entries = OrderedDict()
+		self.bytes = 0
+
+	def used(self, store, key):
+		with self.lock:
+			self.entries.move_to_end((id(store), key))
+
+	def add(self, store, key, nbytes):
+		"""Counts the new map key of store, and drops the oldest maps of any store past the budget. The newest map is
+		always kept, even if it doesn't fit by itself"""
+		with self.lock:
+			self.entries[(id(store), key)] = (weakref.ref(store), nbytes)
+			self.bytes += nbytes
+			self.evict(keep=1)
+
+	def evict(self, keep=0):
+		"""Drops the least recently used maps until the rest fit, keeping at least the newest keep maps"""
+		with self.lock:
+			while self.bytes > self.max_bytes and len(self.entries) > keep:
+				(_, key), (reference, nbytes) = self.entries.popitem(last=False)
+				self.bytes -= nbytes
+				store = reference()
+				if store is not None:
+					store.maps.pop(key, None)
+
+	def remove(self, store_id, keys):
+		with self.lock:
+			for key in keys:
+				entry = self.entries.pop((store_id, key), None)
+				if entry is not None:
+					self.bytes -= entry[1]
+
+	def set_max_bytes(self, max_bytes):
+		"""Changes the budget, dropping maps straight away if they no longer fit"""
+		self.max_bytes = max_bytes
+		self.evict()
+
+
+DEFAULT_BUDGET = MapBudget()
+
+
+class MapStore:
+	"""The derived maps of one dataset, by key. get(key, function) returns the map, calculating it with function() if
+	it isn't there. The key must hold everything the map depends on"""
+
+	def __init__(self, budget=DEFAULT_BUDGET):
+		self.budget = budget
+		self.maps = {}
+		# the maps of a store which is no longer used stop counting towards the budget
+		self.finalizer = weakref.finalize(self, MapStore.forget, budget, id(self), self.maps)
+
+	@staticmethod
+	def forget(budget, store_id, maps):
+		budget.remove(store_id, list(maps))
+
+	def get(self, key, function):
+		with self.budget.lock:
+			value = self.maps.get(key)
+			if value is not None:
+				self.budget.used(self, key)
+				return value
+		# calculated without the lock, so that the stores of other datasets are used in the meantime
+		value = read_only(function())
+		with self.budget.lock:
+			if key not in self.maps:
+				self.maps[key] = value
+				self.budget.add(self, key, map_bytes(value))
+		return value
+
+	def clear(self):
+		"""Drops all the maps, which are calculated again when they are needed"""
+		with self.budget.lock:
+			self.budget.remove(id(self), list(self.maps))
+			self.maps.clear()
+
+	def nbytes(self):
+		with self.budget.lock:
+			return sum(map_bytes(value) for value in self.maps.values())
@@ -0,0 +1,208 @@
+# Keeps the masks of the thresholds applied to the image, and the mask of all of them combined, up to date one
+# component at a time. Moving a range slider only changes the pixels whose values lie between the old and the new
+# limit, so those are found in the sorted order of the values instead of comparing the whole image again. The
+# components are kept packed eight pixels to a byte, as only the combined mask is read for every pixel.
+
+# imports
+import copy
+import numpy as np
+
+
+def pack(mask):
+	"""Returns the boolean mask packed eight pixels to a byte"""
+	return np.packbits(mask.reshape(-1))
+
+
+def unpack(packed, shape):
+	"""Returns the boolean mask of the given shape from its packed bits"""
+	size = int(np.prod(shape))
+	return np.unpackbits(packed, count=size).view(bool).reshape(shape)
+
+
+def set_bits(packed, pixels, value):
+	"""Sets the bits of the flat indices pixels of the packed mask to value"""
+	index = pixels >> 3
+	bits = np.left_shift(1, 7 - (pixels & 7)).astype(np.uint8)
+	if value:
+		np.bitwise_or.at(packed, index, bits)
+	else:
+		np.bitwise_and.at(packed, index, ~bits)
+
+
+class RangeMask:
+	"""Mask of the pixels of values which lie outside of a [min, max] range. Pixels without a value (nan) are never
+	masked. The values are sorted the second time the range changes, after which moving the range only touches the
+	pixels between the old and the new limits. values is the array, or a function which returns it, so that the
+	values are only made when the mask needs them"""
+
+	def __init__(self, values):
+		self.source = values
+		self.order = None
+		self.sorted = None
+		self.updates = 0
+		self.low, self.high = 0, 0
+
+	@property
+	def values(self):
+		values = self.source() if callable(self.source) else self.source
+		return values.reshape(-1)
+
+	def sort(self):
+		values = self.values
+		order = np.argsort(values, kind='stable')
+		valid = np.count_nonzero(~np.isnan(values)) if values.dtype.kind == 'f' else values.size
+		# the order takes half the memory as 32 bit indices, which fit all but the largest images
+		self.order = order[:valid].astype(np.int32) if values.size < 2 ** 31 else order[:valid]
+		self.sorted = values[self.order]
+
+	def compact(self):
+		"""Drops the sorted values, which are sorted again the next time the range changes"""
+		self.order = None
+		self.sorted = None
+
+	def search_key(self, limit, side):
+		"""Returns limit in the type of the sorted values, so that searchsorted doesn't convert all of them to the
+		type of limit. It is rounded up for the low limit and down for the high one, so the ranks are the same as
+		comparing the values with limit itself"""
+		dtype = self.sorted.dtype
+		limit = np.float64(limit)
+		if dtype.kind == 'f':
+			key = dtype.type(limit)
+			if side == 'left' and key < limit:
+				key = np.nextafter(key, dtype.type(np.inf))
+			elif side == 'right' and key > limit:
+				key = np.nextafter(key, dtype.type(-np.inf))
+			return key
+		key = np.ceil(limit) if side == 'left' else np.floor(limit)
+		info = np.iinfo(dtype)
+		return dtype.type(key) if info.min <= key <= info.max else limit
+
+	def ranks(self, min, max):
+		"""Returns the [low, high) ranks of the sorted values which are inside the range"""
+		low = np.searchsorted(self.sorted, self.search_key(min, 'left'), 'left')
+		high = np.searchsorted(self.sorted, self.search_key(max, 'right'), 'right')
+		return low, int(np.maximum(high, low))
+
+	def update(self, min, max):
+		"""Moves the range to [min, max]. Returns None if the whole mask has to be recomputed, and otherwise a list of
+		the (pixels, masked) whose state changed"""
+		self.updates += 1
+		if self.updates < 2:
+			return None
+		if self.order is None:
+			self.sort()
+			self.low, self.high = self.ranks(min, max)
+			return None
+		low, high = self.ranks(min, max)
+		# the state of a pixel only changes between the breakpoints where it enters or leaves one of the two ranges
+		points = sorted({self.low, self.high, low, high})
+		changes = []
+		for start, stop in zip(points[:-1], points[1:]):
+			was_inside = self.low <= start < self.high
+			is_inside = low <= start < high
+			if was_inside != is_inside:
+				changes.append((self.order[start:stop], was_inside))
+		self.low, self.high = low, high
+		return changes
+
+	def compute(self, min, max):
+		"""Returns the full flat mask of the range"""
+		# compared in double precision, the same as the ranks of the sorted values
+		values = self.values
+		return np.logical_or(values > np.float64(max), values < np.float64(min))
+
+
+class MaskManager:
+	"""Holds the named boolean masks which are combined into the mask of the image. Each pixel keeps a count of the
+	components which mask it, so that changing one component only updates the pixels where it changed. The components
+	are stored packed, and unpacked when they are read"""
+
+	def __init__(self, shape):
+		self.shape = shape
+		self.components = {}
+		self.ranges = {}
+		self.versions = {}
+		self.count = np.zeros(shape, dtype=np.uint8)
+		self.combined = np.zeros(shape, dtype=bool)
+		# the combined mask is handed out as a read only view, as it is updated in place
+		self.mask = self.combined.view()
+		self.mask.flags.writeable = False
+
+	def __getitem__(self, name):
+		return unpack(self.components[name], self.shape)
+
+	def copy(self):
+		"""Returns a copy of the masks as they are now, which isn't changed by the changes made to these ones. The
+		values of the ranges are shared, as they are only ever replaced"""
+		masks = copy.copy(self)
+		masks.components = {name: mask.copy() for name, mask in self.components.items()}
+		masks.ranges = {name: copy.copy(range_mask) for name, range_mask in self.ranges.items()}
+		masks.versions = dict(self.versions)
+		masks.count = self.count.copy()
+		masks.combined = self.combined.copy()
+		masks.mask = masks.combined.view()
+		masks.mask.flags.writeable = False
+		return masks
+
+	def version(self, name):
+		"""Returns a number which changes every time the component name changes"""
+		return self.versions.get(name, 0)
+
+	def set_mask(self, name, mask):
+		"""Replaces the component name with the boolean array mask"""
+		old = self.components.get(name)
+		mask = np.ascontiguousarray(mask, dtype=bool).reshape(-1)
+		if old is None:
+			self.toggle(np.flatnonzero(mask), True)
+		else:
+			changed = np.flatnonzero(unpack(old, mask.shape) != mask)
+			if len(changed) == 0:
+				return
+			masked = mask[changed]
+			self.toggle(changed[masked], True)
+			self.toggle(changed[~masked], False)
+		self.components[name] = pack(mask)
+		self.versions[name] = self.version(name) + 1
+
+	def set_values(self, name, values):
+		"""Sets the values which the range of the component name is applied to, an array or a function which returns
+		it. The mask itself keeps its state until the range is set again"""
+		self.ranges[name] = RangeMask(values)
+		if name not in self.components:
+			self.set_mask(name, np.zeros(self.shape, dtype=bool))
+
+	def set_range(self, name, min, max):
+		"""Masks the pixels of the component name whose values are outside of [min, max]"""
+		changes = self.ranges[name].update(min, max)
+		if changes is None:
+			self.set_mask(name, self.ranges[name].compute(min, max))
+			return
+		component = self.components[name]
+		for pixels, masked in changes:
+			set_bits(component, pixels, masked)
+			self.toggle(pixels, masked)
+		if changes:
+			self.versions[name] = self.version(name) + 1
+
+	def remove(self, name):
+		"""Removes the component name from the mask"""
+		if name in self.components:
+			self.set_mask(name, np.zeros(self.shape, dtype=bool))
+			del self.components[name]
+		self.ranges.pop(name, None)
+
+	def toggle(self, pixels, masked):
+		"""Adds (or removes) one component to the count of pixels, and updates the combined mask there"""
+		if len(pixels) == 0:
+			return
+		count = self.count.reshape(-1)
+		if masked:
+			count[pixels] += 1
+		else:
+			count[pixels] -= 1
+		self.combined.reshape(-1)[pixels] = count[pixels] > 0
+
+	def compact(self):
+		"""Drops the sorted values of the ranges, e.g. while the image isn't selected"""
+		for range_mask in self.ranges.values():
+			range_mask.compact()
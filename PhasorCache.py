@@ -0,0 +1,161 @@
+# Keeps the phasor coordinates of the stacks which have already been read in a cache directory, so that opening the same
+# stack again doesn't need to read the raw decays. The entries are compressed numpy files, and the least recently used
+# ones are removed when the cache grows over its size limit. A cache which can't be written, e.g. on a read only or full
+# disk, only gives a warning, and the stacks are read as if there was no cache.
+#
+# The directory of the cache is set by the FLUTE_CACHE environment variable, and setting it to 0 turns the cache off.
+
+# imports
+import numpy as np
+import hashlib
+import os
+import glob
+import warnings
+import PhasorTransform
+
+_setting = os.environ.get('FLUTE_CACHE', '')
+CACHE_DIR = _setting if _setting not in ('', '0') else os.path.join(os.path.expanduser('~'), '.flute', 'cache')
+MAX_BYTES = 2 * 1024 ** 3
+
+
+class PhasorCache:
+	"""Stores the intensity image and the uncalibrated g and s coordinates of the stacks in directory. An entry is
+	found by the identity of the file (its path, size and modification time, or a hash of its content when
+	hash_content is set) along with the bin width, frequency, harmonics and time gate of the transform. The calibration is not
+	part of the key, as it is applied to the coordinates after they are read from the cache"""
+
+	def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES, hash_content=False):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.hash_content = hash_content
+
+	def file_key(self, filename):
+		"""Returns the part of the key which identifies the file. Every entry of a file starts with it"""
+		return hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()[:16]
+
+	def key(self, filename, bin_width, freq, harmonics, gate=None):
+		"""Returns the name of the entry of filename transformed with the given parameters"""
+		if self.hash_content:
+			content = hashlib.sha1()
+			with open(filename, 'rb') as f:
+				for block in iter(lambda: f.read(1024 ** 2), b''):
+					content.update(block)
+			identity = content.hexdigest()
+		else:
+			stat = os.stat(filename)
+			identity = f'{stat.st_size}_{stat.st_mtime_ns}'
+		params = (identity, float(bin_width), float(freq), tuple(float(h) for h in harmonics))
+		if gate is not None:
+			params += (tuple(int(bin) for bin in gate),)
+		params = repr(params)
+		return self.file_key(filename) + '_' + hashlib.sha1(params.encode()).hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.directory, key + '.npz')
+
+	def get(self, key):
+		"""Returns the (intensity, g, s) of the entry, or None if it isn't in the cache"""
+		path = self.path(key)
+		try:
+			with np.load(path) as entry:
+				arrays = entry['intensity'], entry['g'], entry['s']
+		except (OSError, KeyError, ValueError):
+			return None
+		# mark the entry as recently used
+		try:
+			os.utime(path)
+		except OSError:
+			# a read only cache is still read from
+			pass
+		return arrays
+
+	def put(self, key, intensity, g, s):
+		"""Adds the entry to the cache, and removes the least recently used entries if the cache is too large. If the
+		cache can't be written, a warning is given and the entry is left out"""
+		path = self.path(key)
+		# write to a temporary file first, so an interrupted write never leaves a broken entry
+		temp_path = path + '.tmp'
+		try:
+			os.makedirs(self.directory, exist_ok=True)
+			with open(temp_path, 'wb') as f:
+				np.savez_compressed(f, intensity=intensity, g=g, s=s)
+			os.replace(temp_path, path)
+		except OSError as error:
+			warnings.warn(f"The phasor cache in {self.directory} can't be written: {error}", RuntimeWarning)
+			try:
+				os.remove(temp_path)
+			except OSError:
+				pass
+			return
+		self.enforce_limit()
+
+	def enforce_limit(self):
+		"""Removes the least recently used entries until the cache fits in max_bytes"""
+		try:
+			entries = []
+			for path in glob.glob(os.path.join(self.directory, '*.npz')):
+				try:
+					entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+				except OSError:
+					pass
+			total = sum(size for _, size, _ in entries)
+			for _, size, path in sorted(entries):
+				if total <= self.max_bytes:
+					break
+				try:
+					os.remove(path)
+				except FileNotFoundError:
+					# already removed, e.g. by another process sharing the cache
+					pass
+				total -= size
+		except OSError as error:
+			warnings.warn(f"The phasor cache in {self.directory} can't be trimmed: {error}", RuntimeWarning)
+
+	def invalidate(self, filename):
+		"""Removes all the entries of filename"""
+		for path in glob.glob(os.path.join(self.directory, self.file_key(filename) + '_*.npz')):
+			os.remove(path)
+
+	def clear(self):
+		"""Removes every entry of the cache"""
+		for path in glob.glob(os.path.join(self.directory, '*.npz')):
+			os.remove(path)
+
+	def size(self):
+		"""Returns the size of the cache in bytes"""
+		return sum(os.path.getsize(path) for path in glob.glob(os.path.join(self.directory, '*.npz')))
+
+
+def cache_from_setting(directory):
+	"""Returns the PhasorCache in directory, the default cache if directory is None, or None (no cache) if it is '0'
+	or empty"""
+	if directory is None:
+		return DEFAULT_CACHE
+	if directory in ('', '0'):
+		return None
+	return PhasorCache(directory)
+
+
+DEFAULT_CACHE = None if _setting == '0' else PhasorCache()
+
+
+def read_phasor_coordinates(filename, bin_width, freq, harmonics=(1,), memory_budget=PhasorTransform.MEMORY_BUDGET,
+							progress=None, cache=DEFAULT_CACHE, gate=None):
+	"""Returns the intensity image and the uncalibrated (n_harmonics, Y, X) g and s coordinates of the tiff stack at
+	filename. They are read from the cache when the stack was already transformed with the same parameters, and
+	otherwise the stack is streamed through the transform and the result is added to the cache. Passing cache=None
+	always reads the stack. If gate is given, only the time bins [start, stop) of it are summed"""
+	if cache is not None:
+		key = cache.key(filename, bin_width, freq, harmonics, gate)
+		arrays = cache.get(key)
+		if arrays is not None:
+			if progress is not None:
+				progress(1, 1)
+			return arrays
+
+	intensity, sums = PhasorTransform.read_phasor_sums(filename, bin_width, freq, harmonics, memory_budget, progress,
+													   gate)
+	g, s = PhasorTransform.sums_to_coordinates(sums)
+	if cache is not None:
+		cache.put(key, intensity, g, s)
+	return intensity, g, s
@@ -0,0 +1,939 @@
+# Holds the phasor data of one FLIM stack: the g and s coordinates, the thresholds, the filters and the derived maps.
+# Everything here is plain numpy, so the data can be computed and exported without any Qt windows. ImageHandler is
+# the GUI view over this class.
+
+
+# imports
+import copy
+from functools import lru_cache, partial
+import numpy as np
+from PIL import Image
+import os
+import matplotlib
+from scipy import signal
+import tifffile
+import PhasorTransform
+import PhasorCache
+import PhasorPlot
+import ExportPipeline
+import Instrumentation
+import Unmixing
+import Clustering
+from MapStore import MapStore
+from MaskManager import MaskManager
+
+np.seterr(divide='ignore', invalid='ignore')
+
+# colormap values used throughout: 0=Intensity (greyscale), 1=TauM, 2=TauP, 3=Jet intensity, 4=Distance
+COLORMAP_NAMES = {0: 'Intensity', 1: 'TauM', 2: 'TauP', 3: 'Jet', 4: 'Distance'}
+# colours of the four cursor circles, red, green, blue and yellow
+CIRCLE_COLOURS = [[255, 0, 0], [0, 255, 0], [0, 0, 255], [255, 255, 0]]
+# colours of the clusters of the phasor plot, which also limit how many clusters can be shown
+CLUSTER_COLOURS = [[0, 255, 255], [255, 0, 255], [255, 128, 0], [128, 0, 255], [0, 128, 128], [255, 128, 192],
+				   [128, 128, 0], [255, 255, 255]]
+# entries at the end of every lookup table: black for the pixels without a value or masked, then the circle colours and
+# the cluster colours
+OVERLAY_COLOURS = [[0, 0, 0]] + CIRCLE_COLOURS + CLUSTER_COLOURS
+# greyscale lookup table
+GREY_LUT = np.concatenate([np.repeat(np.arange(256)[:, None], 3, axis=1), OVERLAY_COLOURS]).astype(np.uint8)
+# harmonics which are calculated along with the selected one when the stack is read, so that they can be switched to
+# without reading the file again
+DEFAULT_HARMONICS = (1, 2)
+# The phasor coordinates are kept in single precision, which halves the memory of every map derived from them
+COORDINATE_DTYPE = np.float32
+
+
+@lru_cache(maxsize=None)
+def colormap_lut(name, bins):
+	"""Returns the uint8 lookup table of the matplotlib colormap name resampled to bins colours, followed by the
+	OVERLAY_COLOURS"""
+	colours = matplotlib.colormaps[name].resampled(bins)(np.arange(bins))[:, :3]
+	lut = np.zeros((bins + len(OVERLAY_COLOURS), 3), dtype=np.uint8)
+	lut[:bins] = (colours * 255).astype(int)
+	lut[bins:] = OVERLAY_COLOURS
+	lut.setflags(write=False)
+	return lut
+
+
+def median_filter(image):
+	"""Returns the 3x3 median filter of the 2D image, zero padded at the edges, which is the same as
+	scipy.signal.medfilt(image). Each column of three pixels is sorted once and shared by its neighbours, and the
+	median is the median of the largest of the low values, the median of the middle values and the smallest of the
+	high values of the three columns. Images with nan are passed to medfilt, which orders them differently"""
+	if image.ndim != 2 or np.isnan(image).any():
+		return signal.medfilt(image)
+	padded = np.pad(image, 1)
+	top, centre, bottom = padded[:-2], padded[1:-1], padded[2:]
+	# sort the columns into low <= mid <= high
+	low = np.minimum(top, centre)
+	high = np.maximum(top, centre)
+	mid = np.minimum(high, bottom)
+	np.maximum(high, bottom, out=high)
+	low, mid = np.minimum(low, mid), np.maximum(low, mid)
+
+	max_low = np.maximum(low[:, :-2], low[:, 1:-1])
+	np.maximum(max_low, low[:, 2:], out=max_low)
+	min_high = np.minimum(high[:, :-2], high[:, 1:-1])
+	np.minimum(min_high, high[:, 2:], out=min_high)
+	# median of three is max(min(a, b), min(max(a, b), c))
+	med_mid = np.minimum(mid[:, :-2], mid[:, 1:-1])
+	upper = np.maximum(mid[:, :-2], mid[:, 1:-1])
+	np.minimum(upper, mid[:, 2:], out=upper)
+	np.maximum(med_mid, upper, out=med_mid)
+
+	np.maximum(max_low, med_mid, out=upper)
+	np.minimum(max_low, med_mid, out=max_low)
+	np.minimum(upper, min_high, out=upper)
+	return np.maximum(max_low, upper, out=upper)
+
+
+class PhasorDataset:
+	"""Holds the phasor coordinates of the tiff stack located at filename, along with the thresholds, filters and
+	derived maps applied to them"""
+
+	def __init__(self, filename, phi_cal=0, m_cal=1, bin_width=0.2208, freq=80, harmonic=1,
+				 memory_budget=PhasorTransform.MEMORY_BUDGET, progress=None, harmonics=DEFAULT_HARMONICS,
+				 cache=PhasorCache.DEFAULT_CACHE, dtype=COORDINATE_DTYPE, maps=None, gate=None, gating=False,
+				 binning=0, binning_shape='square'):
+		self.filename = filename
+		self.name = os.path.splitext(os.path.basename(filename))[0]
+		self.phi_cal = float(phi_cal)
+		self.m_cal = float(m_cal)
+		self.bin_width = float(bin_width)
+		self.freq = float(freq)
+		self.harmonic = float(harmonic)
+		self.harmonics = tuple(float(h) for h in harmonics)
+		if self.harmonic not in self.harmonics:
+			self.harmonics = (self.harmonic,) + self.harmonics
+		self.memory_budget = memory_budget
+		self.cache = cache
+		self.dtype = np.dtype(dtype)
+		# the maps derived from the coordinates are made when they are needed, and dropped past the memory budget
+		self.maps = MapStore() if maps is None else maps
+
+		# With gating, the cumulative sums of the stack over the time bins are kept, so that the time gate is changed
+		# without reading the stack again, see set_gate
+		self.bins = None
+		self.cumulative = None
+		if gating:
+			self.cumulative = PhasorTransform.read_cumulative_sums(filename, self.bin_width, self.freq, self.harmonics,
+																   progress)
+		# (start, stop) of the time bins which are summed, or None for all of them
+		self.gate = self.resolve_gate(gate)
+		# the decays of the square or circle of radius binning around every pixel are summed, see set_binning
+		self.binning = int(binning)
+		self.binning_shape = binning_shape
+
+		# The stack is streamed through the transform, so it is never held in memory as a whole. All the harmonics
+		# are calculated in the same pass over the file, or read from the cache if the file was opened before
+		intensity, g, s = self.read_coordinates(self.harmonics, progress)
+		self.set_intensity(intensity)
+		# the buffers of the full size colormaps are only allocated when they are used, see colormaps
+		self.displayImage = None
+
+		# Record the fft coordinates of every harmonic as (n_harmonics, Y, X) arrays, and the selected one as g and s
+		self.g_harmonics, self.s_harmonics = self.calibrate_coordinates(g, s)
+		del g, s
+		self.select_harmonic(self.harmonic)
+		# (harmonic, number of filters, whether the zeros of g are moved) of the coordinates the maps are made from,
+		# which only changes when the filters are applied, and the point the fraction map is measured from
+		self.coordinates_key = (self.harmonic, 0, False)
+		self.fraction_point = (0, 0)
+		# number (1 to 4) of the cursor circle each pixel is coloured with, or 0 outside of the circles
+		self.circle_label = np.zeros(self.original_image.shape, dtype=np.uint8)
+		self.circle_coors = np.full((4, 2), -3.0)
+		self.circle_radius = [0.05, 0.05, 0.05, 0.05]
+
+		self.color_map_select = 0
+		self.min_thresh = 0
+		self.max_thresh = 1000000
+		self.x_fraction = 0
+		self.y_fraction = 0
+		self.num_filter = 0
+
+		self.image_min_ang, self.image_max_ang = 0, 90
+		self.applied_min_ang, self.applied_max_ang = 0, 90
+		self.image_min_M, self.image_max_M = 0, 120
+		self.applied_min_M, self.applied_max_M = 0, 120
+		self.fraction_min, self.fraction_max = 0, 1
+		# (g, s) of the species every pixel is unmixed into, and the (min, max) range of the fraction of each of them
+		self.unmixing_components = ()
+		self.unmixing_ranges = ()
+		# the PhasorClusters fitted to the phasor plot, whose labels are shown over the image, see cluster
+		self.clusters = None
+
+		# The thresholds are the components of the mask, which are each updated on their own
+		self.masks = MaskManager(self.original_image.shape)
+		self.masks.set_values('intensity', self.original_image)
+		self.masks.set_range('intensity', self.min_thresh, self.max_thresh)
+		self.thresholded_cache = None
+		self.histogram_cache = None
+		self.coordinates_changed()
+		self.colormap_scale(self.get_mask())
+
+	@Instrumentation.timed('dataset/read')
+	def read_coordinates(self, harmonics, progress=None):
+		"""Returns the intensity image and the uncalibrated (n_harmonics, Y, X) g and s coordinates of harmonics, of the
+		time bins in the gate and binned over the neighbourhood of every pixel. With gating they are found from the
+		cumulative sums, which are read for the harmonics they don't have yet, and otherwise they are read from the
+		cache or the stack. The intensity image itself isn't binned"""
+		if self.cumulative is None:
+			intensity, g, s = PhasorCache.read_phasor_coordinates(self.filename, self.bin_width, self.freq, harmonics,
+																  self.memory_budget, progress, self.cache, self.gate)
+		else:
+			missing = tuple(h for h in harmonics if h not in self.cumulative.harmonics)
+			if missing:
+				self.cumulative = self.cumulative.add_harmonics(
+					PhasorTransform.read_cumulative_sums(self.filename, self.bin_width, self.freq, missing, progress))
+			intensity, sums = self.cumulative.gate_sums(self.gate, harmonics)
+			g, s = PhasorTransform.sums_to_coordinates(sums)
+		with Instrumentation.span('dataset/binning', radius=self.binning, shape=self.binning_shape):
+			g, s = PhasorTransform.bin_coordinates(intensity, g, s, self.binning, self.binning_shape)
+		return intensity, g, s
+
+	def set_intensity(self, intensity):
+		"""Sets the intensity image, which is kept in the smallest integer type which holds it rather than the 64
+		bits of the sums"""
+		self.max = np.max(intensity)
+		self.min = np.min(intensity)
+		if intensity.dtype.kind in 'ui':
+			dtype = np.result_type(np.min_scalar_type(self.min), np.min_scalar_type(self.max))
+			intensity = intensity.astype(dtype, copy=False)
+			self.max, self.min = dtype.type(self.max), dtype.type(self.min)
+		self.original_image = intensity
+
+	def calibrate_coordinates(self, g, s):
+		"""Returns the calibrated g and s coordinates in the dtype of the dataset"""
+		return tuple(c.astype(self.dtype, copy=False) for c in PhasorTransform.calibrate(g, s, self.phi_cal, self.m_cal))
+
+	def time_bins(self):
+		"""Returns the number of time bins of the stack"""
+		if self.bins is None:
+			self.bins = self.cumulative.bins if self.cumulative is not None else PhasorTransform.stack_bins(self.filename)
+		return self.bins
+
+	def resolve_gate(self, gate):
+		"""Returns the time bins of gate as (start, stop), where a stop of None is the end of the stack, or None if the
+		gate has all the bins. Raises a ValueError if the gate is outside of the stack"""
+		if gate is None:
+			return None
+		bins = self.time_bins()
+		start, stop = int(gate[0]), bins if gate[1] is None else int(gate[1])
+		PhasorTransform.gate_slice((start, stop), bins)
+		return None if (start, stop) == (0, bins) else (start, stop)
+
+	def filtered(self, harmonic, num_filter):
+		"""Returns the (g, s) maps of harmonic after num_filter median filters. Each number of filters is made from
+		the one before it, so adding a filter only runs one more pass while the maps before it are kept"""
+		if num_filter <= 0:
+			idx = self.harmonics.index(harmonic)
+			return self.g_harmonics[idx], self.s_harmonics[idx]
+
+		def make():
+			previous = self.filtered(harmonic, num_filter - 1)
+			with Instrumentation.span('dataset/median_filter', filter=num_filter):
+				return tuple(median_filter(c) for c in previous)
+		return self.maps.get(('filtered', harmonic, num_filter), make)
+
+	def adjusted(self, key):
+		"""Returns the (g, s) maps the thresholds and the plot use for the coordinates key, where the g coordinates
+		of 0 are moved to -0.1 once the filters were applied"""
+		harmonic, num_filter, move_zeros = key
+
+		def adjust():
+			x, y = self.filtered(harmonic, num_filter)
+			if move_zeros and (x == 0).any():
+				x = np.where(x == 0, x.dtype.type(-0.1), x)
+			return x, y
+		return self.maps.get(('adjusted',) + key, adjust)
+
+	def derived(self, name, key):
+		"""Returns the map name, 'angle', 'distance' or 'bins' (of the phasor plot), of the coordinates key"""
+		def make():
+			x, y = self.adjusted(key)
+			if name == 'angle':
+				return y / x
+			if name == 'distance':
+				return np.sqrt(y ** 2 + x ** 2)
+			return PhasorPlot.histogram_bins(x, y)
+		return self.maps.get((name,) + key, make)
+
+	def fraction_map(self, harmonic, point):
+		"""Returns the distance of the unfiltered coordinates of harmonic from the point (g, s)"""
+		def make():
+			x, y = self.filtered(harmonic, 0)
+			return np.sqrt((y - point[1]) ** 2 + (x - point[0]) ** 2)
+		return self.maps.get(('fraction', harmonic) + tuple(point), make)
+
+	def unmixing_maps(self, key, components):
+		"""Returns the (n, Y, X) fractions of the species at components of the coordinates key, see Unmixing"""
+		return self.maps.get(('unmixing', components) + key,
+							 lambda: Unmixing.fractions(*self.adjusted(key), components))
+
+	def unmixing_map(self, key, components, index):
+		return self.unmixing_maps(key, components)[index]
+
+	def cluster_labels(self, key, clusters):
+		"""Returns the label of the cluster of every pixel of the coordinates key, 0 outside of the phasor plot"""
+		return self.maps.get(('clusters', clusters) + key,
+							 lambda: clusters.labels[self.derived('bins', key)])
+
+	@property
+	def cluster_label(self):
+		"""Returns the labels of the clusters of the pixels, or None without clusters"""
+		if self.clusters is None:
+			return None
+		return self.cluster_labels(self.coordinates_key, self.clusters)
+
+	@property
+	def x_adjusted(self):
+		return self.adjusted(self.coordinates_key)[0]
+
+	@property
+	def y_adjusted(self):
+		return self.adjusted(self.coordinates_key)[1]
+
+	@property
+	def angle_arr(self):
+		return self.derived('angle', self.coordinates_key)
+
+	@property
+	def distance_arr(self):
+		return self.derived('distance', self.coordinates_key)
+
+	@property
+	def fraction_arr(self):
+		return self.fraction_map(self.coordinates_key[0], self.fraction_point)
+
+	def coordinates_changed(self):
+		"""Points the masks at the maps of the coordinates key, after the filters or the harmonic changed. The
+		masks only make the maps when their ranges are set"""
+		key = self.coordinates_key
+		self.masks.set_values('angle', partial(self.derived, 'angle', key))
+		self.masks.set_values('circle', partial(self.derived, 'distance', key))
+		self.masks.set_values('fraction', partial(self.fraction_map, key[0], self.fraction_point))
+		for index in range(len(self.unmixing_components)):
+			self.masks.set_values(f'unmixing{index}', partial(self.unmixing_map, key, self.unmixing_components, index))
+		self.masks.set_mask('negative', self.x_adjusted < 0)
+		self.thresholded_cache = None
+		self.histogram_cache = None
+
+	def colormaps(self, mask):
+		"""applies the colormap selected to the image. The values are quantized straight into the lookup table of the
+		colormap, and written into the preallocated display image along with the cursor circles and the black pixels
+		of mask"""
+		self.colormap_scale(mask)
+		if self.displayImage is None:
+			self.compress_image(self.original_image)
+		self.colour_region(np.s_[:, :], mask, self.displayImage, self.colormap_values, self.colormap_index)
+
+	def colormap_source(self, index, out):
+		"""Writes the values which the selected colormap colours, of the pixels index of the image, into out"""
+		if self.color_map_select in (0, 3):
+			out[...] = self.original_image[index]
+		elif self.color_map_select == 1:
+			np.maximum(self.distance_arr[index], 0, out=out)
+		elif self.color_map_select == 2:
+			np.maximum(self.angle_arr[index], 0, out=out)
+			np.nan_to_num(out, copy=False)
+		elif self.color_map_select == 4:
+			np.maximum(self.fraction_arr[index], 0, out=out)
+		return out
+
+	def colormap_scale(self, mask):
+		"""Finds the range the selected colormap is scaled to, which depends on every pixel outside of mask, and keeps
+		the (offset, factor, lookup table) which colour_region scales the values with. The range is None if every
+		pixel is masked"""
+		unmasked = not mask.all()
+		self.colormap_range = None
+		#Greyscale Intensity colourmap
+		if self.color_map_select == 0:
+			if unmasked:
+				im_min = np.min(self.original_image, where=~mask, initial=self.max)
+				im_max = np.max(self.original_image, where=~mask, initial=self.min)
+				self.colormap_range = im_min, (1 / (im_max - im_min) * 255), GREY_LUT
+
+		#TauM colourmap
+		elif self.color_map_select == 1:
+			if unmasked:
+				self.image_min_M = np.maximum(np.min(self.distance_arr, where=~mask, initial=np.inf), 0)
+				self.image_max_M = np.maximum(np.max(self.distance_arr, where=~mask, initial=-np.inf), 0)
+				self.colormap_range = (self.applied_min_M/100, (1 / (self.applied_max_M/100 - self.applied_min_M/100)),
+									   colormap_lut('jet_r', 20))
+			else:
+				self.image_min_M, self.image_max_M = 0.0, 0.0
+
+		# TauP colourmap
+		elif self.color_map_select == 2:
+			if unmasked:
+				self.image_min_ang = np.tan(np.deg2rad(self.applied_min_ang))
+				self.image_max_ang = np.tan(np.deg2rad(self.applied_max_ang))
+				self.colormap_range = (self.image_min_ang, (1 / (self.image_max_ang - self.image_min_ang)),
+									   colormap_lut('jet', 20))
+			else:
+				values = self.colormap_source(np.s_[:, :], np.empty(mask.shape))
+				self.image_min_ang = np.min(values)
+				self.image_max_ang = np.max(values)
+
+		#Jet instensity colourmap
+		elif self.color_map_select == 3:
+			if unmasked:
+				im_min = np.min(self.original_image, where=~mask, initial=self.max)
+				im_max = np.max(self.original_image, where=~mask, initial=self.min)
+				self.colormap_range = im_min, (1 / (im_max - im_min)), colormap_lut('jet', 20)
+
+		# Fraction Bound colourmap.
+		elif self.color_map_select == 4:
+			if unmasked:
+				self.colormap_range = (self.fraction_min, (1 / (self.fraction_max - self.fraction_min)),
+									   colormap_lut('jet', 20))
+			else:
+				values = self.colormap_source(np.s_[:, :], np.empty(mask.shape))
+				self.fraction_min = np.min(values)
+				self.fraction_max = np.max(values)
+
+	def colour_region(self, index, mask, out=None, values=None, colormap_index=None):
+		"""Writes the colours of the pixels index of the image, e.g. a part of it or every other pixel, into the RGB
+		array out, with the range found by colormap_scale. Only these pixels are read, so a part of the image is
+		coloured without the rest. Values outside the range get the end colours and nan is black, the same as the
+		matplotlib colormaps. The circle colours and the black of the pixels in mask are written in the same pass.
+		If every pixel is masked the image is just black. values and colormap_index are the buffers used, which are
+		allocated if not given"""
+		mask = mask[index]
+		if out is None:
+			out = np.empty(mask.shape + (3,), dtype=np.uint8)
+		if self.colormap_range is None:
+			out[...] = 0
+			return out
+		offset, factor, lut = self.colormap_range
+		if values is None:
+			values = np.empty(mask.shape)
+		if colormap_index is None:
+			colormap_index = np.empty(mask.shape, dtype=np.int32)
+		self.colormap_source(index, values)
+		values -= offset
+		values *= factor
+		bins = len(lut) - len(OVERLAY_COLOURS)
+		if lut is not GREY_LUT:
+			values *= bins
+		np.clip(values, 0, bins - 1, out=values)
+		np.copyto(values, bins, where=np.isnan(values))
+		np.copyto(colormap_index, values, casting='unsafe')
+		if self.clusters is not None:
+			cluster_label = self.cluster_label[index]
+			np.add(cluster_label, bins + len(CIRCLE_COLOURS), out=colormap_index, where=cluster_label > 0,
+				   dtype=colormap_index.dtype)
+		circle_label = self.circle_label[index]
+		np.add(circle_label, bins, out=colormap_index, where=circle_label > 0, dtype=colormap_index.dtype)
+		np.copyto(colormap_index, bins, where=mask)
+		np.take(lut, colormap_index, axis=0, out=out, mode='clip')
+		return out
+
+	def compress_image(self, im):
+		"""Converts the image to be normalized and in the proper format to be displayed. The display image and the
+		buffers used to colour it are allocated here the first time colormaps is called, and reused after that"""
+		im = ((im - self.min) * (1 / (self.max - self.min) * 255)).astype('uint8')
+		im = np.stack((im,) * 3, axis=-1)
+		self.displayImage = im
+		self.colormap_values = np.empty(im.shape[:2])
+		self.colormap_index = np.empty(im.shape[:2], dtype=np.int32)
+
+	def set_circles(self, circle_coors, radii):
+		"""Selects the pixels that fall inside the four cursor circles placed on the plot"""
+		self.circle_coors = np.asarray(circle_coors, dtype=float).copy()
+		self.circle_radius = list(radii)
+		self.circle_label[...] = 0
+		for i in range(4):
+			inside = (self.circle_coors[i, 0] - self.xcoor_map) ** 2 + \
+				(self.circle_coors[i, 1] - self.ycoor_map) ** 2 < self.circle_radius[i] ** 2
+			self.circle_label[inside] = i + 1
+
+	def clear_circles(self):
+		"""Moves the circles far outside the plot and removes them from the colormap"""
+		self.circle_coors[:] = -3.0
+		self.circle_label[...] = 0
+
+	def update_circle_range(self, min, max):
+		"""Updates the mask based on the TauM modulation thresholds"""
+		self.applied_min_M, self.applied_max_M = min, max
+		self.masks.set_range('circle', min / 100, max / 100)
+
+	def update_fraction_range(self, min, max):
+		"""Updates the mask based on the fraction bound thresholds"""
+		self.fraction_min = min / 100
+		self.fraction_max = max / 100
+		self.masks.set_range('fraction', min / 100, max / 100)
+
+	def update_angle_range(self, min, max):
+		"""Updates the mask based on the TauP angle thresholds"""
+		self.applied_min_ang, self.applied_max_ang = min, max
+		min = np.tan(np.deg2rad(min))
+		max = np.tan(np.deg2rad(max))
+		self.masks.set_range('angle', min, max)
+
+	def update_threshold(self, min, max):
+		"""Creates an intensity mask based on the threshold by the user through min and max"""
+		self.min_thresh = min
+		self.max_thresh = max
+		self.masks.set_range('intensity', min, max)
+
+	def set_unmixing(self, components):
+		"""Unmixes every pixel into the fractions of the 2 or 3 species at components, a sequence of their (g, s)
+		coordinates, e.g. of free and bound NADH. An empty sequence stops the unmixing. The fraction of each species
+		is a component of the mask, which masks nothing until its range is set with update_unmixing_range. Raises a
+		ValueError if the species can't be told apart"""
+		components = tuple((float(g), float(s)) for g, s in components)
+		if components:
+			Unmixing.coefficients(components)
+		for index in range(len(components), len(self.unmixing_components)):
+			self.masks.remove(f'unmixing{index}')
+		self.unmixing_components = components
+		self.unmixing_ranges = (self.unmixing_ranges + ((-np.inf, np.inf),) * 3)[:len(components)]
+		self.coordinates_changed()
+		for index, (min, max) in enumerate(self.unmixing_ranges):
+			self.masks.set_range(f'unmixing{index}', min, max)
+
+	def update_unmixing_range(self, index, min, max):
+		"""Masks the pixels whose fraction of the species index is outside of [min, max], as fractions of 1"""
+		ranges = list(self.unmixing_ranges)
+		ranges[index] = (min, max)
+		self.unmixing_ranges = tuple(ranges)
+		self.masks.set_range(f'unmixing{index}', min, max)
+
+	def cluster(self, k, method='kmeans', seed=0):
+		"""Fits k clusters to the phasor plot with method, 'kmeans' or 'gmm' (a Gaussian mixture), and colours the
+		pixels of each cluster over the image, under the cursor circles. The fit is made on the histogram of the plot,
+		so it takes the same time for any size of image. The clusters are kept when the filters or thresholds change,
+		and the pixels are labelled again from their new bins. k of 0 removes the clusters"""
+		if k == 0:
+			self.clusters = None
+			return
+		if k > len(CLUSTER_COLOURS):
+			raise ValueError(f'At most {len(CLUSTER_COLOURS)} clusters can be shown')
+		self.clusters = Clustering.fit(self.phasor_histogram(), k, method, seed)
+
+	def cluster_statistics(self, mask):
+		"""Returns a list of a dictionary for each cluster of the centre of the cluster, the number of its pixels
+		outside of mask, their fraction of those pixels, their mean intensity, g and s, and the TauP and TauM of
+		their mean phasor. The means and lifetimes of a cluster without any pixels outside of mask are None"""
+		if self.clusters is None:
+			return []
+		inside = ~mask
+		labels = self.cluster_label[inside]
+		k = len(self.clusters)
+		omega = self.get_omega()
+		pixels = np.bincount(labels, minlength=k + 1)
+		# the lifetimes of the mean phasor of each cluster
+		sums = {name: np.bincount(labels, values[inside].astype(float), minlength=k + 1)
+				for name, values in [('intensity', self.original_image), ('g', self.x_adjusted), ('s', self.y_adjusted)]}
+		statistics = []
+		for label in range(1, k + 1):
+			row = {'cluster': label, 'centre g': self.clusters.centres[label - 1, 0],
+				   'centre s': self.clusters.centres[label - 1, 1], 'pixels': int(pixels[label]),
+				   'fraction': pixels[label] / max(inside.sum(), 1), 'mean intensity': None, 'mean g': None,
+				   'mean s': None, 'TauP (ns)': None, 'TauM (ns)': None}
+			if pixels[label]:
+				g, s = sums['g'][label] / pixels[label], sums['s'][label] / pixels[label]
+				row.update({'mean intensity': sums['intensity'][label] / pixels[label], 'mean g': g, 'mean s': s,
+							'TauP (ns)': s / g / omega, 'TauM (ns)': np.sqrt(1 / (g ** 2 + s ** 2) - 1) / omega})
+			statistics.append(row)
+		return statistics
+
+	def save_cluster_statistics(self, mask, file_name):
+		"""Writes the cluster_statistics of mask as a comma separated table, where the values which are None are left
+		empty"""
+		statistics = self.cluster_statistics(mask)
+		with open(file_name, 'w') as f:
+			f.write(','.join(statistics[0]) + '\n')
+			for row in statistics:
+				f.write(','.join('' if value is None else f'{value:.6g}' for value in row.values()) + '\n')
+
+	def thresholded_coordinates(self):
+		"""Returns the filtered g and s coordinates of the pixels inside the intensity thresholds, which are the ones
+		shown on the phasor plot. They are only extracted again when the thresholds or the filtered data changed"""
+		version = self.masks.version('intensity')
+		if self.thresholded_cache is None or self.thresholded_cache[0] != version:
+			inside = ~self.masks['intensity']
+			self.thresholded_cache = version, self.x_adjusted[inside], self.y_adjusted[inside]
+		return self.thresholded_cache[1:]
+
+	def phasor_histogram(self):
+		"""Returns the histogram of the phasor plot, of the pixels inside the intensity thresholds. The plot bin of
+		every pixel is found once for each harmonic and number of filters, and the histogram is only counted again
+		when the intensity thresholds change. The histogram is shared, so it must not be modified"""
+		version = self.masks.version('intensity')
+		if self.histogram_cache is None or self.histogram_cache[0] != version:
+			plot_bins = self.derived('bins', self.coordinates_key)
+			with Instrumentation.span('dataset/histogram'):
+				histogram = PhasorPlot.bin_histogram(plot_bins[~self.masks['intensity']])
+			histogram.setflags(write=False)
+			self.histogram_cache = version, histogram
+		return self.histogram_cache[1]
+
+	def get_mask(self):
+		"""Returns the pixels which are outside of any of the thresholds. This is a read only view of the mask, which
+		is kept up to date by the thresholds"""
+		return self.masks.mask
+
+	def apply_masks(self):
+		"""Colours the display image and sets parts of the image outside the thresholds on the plot to black"""
+		mask = self.get_mask()
+		self.colormaps(mask)
+		return mask
+
+	def set_colormap(self, val):
+		"""Changes the colormap to the value val. 0=densitymap, 1=TauM, 2=TauP, 3=densitymap, 4=fractionBound.
+		Selecting the densitymap switches between the greyscale and the jet intensity maps"""
+		if val == 0 and self.color_map_select == 0:
+			self.color_map_select = 3
+		elif val == 0 and self.color_map_select != 3:
+			self.color_map_select = 3
+		else:
+			self.color_map_select = val
+
+	def scaled(self, color_map_select):
+		"""Returns a shallow copy of the dataset with the colormap color_map_select selected and its range found, which
+		leaves this one as it was"""
+		data = copy.copy(self)
+		data.color_map_select = color_map_select
+		data.colormap_scale(self.get_mask())
+		return data
+
+	def render(self, color_map_select):
+		"""Returns the image coloured with the colormap color_map_select, without changing the selected colormap or
+		the display image, so that the colormaps can be rendered at the same time"""
+		mask = self.get_mask()
+		return self.scaled(color_map_select).colour_region(np.s_[:, :], mask)
+
+	def snapshot(self):
+		"""Returns a copy of the dataset as it is now, which isn't changed by the changes made to this one, e.g. to
+		export it in another thread. The arrays which are only ever replaced are shared, the rest are copied"""
+		self.phasor_histogram()
+		data = copy.copy(self)
+		data.masks = self.masks.copy()
+		data.circle_label = self.circle_label.copy()
+		data.circle_coors = self.circle_coors.copy()
+		data.circle_radius = list(self.circle_radius)
+		data.displayImage = None
+		return data
+
+	def get_image_params(self):
+		"""Returns image parameters"""
+		return self.name, self.original_image.shape
+
+	def memory_usage(self):
+		"""Returns a dictionary of attribute: bytes of the arrays held by the dataset, including its derived maps and
+		masks"""
+		return Instrumentation.array_memory(self)
+
+	def compact(self):
+		"""Drops everything which is made again when it's needed: the derived maps, the sorted values of the masks,
+		the buffers of the colormaps and the cumulative sums of gating. Used while the dataset isn't being changed,
+		e.g. when its image isn't selected"""
+		self.disable_gating()
+		self.maps.clear()
+		self.masks.compact()
+		self.thresholded_cache = None
+		self.displayImage = None
+		self.colormap_values = None
+		self.colormap_index = None
+
+	def perform_fft(self, image):
+		"""Performs fft on the image data to get the g and s coordinates. see https://doi.org/10.1073/pnas.1108161108"""
+		kernel = PhasorTransform.phasor_kernel(image.shape[0], self.bin_width, self.freq, (self.harmonic,))
+		g, s = self.calibrate_sums(PhasorTransform.phasor_sums(image, kernel))
+		return g[0].flatten(), s[0].flatten()
+
+	def calibrate_sums(self, sums):
+		"""Converts the intensity, cos and sin sums of the transform into the calibrated (n_harmonics, Y, X) g and s
+		coordinates"""
+		g, s = PhasorTransform.sums_to_coordinates(sums)
+		return PhasorTransform.calibrate(g, s, self.phi_cal, self.m_cal)
+
+	def select_harmonic(self, harmonic):
+		"""Points g, s and the coordinate maps at the already calculated coordinates of harmonic"""
+		idx = self.harmonics.index(float(harmonic))
+		self.harmonic = float(harmonic)
+		self.xcoor_map = self.g_harmonics[idx]
+		self.ycoor_map = self.s_harmonics[idx]
+		self.g = self.xcoor_map.reshape(-1)
+		self.s = self.ycoor_map.reshape(-1)
+
+	def set_harmonic(self, harmonic):
+		"""Switches the data to another harmonic, and reapplies the filters and thresholds to it. Harmonics which
+		weren't calculated when the stack was read are added by reading the file again"""
+		harmonic = float(harmonic)
+		if harmonic not in self.harmonics:
+			intensity, g, s = self.read_coordinates((harmonic,))
+			g, s = self.calibrate_coordinates(g, s)
+			# the harmonic is only recorded once its planes are read, so a failed read leaves the dataset as it was
+			g_harmonics = np.concatenate([self.g_harmonics, g])
+			s_harmonics = np.concatenate([self.s_harmonics, s])
+			self.harmonics = self.harmonics + (harmonic,)
+			self.g_harmonics, self.s_harmonics = g_harmonics, s_harmonics
+		self.select_harmonic(harmonic)
+		self.reapply()
+
+	def set_gate(self, start, stop=None):
+		"""Sums only the time bins [start, stop) of the decays, e.g. to leave out the rise of the IRF or the background
+		of the last bins, where a stop of None is the end of the stack. The intensity and the coordinates of every
+		harmonic are found again, and the filters and thresholds are reapplied to them. With gating this only
+		subtracts two planes of the cumulative sums, and otherwise the stack is read again"""
+		gate = self.resolve_gate((start, stop))
+		if gate == self.gate:
+			return
+		self.gate = gate
+		self.reload()
+
+	def set_binning(self, radius, shape='square'):
+		"""Sums the decays of the (2 * radius + 1) square, or the circle of radius, around every pixel before the g
+		and s coordinates are found, e.g. radius 1 for 3x3 binning of images with few photons, or 0 to stop binning.
+		The sums of the transform are binned rather than the stack, so only the coordinates are read again, from the
+		cache or the cumulative sums of gating when they are there. The filters and thresholds are reapplied"""
+		if shape not in PhasorTransform.BINNING_SHAPES:
+			raise ValueError(f'The binning shape must be one of {", ".join(PhasorTransform.BINNING_SHAPES)}')
+		radius = max(int(radius), 0)
+		if (radius, shape) == (self.binning, self.binning_shape):
+			return
+		self.binning, self.binning_shape = radius, shape
+		self.reload()
+
+	def reload(self):
+		"""Finds the intensity and the coordinates of every harmonic again, after the gate or the binning changed,
+		and reapplies the filters and thresholds to them"""
+		intensity, g, s = self.read_coordinates(self.harmonics)
+		self.set_intensity(intensity)
+		self.g_harmonics, self.s_harmonics = self.calibrate_coordinates(g, s)
+		del g, s
+		# the maps of the old coordinates are left to the snapshots which share the store
+		self.maps = MapStore(self.maps.budget)
+		self.displayImage = None
+		self.masks.set_values('intensity', self.original_image)
+		self.update_threshold(self.min_thresh, self.max_thresh)
+		self.select_harmonic(self.harmonic)
+		self.reapply()
+
+	def enable_gating(self, progress=None):
+		"""Keeps the cumulative sums of the stack over the time bins, so that the gate can be changed without reading
+		the stack again. This reads the stack once, and holds (T + 1) * (1 + 2 * n_harmonics) doubles per pixel"""
+		if self.cumulative is None:
+			self.cumulative = PhasorTransform.read_cumulative_sums(self.filename, self.bin_width, self.freq,
+																   self.harmonics, progress)
+
+	def disable_gating(self):
+		"""Drops the cumulative sums, keeping the gate as it is"""
+		self.cumulative = None
+
+	def reapply(self):
+		"""Applies the filters, the thresholds and the cursor circles again, after the coordinates changed"""
+		self.convolution(self.num_filter)
+		self.update_angle_range(self.applied_min_ang, self.applied_max_ang)
+		self.update_circle_range(self.applied_min_M, self.applied_max_M)
+		self.update_fraction_range(self.fraction_min * 100, self.fraction_max * 100)
+		for index, (min, max) in enumerate(self.unmixing_ranges):
+			self.update_unmixing_range(index, min, max)
+		self.set_circles(self.circle_coors, self.circle_radius)
+
+	def fraction_lifetime_map(self, lifetime):
+		"""Creates the mapping of the coordinates in the plot based on their distance from the lifetime of the
+		fluorophore entered by the user. For example, 0.4ns for NADH."""
+		omega = 2 * np.pi * self.freq / 1000 * self.harmonic
+		self.fraction_coor_map(1 / (1 + np.power(omega * lifetime, 2)),
+							   omega * lifetime / (1 + np.power(omega * lifetime, 2)))
+		return self.x_fraction, self.y_fraction
+
+	def fraction_coor_map(self, x_coor, y_coor):
+		"""Creates the mapping of the coordinates in the plot based on their distance from the coordinates entered
+		by the user"""
+		self.x_fraction = x_coor
+		self.y_fraction = y_coor
+		self.fraction_point = (float(x_coor), float(y_coor))
+		self.masks.set_values('fraction', partial(self.fraction_map, self.coordinates_key[0], self.fraction_point))
+
+	def set_fraction_coordinates(self, x_coor, y_coor):
+		self.x_fraction = x_coor
+		self.y_fraction = y_coor
+
+	def get_phasor_lifetime_coordinates(self):
+		"""Gets the coordinates for the points along the universal circles, which are used a reference when looking
+		at the plots"""
+		points = np.asarray([0.5, 1, 2, 3, 4, 8])
+		omega = 2 * np.pi * self.freq / 1000 * self.harmonic
+		x_coors = 1 / (1 + np.power(omega * points, 2))
+		y_coors = omega * points / (1 + np.power(omega * points, 2))
+		return x_coors, y_coors
+
+	def convolution(self, num_filter):
+		"""Applies a 3x3 convolutional median filter to the graph data num_filter times. See:
+		https://doi.org/10.1038/s41596-018-0026-5. The result of every number of filters is kept while it fits in the
+		memory budget of the maps, so that adding a filter only runs one more pass, and going back to fewer filters
+		runs none"""
+		self.num_filter = num_filter
+		self.coordinates_key = (self.harmonic, max(num_filter, 0), True)
+		self.fraction_point = (float(self.x_fraction), float(self.y_fraction))
+		# the masks keep their state until their ranges are applied to the new values
+		self.coordinates_changed()
+
+	def get_omega(self):
+		"""Returns the angular frequency of the harmonic in rad/ns"""
+		return 2 * np.pi * self.freq / 1000 * self.harmonic
+
+	def lifetime_maps(self, mask):
+		"""Returns the g, s, TauP, TauM and distance maps, where the pixels in mask are set to nan"""
+		omega = self.get_omega()
+		# the maps are saved in double precision, whichever precision the coordinates are kept in
+		g = self.x_adjusted.astype(float)
+		g[mask] = float("nan")
+		s = self.y_adjusted.astype(float)
+		s[mask] = float("nan")
+		tau_p = 1 / omega * self.angle_arr.astype(float)
+		tau_p[mask] = float("nan")
+		tau_m = 1 / omega * np.sqrt(1 / np.power(self.distance_arr.astype(float), 2) - 1)
+		tau_m[mask] = float("nan")
+		frac = self.fraction_arr.astype(float)
+		frac[mask] = float("nan")
+		return g, s, tau_p, tau_m, frac
+
+	def species_maps(self, mask):
+		"""Returns the list of the maps of the fractions of the unmixed species, where the pixels in mask are set to
+		nan"""
+		if not self.unmixing_components:
+			return []
+		maps = self.unmixing_maps(self.coordinates_key, self.unmixing_components).astype(float)
+		maps[:, mask] = float("nan")
+		return list(maps)
+
+	def get_save_params(self, mask, maps=None):
+		"""Returns the lines of the parameters file, with all the parameters used to create the data. maps are the
+		lifetime_maps of mask, if they were made already"""
+		omega = self.get_omega()
+		g, s, tau_p, tau_m, frac = self.lifetime_maps(mask) if maps is None else maps
+		x_avg = np.average(g[~mask])
+		y_avg = np.average(s[~mask])
+		gate = [] if self.gate is None else [f'Time Gate (bins): {self.gate[0]} - {self.gate[1]}\n']
+		if self.binning > 0:
+			gate.append(f'Binning: {2 * self.binning + 1}x{2 * self.binning + 1} {self.binning_shape}\n')
+		return gate + [f'number Of 3x3 Median Filters: {self.num_filter}\n',
+				f'Intensity Min: {self.min_thresh:.3f}\n',
+				f'Intensity Max: {self.max_thresh:.3f}\n',
+				f'Phi Min (Deg, ns): ({self.applied_min_ang:.3f}, {1 / omega * np.tan(np.deg2rad(self.applied_min_ang)):.3f}) \n',
+				f'Phi Max (Deg, ns): ({self.applied_max_ang:.3f}, {1 / omega * np.tan(np.deg2rad(self.applied_max_ang)):.3f})\n',
+				f'Modulation Min (M, ns): ({self.applied_min_M/100:.3f}, {1 / omega * np.sqrt(1 / np.power(self.applied_min_M/100, 2) - 1):.3f})\n',
+				f'Modulation Max (M, ns): ({self.applied_max_M/100:.3f}, {1 / omega * np.sqrt(1 / np.power(self.applied_max_M/100, 2) - 1):.3f})\n',
+				f'Distance From Coordinates (g,s): {self.x_fraction:.3f}, {self.y_fraction:.3f}\n',
+				f'Distance Min: {self.fraction_min:.3f}\n',
+				f'Distance Max: {self.fraction_max:.3f}\n\n\n',
+				f'Average g Coordinate: {x_avg:.3f}\n',
+				f'Average s Coordinate: {y_avg:.3f}\n',
+				f'Average TauP (ns): {np.nanmean(tau_p):.3f}\n',
+				f'Average TauM (ns): {np.nanmean(tau_m):.3f}\n',
+				f'Average distance: {np.nanmean(frac):.3f}\n'] + self.unmixing_params(mask) + self.cluster_params(mask)
+
+	def cluster_params(self, mask):
+		"""Returns the lines of the parameters file of the clusters"""
+		lines = [] if self.clusters is None else [f'Clusters: {len(self.clusters)} ({self.clusters.method})\n']
+		for row in self.cluster_statistics(mask):
+			line = (f"Cluster {row['cluster']} (g,s): {row['centre g']:.3f}, {row['centre s']:.3f}, "
+					f"Pixels: {row['pixels']}")
+			if row['pixels']:
+				line += f", Mean TauP (ns): {row['TauP (ns)']:.3f}, Mean TauM (ns): {row['TauM (ns)']:.3f}"
+			lines.append(line + '\n')
+		return lines
+
+	def unmixing_params(self, mask):
+		"""Returns the lines of the parameters file of the unmixed species"""
+		lines = []
+		for index, (species, (min, max), fraction) in enumerate(zip(self.unmixing_components, self.unmixing_ranges,
+																	 self.species_maps(mask)), 1):
+			lines += [f'Species {index} (g,s): {species[0]:.3f}, {species[1]:.3f}\n',
+					  f'Species {index} Fraction Min: {min:.3f}\n',
+					  f'Species {index} Fraction Max: {max:.3f}\n',
+					  f'Average Species {index} Fraction: {np.nanmean(fraction):.3f}\n']
+		return lines
+
+	def export_tasks(self, file, save_type='all', colormap=None, name=None, harmonics=False):
+		"""Returns the (path, function) of every file saved by save_data, where function() renders and writes the file.
+		The functions only read the dataset, so they can run at the same time in any order, see ExportPipeline. With
+		harmonics, the maps of the other harmonics which were read are saved too, see harmonic_maps"""
+		if colormap is None:
+			colormap = self.color_map_select
+		path = file + '/' + (self.name if name is None else name)
+		tasks = []
+		for val in [0, 1, 2, 3, 4]:
+			if save_type == 'all' or (save_type == 'current' and colormap == val):
+				file_name = path + '_image_' + COLORMAP_NAMES[val] + '.tif'
+				tasks.append((file_name, partial(self.save_image, val, file_name)))
+
+		# the maps are shared by their files and the parameters
+		mask = self.get_mask()
+		maps = ExportPipeline.once(lambda: self.lifetime_maps(mask))
+		for idx, suffix, val in [(0, '_g.tiff', None), (1, '_s.tiff', None), (2, '_TauP.tiff', 2), (3, '_TauM.tiff', 1),
+								 (4, '_Dist.tiff', 4)]:
+			if val is None or save_type == 'all' or (save_type == 'current' and colormap == val):
+				tasks.append((path + suffix, partial(self.save_map, maps, idx, path + suffix)))
+		species = ExportPipeline.once(lambda: self.species_maps(mask))
+		for idx in range(len(self.unmixing_components)):
+			file_name = path + f'_Species{idx + 1}.tiff'
+			tasks.append((file_name, partial(self.save_map, species, idx, file_name)))
+		if self.clusters is not None:
+			file_name = path + '_Clusters.tiff'
+			tasks.append((file_name, partial(tifffile.imwrite, file_name, self.cluster_label)))
+			file_name = path + '_Clusters.csv'
+			tasks.append((file_name, partial(self.save_cluster_statistics, mask, file_name)))
+
+		if harmonics:
+			for harmonic in self.harmonics:
+				if harmonic == self.harmonic:
+					continue
+				harmonic_maps = ExportPipeline.once(partial(self.harmonic_maps, harmonic, mask))
+				for idx, map_name in enumerate(['g', 's', 'TauP', 'TauM']):
+					file_name = path + f'_h{harmonic:g}_{map_name}.tiff'
+					tasks.append((file_name, partial(self.save_map, harmonic_maps, idx, file_name)))
+
+		tasks.append((path + '_Parameters.txt', partial(self.save_params, mask, maps, path + '_Parameters.txt')))
+		return tasks
+
+	def harmonic_maps(self, harmonic, mask):
+		"""Returns the g, s, TauP and TauM maps of harmonic, one of the harmonics which were read, with the filters
+		of the selected harmonic and the pixels in mask set to nan"""
+		omega = 2 * np.pi * self.freq / 1000 * harmonic
+		g, s = (c.astype(float) for c in self.adjusted((harmonic,) + self.coordinates_key[1:]))
+		tau_p = s / g / omega
+		tau_m = np.sqrt(1 / (g ** 2 + s ** 2) - 1) / omega
+		maps = g, s, tau_p, tau_m
+		for values in maps:
+			values[mask] = float("nan")
+		return maps
+
+	def container_layers(self):
+		"""Returns the (name, array) layers which are written into a container instead of the files of save_data: the
+		intensity, the mask of the pixels outside of the thresholds, the g, s and lifetime maps and the histogram of
+		the phasor plot, along with the text of the parameters file. The fractions of the unmixed species are the
+		layers species1, species2... and the labels of the clusters the layer clusters"""
+		mask = self.get_mask()
+		maps = self.lifetime_maps(mask)
+		layers = [('intensity', self.original_image), ('mask', mask.astype(np.uint8))]
+		layers += list(zip(['g', 's', 'TauP', 'TauM', 'Dist'], maps))
+		layers += [(f'species{index}', fraction) for index, fraction in enumerate(self.species_maps(mask), 1)]
+		if self.clusters is not None:
+			layers.append(('clusters', self.cluster_label))
+		layers.append(('histogram', self.phasor_histogram()))
+		return layers, ''.join(self.get_save_params(mask, maps))
+
+	def save_image(self, color_map_select, file_name):
+		Image.fromarray(self.render(color_map_select)).save(file_name)
+
+	def save_map(self, maps, idx, file_name):
+		tifffile.imwrite(file_name, maps()[idx])
+
+	def save_params(self, mask, maps, file_name):
+		with open(file_name, 'w') as f:
+			f.writelines(self.get_save_params(mask, maps()))
+
+	def save_data(self, file, save_type='all', colormap=None, name=None, harmonics=False):
+		"""Saves all the images of the various colormaps, the g and s coordinates, and a file that contains all the
+		parameters used to create the data. With save_type 'current' only the data of colormap (by default the one
+		selected) is saved, and with harmonics the maps of the other harmonics too. The files are written at the same
+		time by the writer threads of ExportPipeline. The phasor plots are saved by PhasorPlot, see
+		ExportPipeline.export to save both"""
+		ExportPipeline.run_tasks(self.export_tasks(file, save_type, colormap, name, harmonics))
@@ -0,0 +1,440 @@
+# Draws the phasor plot of the data, including the colormaps and the ranges specified by the user, on a matplotlib
+# axes. The Graph window draws it on its canvas, and it can be drawn on its own figure to save the plots without any
+# Qt windows.
+
+#imports
+from functools import partial
+import numpy as np
+import matplotlib
+import matplotlib.patches as patches
+from matplotlib.image import NonUniformImage
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# The data is plotted as a BINS x BINS histogram over the g and s ranges of the plot
+BINS = 150
+G_RANGE = (0, 1)
+S_RANGE = (0, 0.6)
+# (colormap, name, colormaps it is saved with) of each of the saved plots. The density plot is shared by the greyscale
+# and jet intensity colormaps
+PLOT_COLORMAPS = [(0, 'density', [0, 3]), (1, 'TauM', [1]), (2, 'TauP', [2]), (4, 'Distance', [4])]
+
+
+def histogram_bins(x, y):
+	"""Returns the flat index of the histogram bin of each of the x, y points, with BINS * BINS for the points outside
+	of the plot. The bins are the same as np.histogram2d(x, y, BINS, [G_RANGE, S_RANGE]), so the histogram of any
+	subset of the points can be counted from these indices without binning the points again"""
+	indices = []
+	for values, (low, high) in [(x, G_RANGE), (y, S_RANGE)]:
+		edges = np.linspace(low, high, BINS + 1)
+		index = np.searchsorted(edges, values, side='right').astype(np.int32)
+		# values on the last edge are in the last bin, as in histogram2d
+		index[values == edges[-1]] -= 1
+		indices.append(index - 1)
+	ix, iy = indices
+	bins = ix * BINS + iy
+	bins[(ix < 0) | (ix >= BINS) | (iy < 0) | (iy >= BINS)] = BINS * BINS
+	return bins
+
+
+def bin_histogram(bins):
+	"""Returns the (BINS, BINS) float histogram of the points in the flat bin indices bins"""
+	counts = np.bincount(bins.reshape(-1), minlength=BINS * BINS + 1)
+	return counts[:BINS * BINS].reshape(BINS, BINS).astype(float)
+
+
+class PhasorPlot:
+	"""Draws the phasor plot on the axes given to setup_plot, based on the thresholding parameters that the user
+	enters. With blit, the data and the universal circle are drawn once into a background which is kept by the
+	canvas, and moving the circles or the range lines only draws those artists over it"""
+
+	def setup_plot(self, ax, MHz, blit=False):
+		"""Draws the universal circle, the range lines and the selection circles on the axes ax"""
+		self.ax = ax
+		self.blit = blit
+		self.background = None
+		self.saving = False
+
+		x = np.linspace(0, 1, 1000)
+		y = np.sqrt(0.5 * 0.5 - (x - 0.5) * (x - 0.5))
+		self.ax.set_xlim([0, 1])
+		self.ax.set_ylim([0, 0.6])
+		self.ax.plot(x, y, 'r')
+		self.ax.set_xlabel('g', fontsize=12, weight='bold')
+		self.ax.set_ylabel('s', fontsize=12, weight='bold')
+
+		self.MHz_text = self.ax.text(0.8, 0.55, '', fontsize=12)
+		self.set_frequency(MHz)
+		self.lifetime_artists = []
+
+		# load the range lines horizontally and vertically. They are moved by changing their data, rather than plotting
+		# them again
+		y = np.tan((np.radians(0)) * x - 0.001)
+		self.min_line, = self.ax.plot(x, y, color='r')
+
+		y = np.tan(np.radians(90)) * x
+		self.max_line, = self.ax.plot(x, y, color='r')
+
+		self.min_circle, = self.ax.plot(x, y, color='r')
+		self.max_circle, = self.ax.plot(x, y, color='r')
+
+		self.circle_coors = np.full((4, 2),-3.0)
+		self.circle_radius = [0.05, 0.05, 0.05, 0.05]
+
+		self.circler = patches.Circle((-2, -2), 0.05, ec='r', fill=0, alpha=0.7, lw=2.5)
+		self.circleg = patches.Circle((-2, -2), 0.05, ec='g', fill=0, alpha=0.7, lw=2.5)
+		self.circleb = patches.Circle((-2, -2), 0.05, ec='b', fill=0, alpha=0.7, lw=2.5)
+		self.circley = patches.Circle((-2, -2), 0.05, ec='y', fill=0, alpha=0.7, lw=2.5)
+
+		self.ax.add_patch(self.circler)
+		self.ax.add_patch(self.circleg)
+		self.ax.add_patch(self.circleb)
+		self.ax.add_patch(self.circley)
+
+		self.circle_fraction_min = patches.Circle((0, 0), 0, ec='r', fill=0, lw=1.5)
+		self.circle_fraction_max = patches.Circle((0, 0), 1.2, ec='r', fill=0, lw=1.5)
+
+		self.ax.add_patch(self.circle_fraction_min)
+		self.ax.add_patch(self.circle_fraction_max)
+
+		if self.blit:
+			for artist in self.animated_artists():
+				artist.set_animated(True)
+			self.ax.figure.canvas.mpl_connect('draw_event', self.on_draw)
+
+		self.angle_min_val = 0
+		self.angle_max_val = 90
+		self.circle_min_val = 0
+		self.circle_max_val = 120
+		self.fraction_min = 0
+		self.fraction_max = 1.2
+		self.line_alpha = 1.0
+
+		self.image_min_ang, self.image_max_ang = 0, 90
+		self.image_min_M, self.image_max_M = 0, 120
+
+		self.color_map = 0 #0=densitymap, 1=TauM, 2=TauP, 3=densitymap, 4=fractionBound
+
+		self.cmap = matplotlib.cm.jet.copy()
+		self.cmap_r = matplotlib.cm.jet_r.copy()
+		self.cmap.set_bad('k', alpha=0)
+		self.cmap_noir = matplotlib.cm.Greys.copy()
+
+		self.x_fraction = 0
+		self.y_fraction = 0
+		self.circleSelect = 0
+
+	def plot_data(self, x_data, y_data):
+		"""Plots the xy data given by image handler, and colors based on the thresholds and colormap selected by the
+		user"""
+		# Placing the data into a histogram with reasonably sized binning helps speed up the plotting significantly
+		self.plot_histogram(np.histogram2d(x_data, y_data, bins=BINS, range=[G_RANGE, S_RANGE])[0])
+
+	def plot_histogram(self, H):
+		"""Plots the (BINS, BINS) histogram H of the g and s coordinates, coloured based on the thresholds and the
+		colormap selected by the user. H itself isn't modified"""
+		xedges = np.linspace(G_RANGE[0], G_RANGE[1], BINS + 1)
+		yedges = np.linspace(S_RANGE[0], S_RANGE[1], BINS + 1)
+		H = H.T.copy()
+		xcenters = (xedges[:-1] + xedges[1:]) / 2
+		ycenters = (yedges[:-1] + yedges[1:]) / 2
+		x = np.tile(xcenters, (BINS,1))
+		y = np.tile(ycenters, (BINS,1)).T
+		# pre calculate distance D, fraction bound F, and angle A maps for the data
+		D = np.sqrt(x**2+y**2)
+		F = np.sqrt((x-self.x_fraction)**2+(y-self.y_fraction)**2)
+		A = y/x
+		min = np.tan(np.deg2rad(self.angle_min_val))
+		max = np.tan(np.deg2rad(self.angle_max_val))
+		# Convert the plot to an image, which makes it faster to plot than the raw data
+		im = NonUniformImage(self.ax, interpolation='bilinear', cmap=self.cmap)
+		im2 = NonUniformImage(self.ax, interpolation='bilinear', cmap=self.cmap_noir)
+		im.set_data(xcenters, ycenters, A)
+		# These if statements color the top image based on the thresholds, and then sets areas outside the thresholding
+		# to be black.
+		if self.color_map == 0:
+			H = np.ma.masked_where(H < 0.005, H)
+			im.set_data(xcenters, ycenters, H)
+			H[H != 0] = 1
+			im2.set_data(xcenters, ycenters, H)
+		elif self.color_map == 1:
+			im = NonUniformImage(self.ax, interpolation='bilinear', cmap=self.cmap_r)
+			D = np.ma.masked_where((D < self.circle_min_val / 100) | (D > self.circle_max_val / 100) | (H < 0.01) |
+								   (A < min) | (A > max) | (F<self.fraction_min) | (F>self.fraction_max),D)
+			H[H != 0] = 1
+			if not False in D.mask:
+				D.mask[0, 0] = False
+			im.set_data(xcenters, ycenters, D)
+			im.set_clim(self.circle_min_val / 100, self.circle_max_val / 100)
+			im2.set_data(xcenters, ycenters, H)
+		elif self.color_map == 2:
+			A[(A > self.image_max_ang) & (A < max)] = self.image_max_ang
+			A[(A < self.image_min_ang) & (A > min)] = self.image_min_ang
+			A = np.ma.masked_where((D < self.circle_min_val / 100) | (D > self.circle_max_val / 100) | (H < 0.01) |
+								   (A < min) | (A > max) | (F<self.fraction_min) | (F>self.fraction_max),A)
+			if not False in A.mask:
+				A.mask[0, 0] = False
+			im.set_data(xcenters, ycenters, A)
+			im.set_clim(min, max)
+			H[H != 0] = 1
+			im2.set_data(xcenters, ycenters, H)
+		elif self.color_map == 4:
+			F = np.ma.masked_where((D < self.circle_min_val / 100) | (D > self.circle_max_val / 100) | (H < 0.01) |
+								   (A < min) | (A > max) | (F<self.fraction_min) | (F>self.fraction_max),F)
+			H[H != 0] = 1
+			if not False in F.mask:
+				F.mask[0, 0] = False
+			im.set_data(xcenters, ycenters, F)
+			im.set_clim(self.fraction_min, self.fraction_max)
+			im2.set_data(xcenters, ycenters, H)
+		for item in self.ax.get_images():
+			item.remove()
+		# Plot one image on top which has all the colours, and one image on the bottom which is just black to show the
+		# points which are outside of the thresholding
+		self.ax.add_image(im2)
+		self.ax.add_image(im)
+
+	def animated_artists(self):
+		"""Returns the artists which move with the cursor and the range sliders, in the order they are drawn when the
+		whole figure is drawn"""
+		return [self.circler, self.circleg, self.circleb, self.circley, self.circle_fraction_min,
+				self.circle_fraction_max, self.min_line, self.max_line, self.min_circle, self.max_circle]
+
+	def on_draw(self, event):
+		"""Keeps the newly drawn figure, which has everything but the animated artists, as the background, and draws
+		the animated artists over it"""
+		if self.saving:
+			return
+		canvas = self.ax.figure.canvas
+		self.background = canvas.copy_from_bbox(self.ax.figure.bbox)
+		for artist in self.animated_artists():
+			self.ax.draw_artist(artist)
+
+	def redraw(self):
+		"""Draws the animated artists over the background. The whole figure is drawn if there is no background yet,
+		and nothing is drawn without blitting, as the figure is drawn when it's saved"""
+		if not self.blit:
+			return
+		canvas = self.ax.figure.canvas
+		if self.background is None:
+			canvas.draw()
+			return
+		canvas.restore_region(self.background)
+		for artist in self.animated_artists():
+			self.ax.draw_artist(artist)
+		canvas.blit(self.ax.figure.bbox)
+
+	def draw_plot(self):
+		"""Draws the whole figure again, when the data or the static artists changed"""
+		if self.blit:
+			self.ax.figure.canvas.draw()
+
+
+	def set_circle(self, selection):
+		"""Changes the colour of the circle seleted for when the user clicks the plot based on the value in the
+		enumerated dropdown box on the front panel"""
+		self.circleSelect = selection
+
+
+	def clear_circles(self):
+		"""Sends all the circles to far outside the plot coordinates"""
+		self.circle_coors[:] = -3.0
+		self.draw_circles()
+
+
+	def update_circle(self, event):
+		"""Moves the selected circles"""
+		self.circle_coors[self.circleSelect][0] = event.xdata
+		self.circle_coors[self.circleSelect][1] = event.ydata
+		self.draw_circles()
+
+
+	def draw_circles(self):
+		"""Draws the circles. Using patches as opposed to plotting them is far more efficient, otherwise the program
+		hangs for a while"""
+		self.move_circles()
+		self.redraw()
+
+	def move_circles(self):
+		"""Moves the circle patches to the circle coordinates and radii, without drawing them"""
+		for i, circle in enumerate([self.circler, self.circleg, self.circleb, self.circley]):
+			circle.set_center((self.circle_coors[i][0], self.circle_coors[i][1]))
+			circle.set_radius(self.circle_radius[i])
+
+
+	def update_fraction_range(self, min, max, *args, **kwargs):
+		"""Draws the circles for fraction range. Need to clear plot and then redraw it. This is why it's far more
+		efficient to work with images rather than the raw histogram data"""
+		self.fraction_min = min
+		self.fraction_max = max
+		for circle, radius in [(self.circle_fraction_min, min), (self.circle_fraction_max, max)]:
+			circle.set_center((self.x_fraction, self.y_fraction))
+			circle.set_radius(radius)
+			circle.set_edgecolor('b')
+			circle.set_alpha(self.line_alpha)
+		self.redraw()
+
+
+	def update_angle_range(self, min, max, *args, **kwargs):
+		"""Draws the lines for angle range. Need to clear plot and then redraw it. This is why it's far more
+		efficient to work with images rather than the raw histogram data"""
+		x = np.linspace(0,2,3)
+		y = np.tan((np.deg2rad(min)))*x
+		if y[-1] == 0:
+			y = [-1, -1, -1]
+
+		self.min_line.set_data(x, y)
+		self.min_line.set_alpha(self.line_alpha)
+
+		y = np.tan(np.radians(max))*x
+		self.max_line.set_data(x, y)
+		self.max_line.set_alpha(self.line_alpha)
+
+		self.angle_min_val = min
+		self.angle_max_val = max
+
+
+	def update_circle_range(self, min, max, *args, **kwargs):
+		"""Draws the circles for modulation range. Need to clear plot and then redraw it. This is why it's far more
+		efficient to work with images rather than the raw histogram data"""
+		x1 = np.linspace(0, min/100, 100)
+		y1 = np.sqrt((min/100)**2 - x1**2)
+		self.min_circle.set_data(x1, y1)
+		self.min_circle.set_alpha(self.line_alpha)
+
+		x2 = np.linspace(0, max/100, 100)
+		y2 = np.sqrt((max/100)**2 - x2**2)
+		self.max_circle.set_data(x2, y2)
+		self.max_circle.set_alpha(self.line_alpha)
+
+		self.circle_min_val = min
+		self.circle_max_val = max
+
+
+	def change_circle_radius(self, radius):
+		"""Makes the click circles of radius = radius"""
+		self.circle_radius[self.circleSelect] = radius
+		self.draw_circles()
+
+
+	def update_histogram(self, H):
+		"""plots the histogram H of the data, and adds the thresholding lines and circles to a new plot"""
+		self.plot_histogram(H)
+		self.update_angle_range(self.angle_min_val, self.angle_max_val)
+		self.update_circle_range(self.circle_min_val, self.circle_max_val)
+		self.move_circles()
+		self.draw_plot()
+
+
+	def set_colormap(self, val):
+		"""updates the colormap value"""
+		self.color_map = val
+
+
+	def set_image_props(self, min_ang, max_ang, min_m, max_m):
+		"""Changes the thresholding parameters for angle and modulation"""
+		self.image_min_ang = min_ang
+		self.image_max_ang = max_ang
+		self.image_min_M = min_m
+		self.image_max_M = max_m
+
+
+	def set_lifetime_points(self, *args):
+		"""Adds the lifetime values to the universal circle"""
+		lifetime_x = args[0][0]
+		lifetime_y = args[0][1]
+		lifetimes = [0.5, 1, 2, 3, 4, 8]
+		for artist in self.lifetime_artists:
+			artist.remove()
+		self.lifetime_artists = [self.ax.scatter(lifetime_x, lifetime_y, color='r', s=10)]
+		for i in range(6):
+			self.lifetime_artists.append(self.ax.text(lifetime_x[i]-0.05, lifetime_y[i]+0.03,
+																  str(lifetimes[i]) + " ns", color='r', fontsize=9))
+
+
+	def set_frequency(self, MHz):
+		"""Changes the frequency shown on the plot, e.g. when switching to another harmonic"""
+		self.MHz = '{0:.0f}'.format(MHz)
+		self.MHz_text.set_text(self.MHz + " MHz")
+		self.MHz_text.set_x(0.8 if len(self.MHz) <= 2 else 0.75)
+
+
+	def set_fraction(self, x, y):
+		"""Changes the thresholding parameters for the fraction bound circles"""
+		self.x_fraction = x
+		self.y_fraction = y
+
+
+	def save_fig(self, file):
+		"""Saves a picture of the plot in file path. The animated artists are only drawn by savefig when they aren't
+		animated, and the canvas is drawn again afterwards as saving replaces its buffer"""
+		if not self.blit:
+			self.ax.figure.savefig(file)
+			return
+		self.saving = True
+		try:
+			for artist in self.animated_artists():
+				artist.set_animated(False)
+			self.ax.figure.savefig(file)
+		finally:
+			for artist in self.animated_artists():
+				artist.set_animated(True)
+			self.saving = False
+		self.draw_plot()
+
+
+	def set_alpha(self, value):
+		self.line_alpha = value
+		self.update_circle_range(self.circle_min_val, self.circle_max_val)
+		self.update_angle_range(self.angle_min_val, self.angle_max_val)
+		self.update_fraction_range(self.fraction_min, self.fraction_max)
+
+
+def headless_plot(MHz):
+	"""Returns a phasor plot drawn on its own figure, with the same layout as the Graph window"""
+	fig = Figure()
+	FigureCanvasAgg(fig)
+	plot = PhasorPlot()
+	# [left, bottom, width, height]
+	plot.setup_plot(fig.add_axes([0.15, 0.19, 0.8, 0.75]), MHz)
+	return plot
+
+
+def plot_dataset(dataset):
+	"""Returns a headless phasor plot set up with the ranges, cursor circles and fraction coordinates of the
+	PhasorDataset dataset"""
+	plot = headless_plot(dataset.freq * dataset.harmonic)
+	plot.set_lifetime_points(dataset.get_phasor_lifetime_coordinates())
+	plot.set_fraction(dataset.x_fraction, dataset.y_fraction)
+	plot.update_fraction_range(dataset.fraction_min, dataset.fraction_max)
+	plot.update_angle_range(dataset.applied_min_ang, dataset.applied_max_ang)
+	plot.update_circle_range(dataset.applied_min_M, dataset.applied_max_M)
+	plot.circle_coors = dataset.circle_coors.copy()
+	plot.circle_radius = list(dataset.circle_radius)
+	plot.set_image_props(dataset.image_min_ang, dataset.image_max_ang, dataset.image_min_M, dataset.image_max_M)
+	return plot
+
+
+def plot_tasks(dataset, file, save_type='all', colormap=None, name=None):
+	"""Returns the (path, function) of each of the phasor plots of the colormaps of dataset, the same way as
+	PhasorDataset.save_data saves the images, where function() draws the plot on a headless figure of its own and
+	saves it, so that the plots can be saved at the same time"""
+	if colormap is None:
+		colormap = dataset.color_map_select
+	path = file + '/' + (dataset.name if name is None else name)
+	H = dataset.phasor_histogram()
+	tasks = []
+	for val, graph_name, colormaps in PLOT_COLORMAPS:
+		if save_type == 'all' or (save_type == 'current' and colormap in colormaps):
+			file_name = path + '_graph_' + graph_name + '.png'
+			tasks.append((file_name, partial(save_plot, dataset, val, H, file_name)))
+	return tasks
+
+
+def save_plot(dataset, val, H, file_name):
+	"""Saves the plot of the histogram H with the colormap val, and the ranges the image of that colormap is coloured
+	with"""
+	plot = plot_dataset(dataset.scaled(val))
+	plot.set_colormap(val)
+	plot.update_histogram(H)
+	plot.save_fig(file_name)
@@ -0,0 +1,290 @@
+# Calculates the phasor transform of the decay stacks. The stack is treated as a (T, Y*X) matrix which is multiplied by
+# a precomputed (ones, cos, sin) kernel, so the sums over the time bins are done by a single matrix product per block of
+# pixels instead of building full size float copies of the stack for each of the sums.
+#
+# Only a time gate of the bins can be summed, e.g. to leave out the rise of the IRF or the background of the last bins.
+# To try many gates, the cumulative sums over the time bins are kept instead, so that the sums of any gate are the
+# difference of two of their planes, without reading the stack again.
+#
+# The decays of the neighbourhood of every pixel can also be summed (binned) for images with few photons. As the
+# transform is linear, this is done on the sums of the transform rather than on the stack itself.
+
+# imports
+import numpy as np
+import tifffile
+from functools import lru_cache
+
+# Number of pixels which are converted to float at a time, which bounds the temporary memory to
+# CHUNK_PIXELS * bins * 8 bytes
+CHUNK_PIXELS = 65536
+# Memory in bytes which the blocks read from a tiff file may use when the stack is streamed from disk
+MEMORY_BUDGET = 256 * 1024 ** 2
+
+
+@lru_cache(maxsize=32)
+def phasor_kernel(bins, bin_width, freq, harmonics=(1,)):
+	"""Returns the (1 + 2 * n_harmonics, bins) kernel of the transform. The first row sums the intensity, followed by
+	the cos and sin rows of each harmonic in harmonics. The kernel is cached, so it must not be modified"""
+	t_arr = np.linspace(bin_width / 2, bin_width * (bins - 1 / 2), bins)
+	rows = [np.ones(bins)]
+	for harmonic in harmonics:
+		omega = 2 * np.pi * freq / 1000 * harmonic
+		rows.append(np.cos(omega * t_arr))
+		rows.append(np.sin(omega * t_arr))
+	kernel = np.stack(rows)
+	kernel.setflags(write=False)
+	return kernel
+
+
+def gate_slice(gate, bins):
+	"""Returns the slice of the time bins [start, stop) of gate, or of all the bins if gate is None"""
+	if gate is None:
+		return slice(0, bins)
+	start, stop = int(gate[0]), int(gate[1])
+	if not 0 <= start < stop <= bins:
+		raise ValueError(f'The gate {start}-{stop} is not within the {bins} time bins of the stack')
+	return slice(start, stop)
+
+
+def phasor_sums(stack, kernel, chunk_pixels=CHUNK_PIXELS):
+	"""Multiplies the (T, Y, X) stack by the kernel and returns the (K, Y, X) sums. The stack keeps its own dtype, and
+	only chunk_pixels pixels at a time are converted to float"""
+	bins = stack.shape[0]
+	pixels = stack.reshape(bins, -1)
+	sums = np.empty((kernel.shape[0], pixels.shape[1]))
+	for start in range(0, pixels.shape[1], chunk_pixels):
+		block = pixels[:, start:start + chunk_pixels].astype(float)
+		sums[:, start:start + chunk_pixels] = kernel @ block
+	return sums.reshape((kernel.shape[0],) + stack.shape[1:])
+
+
+def sums_to_coordinates(sums):
+	"""Divides the cos and sin sums by the intensity, returning the (n_harmonics, Y, X) g and s maps"""
+	integral = sums[0].copy()
+	integral[integral == 0] = 0.00001
+	g = sums[1::2] / integral
+	s = sums[2::2] / integral
+	return g, s
+
+
+def calibrate(g, s, phi_cal, m_cal):
+	"""Rotates the g and s coordinates by phi_cal and scales them by m_cal"""
+	cos_phi, sin_phi = np.cos(phi_cal), np.sin(phi_cal)
+	return (cos_phi * g - sin_phi * s) * m_cal, (sin_phi * g + cos_phi * s) * m_cal
+
+
+def phasor_coordinates(stack, bin_width, freq, harmonic=1):
+	"""Returns the uncalibrated g and s maps of the (T, Y, X) stack for one harmonic. see
+	https://doi.org/10.1073/pnas.1108161108"""
+	kernel = phasor_kernel(stack.shape[0], float(bin_width), float(freq), (float(harmonic),))
+	g, s = sums_to_coordinates(phasor_sums(stack, kernel))
+	return g[0], s[0]
+
+
+def read_phasor_sums(filename, bin_width, freq, harmonics=(1,), memory_budget=MEMORY_BUDGET, progress=None,
+					 gate=None):
+	"""Streams the tiff stack located at filename through the transform without loading the whole stack. Returns the
+	intensity image, which is the same as summing the stack over the time bins, and the (K, Y, X) sums. The file is
+	memory mapped and read in bands of rows when possible, and otherwise read in batches of pages. The blocks read
+	at once are kept under memory_budget bytes, and progress(done, total) is called after each block. If gate is
+	given, only the time bins [start, stop) of it are summed"""
+	try:
+		stack = tifffile.memmap(filename, mode='r')
+	except ValueError:
+		stack = None
+	if stack is not None and stack.ndim == 3:
+		return _memmap_sums(stack, bin_width, freq, harmonics, memory_budget, progress, gate)
+	return _page_sums(filename, bin_width, freq, harmonics, memory_budget, progress, gate)
+
+
+def _memmap_sums(stack, bin_width, freq, harmonics, memory_budget, progress, gate=None):
+	"""Accumulates the sums of a memory mapped (T, Y, X) stack one band of rows at a time"""
+	gate = gate_slice(gate, stack.shape[0])
+	kernel = phasor_kernel(stack.shape[0], float(bin_width), float(freq), tuple(float(h) for h in harmonics))[:, gate]
+	stack = stack[gate]
+	bins, height, width = stack.shape
+	rows = int(max(1, memory_budget // (bins * width * (stack.itemsize + 8))))
+	intensity = np.empty((height, width), dtype=np.zeros(1, dtype=stack.dtype).sum().dtype)
+	sums = np.empty((kernel.shape[0], height, width))
+	for start in range(0, height, rows):
+		block = np.ascontiguousarray(stack[:, start:start + rows])
+		intensity[start:start + rows] = np.sum(block, axis=0)
+		sums[:, start:start + rows] = phasor_sums(block, kernel, block.shape[1] * width)
+		if progress is not None:
+			progress(min(start + rows, height), height)
+	return intensity, sums
+
+
+def _page_sums(filename, bin_width, freq, harmonics, memory_budget, progress, gate=None):
+	"""Accumulates the sums of a tiff stack which can't be memory mapped (e.g. compressed) a batch of pages at a
+	time"""
+	with tifffile.TiffFile(filename) as tif:
+		pages = tif.series[0].pages
+		first = pages[0].asarray()
+		if first.ndim == 3:
+			# the whole stack is stored in a single page
+			first = tif.series[0].asarray()
+			gate = gate_slice(gate, first.shape[0])
+			kernel = phasor_kernel(first.shape[0], float(bin_width), float(freq), tuple(float(h) for h in harmonics))
+			if progress is not None:
+				progress(1, 1)
+			return np.sum(first[gate], axis=0), phasor_sums(first[gate], kernel[:, gate])
+
+		gate = gate_slice(gate, len(pages))
+		kernel = phasor_kernel(len(pages), float(bin_width), float(freq), tuple(float(h) for h in harmonics))
+		batch = int(max(1, memory_budget // (first.size * (first.itemsize + 8))))
+		intensity = np.zeros(first.size, dtype=np.zeros(1, dtype=first.dtype).sum().dtype)
+		sums = np.zeros((kernel.shape[0], first.size))
+		for start in range(gate.start, gate.stop, batch):
+			stop = min(start + batch, gate.stop)
+			block = np.stack([pages[t].asarray().reshape(-1) for t in range(start, stop)])
+			intensity += np.sum(block, axis=0)
+			sums += kernel[:, start:stop] @ block.astype(float)
+			if progress is not None:
+				progress(stop - gate.start, gate.stop - gate.start)
+	return intensity.reshape(first.shape), sums.reshape((kernel.shape[0],) + first.shape)
+
+
+def box_sum(image, radius):
+	"""Returns the sums of image over the (2 * radius + 1) square around every pixel, where the pixels outside of the
+	image count as 0. The sums are found from the summed-area table of image, four lookups per pixel, so the cost
+	doesn't depend on radius. Integer images are summed exactly in 64 bits"""
+	height, width = image.shape
+	size = 2 * radius + 1
+	# The table is padded by radius on every side, so that the corners of every square are at the same offsets: the
+	# padding before the image is 0 and the padding after it repeats the sums of the whole rows and columns
+	table = np.zeros((height + 2 * radius + 1, width + 2 * radius + 1),
+					 dtype=np.int64 if image.dtype.kind in 'ui' else float)
+	inside = table[radius + 1:radius + 1 + height, radius + 1:radius + 1 + width]
+	np.cumsum(image, axis=1, out=inside)
+	# the rows are added one at a time, which is several times faster than a cumulative sum down the columns
+	for row in range(1, height):
+		np.add(inside[row - 1], inside[row], out=inside[row])
+	table[radius + 1 + height:] = table[radius + height]
+	table[:, radius + 1 + width:] = table[:, radius + width, None]
+	sums = table[size:size + height, size:size + width] - table[:height, size:size + width]
+	sums -= table[size:size + height, :width]
+	sums += table[:height, :width]
+	return sums
+
+
+def disk_sum(image, radius):
+	"""Returns the sums of image over the pixels within radius of every pixel, where the pixels outside of the image
+	count as 0. Each row of the circle is a run of pixels, which is found from the cumulative sums of the rows of
+	image, so the cost grows with the number of rows of the circle rather than its area"""
+	height, width = image.shape
+	# padded the same as the table of box_sum, along the rows only
+	table = np.zeros((height, width + 2 * radius + 1), dtype=np.int64 if image.dtype.kind in 'ui' else float)
+	np.cumsum(image, axis=1, out=table[:, radius + 1:radius + 1 + width])
+	table[:, radius + 1 + width:] = table[:, radius + width, None]
+	sums = np.zeros(image.shape, dtype=table.dtype)
+	for dy in range(-radius, radius + 1):
+		half = int(np.sqrt(radius ** 2 - dy ** 2))
+		# the rows y of the result which have a row y + dy in the image
+		start, stop = max(0, -dy), min(height, height - dy)
+		if start >= stop:
+			continue
+		rows = table[start + dy:stop + dy]
+		sums[start:stop] += rows[:, radius + half + 1:radius + half + 1 + width]
+		sums[start:stop] -= rows[:, radius - half:radius - half + width]
+	return sums
+
+
+# the neighbourhoods the decays of each pixel can be binned over
+BINNING_SHAPES = {'square': box_sum, 'circle': disk_sum}
+
+
+def bin_coordinates(intensity, g, s, radius, shape='square'):
+	"""Returns the uncalibrated (n_harmonics, Y, X) g and s coordinates of the decays summed over the neighbourhood of
+	every pixel, the (2 * radius + 1) square or the circle of radius around it. The cos and sin sums are found again
+	from the coordinates and the intensity, and summed over the neighbourhoods along with the intensity before they
+	are divided by it, which is the same as summing the decays of the stack before the transform"""
+	if radius <= 0:
+		return g, s
+	neighbourhood_sum = BINNING_SHAPES[shape]
+	integral = neighbourhood_sum(intensity, radius).astype(float)
+	integral[integral == 0] = 0.00001
+	return tuple(np.stack([neighbourhood_sum(c * intensity, radius) / integral for c in coordinates])
+				 for coordinates in (g, s))
+
+
+def stack_bins(filename):
+	"""Returns the number of time bins of the tiff stack at filename, which only reads its header"""
+	with tifffile.TiffFile(filename) as tif:
+		return tif.series[0].shape[0]
+
+
+class CumulativeSums:
+	"""The (T + 1, K, Y, X) cumulative sums of the transform of a stack over its T time bins, where plane t holds the
+	sums of the bins before t. The intensity and the (K, Y, X) sums of any gate [start, stop) are then found by
+	subtracting two planes. The K rows are the intensity and the cos and sin rows of each of harmonics, the same as
+	phasor_kernel. The sums are kept in double precision, so the intensity of integer stacks is exact. This takes
+	(T + 1) * K times the memory of the coordinates of one harmonic"""
+
+	def __init__(self, cumulative, intensity_dtype, harmonics):
+		self.cumulative = cumulative
+		self.intensity_dtype = np.dtype(intensity_dtype)
+		self.harmonics = tuple(float(h) for h in harmonics)
+
+	@property
+	def bins(self):
+		return self.cumulative.shape[0] - 1
+
+	def gate_sums(self, gate=None, harmonics=None):
+		"""Returns the intensity image and the (K, Y, X) sums of the time bins of gate, the same as read_phasor_sums,
+		with the rows of harmonics (by default all of them)"""
+		gate = gate_slice(gate, self.bins)
+		if harmonics is None:
+			sums = self.cumulative[gate.stop] - self.cumulative[gate.start]
+		else:
+			rows = [0]
+			for harmonic in harmonics:
+				row = 1 + 2 * self.harmonics.index(float(harmonic))
+				rows += [row, row + 1]
+			sums = self.cumulative[gate.stop, rows] - self.cumulative[gate.start, rows]
+		intensity = sums[0]
+		if self.intensity_dtype.kind in 'ui':
+			intensity = np.rint(intensity)
+		return intensity.astype(self.intensity_dtype), sums
+
+	def add_harmonics(self, other):
+		"""Returns the sums along with the harmonics of the sums other, of the same stack"""
+		return CumulativeSums(np.concatenate([self.cumulative, other.cumulative[:, 1:]], axis=1), self.intensity_dtype,
+							  self.harmonics + other.harmonics)
+
+	def nbytes(self):
+		return self.cumulative.nbytes
+
+
+def cumulative_sums(planes, bins, bin_width, freq, harmonics=(1,), progress=None):
+	"""Returns the CumulativeSums of the (Y, X) planes of the T time bins, an iterator which only needs one plane in
+	memory at a time"""
+	harmonics = tuple(float(h) for h in harmonics)
+	kernel = phasor_kernel(bins, float(bin_width), float(freq), harmonics)
+	cumulative = None
+	for t, plane in enumerate(planes):
+		if cumulative is None:
+			cumulative = np.zeros((bins + 1, kernel.shape[0]) + plane.shape)
+			intensity_dtype = np.zeros(1, dtype=plane.dtype).sum().dtype
+		np.multiply.outer(kernel[:, t], plane, out=cumulative[t + 1])
+		cumulative[t + 1] += cumulative[t]
+		if progress is not None:
+			progress(t + 1, bins)
+	return CumulativeSums(cumulative, intensity_dtype, harmonics)
+
+
+def read_cumulative_sums(filename, bin_width, freq, harmonics=(1,), progress=None):
+	"""Reads the tiff stack located at filename one time bin at a time, and returns its CumulativeSums"""
+	try:
+		stack = tifffile.memmap(filename, mode='r')
+	except ValueError:
+		stack = None
+	if stack is None or stack.ndim != 3:
+		with tifffile.TiffFile(filename) as tif:
+			pages = tif.series[0].pages
+			if len(pages) == 1:
+				stack = tif.series[0].asarray()
+			else:
+				return cumulative_sums((page.asarray() for page in pages), len(pages), bin_width, freq, harmonics,
+									   progress)
+	return cumulative_sums(stack, stack.shape[0], bin_width, freq, harmonics, progress)
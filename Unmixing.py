@@ -0,0 +1,62 @@
+# Unmixes the phasor coordinates of every pixel into the fractions of two or three species of known coordinates, e.g.
+# free and bound NADH and a third component. The phasor of a pixel is the sum of the phasors of the species weighted by
+# their fractions of its intensity, so the fractions solve a small linear system which is the same for every pixel. It
+# is inverted once, which makes the fraction of each species a linear function of g and s, and that is applied to
+# whole images a chunk of pixels at a time, without any loops over the pixels.
+
+# imports
+import numpy as np
+
+# number of pixels whose fractions are found at a time, which bounds the temporary memory
+CHUNK_PIXELS = 1 << 20
+
+
+def lifetime_coordinates(lifetime, omega):
+	"""Returns the (g, s) coordinates on the universal circle of a single exponential decay of lifetime (ns), at the
+	angular frequency omega (rad/ns)"""
+	return 1 / (1 + (omega * lifetime) ** 2), omega * lifetime / (1 + (omega * lifetime) ** 2)
+
+
+def coefficients(components):
+	"""Returns the (n, 3) coefficients of the fractions of the n species (2 or 3) at components, a sequence of their
+	(g, s) coordinates, so that the fraction of species i is c[i, 0] * g + c[i, 1] * s + c[i, 2]. Two species are
+	unmixed by projecting every pixel onto the line through them, and three by solving for the fractions which add up
+	to 1 and sum to the phasor of the pixel. Raises a ValueError if the species can't be told apart"""
+	points = np.asarray(components, dtype=float)
+	if points.shape not in ((2, 2), (3, 2)):
+		raise ValueError('Unmixing needs the (g, s) coordinates of 2 or 3 species')
+	if len(points) == 2:
+		direction = points[0] - points[1]
+		length = direction @ direction
+		if length == 0:
+			raise ValueError('The two species have the same coordinates')
+		first = np.append(direction / length, -(points[1] @ direction) / length)
+		return np.stack([first, np.array([0, 0, 1]) - first])
+	# the columns are the species, and the rows their g, s and the sum of the fractions
+	system = np.vstack([points.T, np.ones(3)])
+	if abs(np.linalg.det(system)) < 1e-9:
+		raise ValueError("The three species are on a line, so their fractions can't be told apart")
+	return np.linalg.inv(system)
+
+
+def fractions(g, s, components, chunk_pixels=CHUNK_PIXELS, dtype=None):
+	"""Returns the (n, Y, X) fractions of the n species at components of every pixel of the g and s maps, in dtype
+	(by default the dtype of g). The pixels are done chunk_pixels at a time, so only the result is allocated at the
+	full size of the image. The fractions of the pixels outside of the species, e.g. outside the triangle of three
+	species, are below 0 or above 1"""
+	coefficient = coefficients(components)
+	dtype = np.dtype(g.dtype if dtype is None else dtype)
+	if dtype.kind != 'f':
+		dtype = np.dtype(float)
+	out = np.empty((len(coefficient),) + g.shape, dtype=dtype)
+	g, s, flat = g.reshape(-1), s.reshape(-1), out.reshape(len(coefficient), -1)
+	term = np.empty(min(chunk_pixels, g.size), dtype=dtype)
+	for start in range(0, g.size, chunk_pixels):
+		chunk = slice(start, start + chunk_pixels)
+		size = len(g[chunk])
+		for (a, b, offset), fraction in zip(coefficient, flat[:, chunk]):
+			np.multiply(g[chunk], dtype.type(a), out=fraction)
+			np.multiply(s[chunk], dtype.type(b), out=term[:size])
+			fraction += term[:size]
+			fraction += dtype.type(offset)
+	return out
@@ -0,0 +1,2 @@
+# Benchmarks of the analysis of FLIM stacks, run on synthetic stacks of known lifetimes so that the results of
+# different commits and computers can be compared. Run "python -m benchmarks --help" from the root of the repository.
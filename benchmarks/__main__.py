@@ -0,0 +1,68 @@
+# Command line of the benchmarks. "python -m benchmarks run -o results.json" times the stages of the analysis, and
+# "python -m benchmarks compare reference.json results.json" shows how much faster or slower each stage got.
+
+# imports
+import argparse
+import os
+import sys
+
+# the modules of FLUTE are imported from the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import suite
+from benchmarks.synthetic import DATA_DIR
+
+
+def run(args):
+	"""Runs the run command, and returns the exit code"""
+	def log(message):
+		print(message, file=sys.stderr)
+
+	results = suite.run_suite(args.sizes, args.bins, args.repeat, not args.no_memory, args.photons, args.data, log)
+	suite.save_results(results, args.output)
+	print(f'Results saved to {args.output}', file=sys.stderr)
+	return 0
+
+
+def compare(args):
+	"""Runs the compare command, and returns 1 if any stage regressed"""
+	rows = suite.compare_results(suite.load_results(args.reference), suite.load_results(args.results), args.tolerance)
+	print(f'{"case":>16} {"stage":<22} {"reference":>10} {"now":>10} {"ratio":>7}')
+	for size, bins, stage, before, after, ratio, regression in rows:
+		flag = '  slower' if regression else ''
+		print(f'{f"{size}x{size}x{bins}":>16} {stage:<22} {before * 1000:>8.1f}ms {after * 1000:>8.1f}ms '
+			  f'{ratio:>7.2f}{flag}')
+	return 1 if any(row[-1] for row in rows) else 0
+
+
+def build_parser():
+	parser = argparse.ArgumentParser(prog='benchmarks', description='benchmarks of FLUTE on synthetic FLIM stacks')
+	commands = parser.add_subparsers(dest='command', required=True)
+
+	parser_run = commands.add_parser('run', help='time the stages of the analysis and save the results')
+	parser_run.add_argument('-o', '--output', default='benchmark.json', help='JSON file the results are saved in')
+	parser_run.add_argument('--sizes', type=int, nargs='+', default=suite.DEFAULT_SIZES,
+							help='width and height of the stacks, from 256 up to 4096')
+	parser_run.add_argument('--bins', type=int, nargs='+', default=suite.DEFAULT_BINS,
+							help='time bins of the stacks, from 64 up to 1024')
+	parser_run.add_argument('--photons', type=int, default=1000, help='photons of the brightest pixels')
+	parser_run.add_argument('--repeat', type=int, default=3, help='times each stage is timed')
+	parser_run.add_argument('--no-memory', action='store_true', help="don't measure the peak memory")
+	parser_run.add_argument('--data', default=DATA_DIR, help='folder the synthetic stacks are kept in')
+	parser_run.set_defaults(func=run)
+
+	parser_compare = commands.add_parser('compare', help='compare the results of two runs')
+	parser_compare.add_argument('reference')
+	parser_compare.add_argument('results')
+	parser_compare.add_argument('--tolerance', type=float, default=suite.TOLERANCE,
+								help='slowdown which counts as a regression, e.g. 0.1 for 10%%')
+	parser_compare.set_defaults(func=compare)
+	return parser
+
+
+def main(argv=None):
+	args = build_parser().parse_args(argv)
+	return args.func(args)
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,196 @@
+# Times the stages of the analysis on the synthetic stacks: the transform, the calibration, the median filters, the
+# masks and colormaps, the phasor plot and saving the data, the same way the GUI and the batch run them but without any
+# windows. Each stage is timed a few times and the median is kept, and the peak memory it allocates is measured in a
+# separate run with tracemalloc, which slows the code it traces. The results are written to a JSON file along with the
+# commit and the computer, so that the files of two commits can be compared with compare_results.
+
+# imports
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+import numpy as np
+import tifffile
+import Calibration
+import ExportPipeline
+import PhasorPlot
+from MapStore import MapStore
+from PhasorDataset import PhasorDataset, COLORMAP_NAMES
+from benchmarks.synthetic import SyntheticStack, BI_LIFETIMES, DATA_DIR
+
+DEFAULT_SIZES = (256, 1024)
+DEFAULT_BINS = (64, 256)
+# 3x3 median filters applied in the convolution stage
+FILTERS = 3
+# a stage which is slower than the same stage of the reference by more than this fraction counts as a regression
+TOLERANCE = 0.1
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def commit_info():
+	"""Returns the commit of the repository and whether it has uncommitted changes, or None if git isn't there"""
+	try:
+		commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True)
+		status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+								capture_output=True, text=True, check=True)
+	except (OSError, subprocess.CalledProcessError):
+		return None, None
+	return commit.stdout.strip(), bool(status.stdout.strip())
+
+
+def time_stage(function, setup=None, repeat=3):
+	"""Returns the seconds each of repeat calls of function(state) took, where state = setup() is prepared before
+	each call without being timed"""
+	seconds = []
+	for _ in range(repeat):
+		state = setup() if setup is not None else None
+		start = time.perf_counter()
+		function(state)
+		seconds.append(time.perf_counter() - start)
+	return seconds
+
+
+def peak_memory(function, setup=None):
+	"""Returns the peak bytes allocated by function(state) above what was allocated before it was called, including
+	the arrays of numpy but not the pages of memory mapped files"""
+	state = setup() if setup is not None else None
+	tracemalloc.start()
+	try:
+		tracemalloc.reset_peak()
+		before = tracemalloc.get_traced_memory()[0]
+		function(state)
+		peak = tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+	return peak - before
+
+
+def stages(stack, folder):
+	"""Returns the (name, function, setup) of each stage timed on stack. Every stage works on a dataset of its own
+	from setup, so a stage doesn't see the caches filled by the runs before it"""
+	freq = stack.freq
+
+	def load(state=None):
+		phi_cal, m_cal = Calibration.get_calibration_parameters(stack.calibration_filename, stack.bin_width, freq,
+																cache=None)
+		return PhasorDataset(stack.filename, phi_cal, m_cal, stack.bin_width, freq, cache=None)
+	dataset = load()
+
+	def fresh():
+		data = dataset.snapshot()
+		data.maps = MapStore()
+		return data
+
+	def filtered():
+		data = fresh()
+		data.convolution(FILTERS)
+		data.update_threshold(stack.photons.min() * 0.5, stack.photons.max() * 2)
+		data.update_angle_range(5, 85)
+		data.update_circle_range(10, 100)
+		data.fraction_lifetime_map(BI_LIFETIMES[0])
+		data.update_fraction_range(0, 60)
+		data.apply_masks()
+		return data
+
+	def apply_colormap(colormap):
+		def apply(data):
+			data.color_map_select = colormap
+			data.apply_masks()
+		return apply
+
+	def plot_data(data):
+		plot = PhasorPlot.headless_plot(freq)
+		g, s = data.thresholded_coordinates()
+		plot.plot_data(g, s)
+		plot.ax.figure.canvas.draw()
+
+	def save_data(data):
+		output = tempfile.mkdtemp(dir=folder)
+		try:
+			ExportPipeline.export(data, output)
+		finally:
+			shutil.rmtree(output)
+
+	result = [('perform_fft', lambda image: dataset.perform_fft(image),
+			   lambda: tifffile.memmap(stack.filename, mode='r')),
+			  ('calibration', lambda state: Calibration.get_calibration_parameters(
+				  stack.calibration_filename, stack.bin_width, freq, cache=None), None),
+			  ('load', load, None),
+			  ('convolution', lambda data: data.convolution(FILTERS), fresh)]
+	result += [('apply_masks/' + name, apply_colormap(val), filtered) for val, name in COLORMAP_NAMES.items()]
+	result += [('plot_data', plot_data, filtered),
+			   ('save_data', save_data, filtered)]
+	return dataset, result
+
+
+def accuracy(stack, dataset):
+	"""Returns the mean and largest absolute errors of the calibrated g and s coordinates from the lifetimes the
+	stack was made of"""
+	g, s = stack.truth()
+	g_error = np.abs(dataset.xcoor_map - g)
+	s_error = np.abs(dataset.ycoor_map - s)
+	return {'g_mean': float(g_error.mean()), 'g_max': float(g_error.max()),
+			's_mean': float(s_error.mean()), 's_max': float(s_error.max())}
+
+
+def run_case(size, bins, repeat=3, memory=True, photons=1000, folder=DATA_DIR, log=None):
+	"""Times every stage on the synthetic stack of size x size pixels and bins time bins, and returns the list of
+	results"""
+	stack = SyntheticStack(size, bins, photons, folder=folder)
+	dataset, timed = stages(stack, folder)
+	case = {'size': size, 'bins': bins, 'photons': photons, 'accuracy': accuracy(stack, dataset), 'stages': []}
+	pixels = size * size
+	for name, function, setup in timed:
+		seconds = time_stage(function, setup, repeat)
+		median = float(np.median(seconds))
+		result = {'stage': name, 'seconds': seconds, 'median': median, 'pixels_per_second': pixels / median}
+		if name in ('perform_fft', 'calibration', 'load'):
+			result['samples_per_second'] = pixels * bins / median
+		if memory:
+			result['peak_bytes'] = peak_memory(function, setup)
+		case['stages'].append(result)
+		if log is not None:
+			peak = f", peak {result['peak_bytes'] / 1024 ** 2:.1f} MB" if memory else ''
+			log(f'{size}x{size}x{bins} {name}: {median * 1000:.1f} ms{peak}')
+	return case
+
+
+def run_suite(sizes=DEFAULT_SIZES, bins=DEFAULT_BINS, repeat=3, memory=True, photons=1000, folder=DATA_DIR, log=None):
+	"""Runs every combination of sizes and bins, and returns the results along with the commit and the computer
+	they were measured on"""
+	commit, dirty = commit_info()
+	return {'commit': commit, 'dirty': dirty, 'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+			'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+			'processor': platform.processor(), 'cpu_count': os.cpu_count(), 'repeat': repeat,
+			'cases': [run_case(size, n_bins, repeat, memory, photons, folder, log) for size in sizes for n_bins in bins]}
+
+
+def save_results(results, file_name):
+	with open(file_name, 'w') as f:
+		json.dump(results, f, indent=1)
+
+
+def load_results(file_name):
+	with open(file_name) as f:
+		return json.load(f)
+
+
+def compare_results(reference, results, tolerance=TOLERANCE):
+	"""Returns a (size, bins, stage, reference seconds, seconds, ratio, regression) row for each stage measured in
+	both results, where ratio is the time of results over the time of reference"""
+	times = {(case['size'], case['bins'], stage['stage']): stage['median']
+			 for case in reference['cases'] for stage in case['stages']}
+	rows = []
+	for case in results['cases']:
+		for stage in case['stages']:
+			key = (case['size'], case['bins'], stage['stage'])
+			if key in times:
+				ratio = stage['median'] / times[key]
+				rows.append(key + (times[key], stage['median'], ratio, ratio > 1 + tolerance))
+	return rows
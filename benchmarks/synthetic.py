@@ -0,0 +1,111 @@
+# Generates synthetic TCSPC decay stacks of known lifetimes. The left part of the image has bands of mono exponential
+# decays, and the right part bi exponential decays whose fraction changes along the rows, while the brightness changes
+# down the columns. The decays repeat with the laser period, are delayed by the instrument, and are binned into
+# photon counts with Poisson noise. The stacks are written one time bin at a time, so the largest sizes never sit in
+# memory, and they are kept in a folder so that they are only generated once for each set of parameters.
+
+# imports
+import os
+import tempfile
+import numpy as np
+import tifffile
+
+# Lifetimes in ns of the bands of mono exponential decays, and of the two components of the bi exponential decays
+MONO_LIFETIMES = (0.5, 1.0, 2.0, 4.0)
+BI_LIFETIMES = (0.4, 4.0)
+# Lifetime of the calibration stack, as for fluorescein
+CALIBRATION_LIFETIME = 4.0
+DATA_DIR = os.path.join(tempfile.gettempdir(), 'flute_benchmarks')
+
+
+def lifetime_maps(size):
+	"""Returns the (size, size) maps of the two lifetimes of each pixel and the fraction of the photons of the first
+	one. The left half has MONO_LIFETIMES in vertical bands, and the right half mixes BI_LIFETIMES from all of the
+	short lifetime at its left edge to all of the long one at the right edge"""
+	half = size // 2
+	columns = np.arange(size)
+	tau1 = np.empty(size)
+	tau2 = np.empty(size)
+	fraction = np.ones(size)
+	bands = np.minimum(columns[:half] * len(MONO_LIFETIMES) // max(half, 1), len(MONO_LIFETIMES) - 1)
+	tau1[:half] = tau2[:half] = np.take(MONO_LIFETIMES, bands)
+	tau1[half:], tau2[half:] = BI_LIFETIMES
+	fraction[half:] = 1 - (columns[half:] - half) / max(size - half - 1, 1)
+	return [np.broadcast_to(row, (size, size)) for row in (tau1, tau2, fraction)]
+
+
+def brightness_map(size, photons):
+	"""Returns the expected photons of each pixel, from a fifth of photons in the top row to photons in the bottom
+	row, so that the intensity thresholds have something to cut"""
+	rows = np.linspace(0.2, 1, size)[:, None] * photons
+	return np.broadcast_to(rows, (size, size))
+
+
+def cumulative_decay(t, tau, period):
+	"""Returns the fraction of the photons of a decay of lifetime tau, repeated every period, which arrive before t.
+	t counts from the start of a decay and may span several periods"""
+	cycles = np.floor(t / period)
+	t = t - cycles * period
+	return cycles + (1 - np.exp(-t / tau)) / (1 - np.exp(-period / tau))
+
+
+def expected_counts(t0, t1, tau1, tau2, fraction, photons, period, delay):
+	"""Returns the expected photons of each pixel in the time bin [t0, t1), for decays which start delay ns late"""
+	first = cumulative_decay(t1 - delay, tau1, period) - cumulative_decay(t0 - delay, tau1, period)
+	second = cumulative_decay(t1 - delay, tau2, period) - cumulative_decay(t0 - delay, tau2, period)
+	return photons * (fraction * first + (1 - fraction) * second)
+
+
+def phasor_truth(tau1, tau2, fraction, freq, harmonic=1):
+	"""Returns the g and s maps of the phasors of the decays without the delay, which are what the calibrated
+	transform of the stack should find"""
+	omega = 2 * np.pi * freq / 1000 * harmonic
+	g = fraction / (1 + (omega * tau1) ** 2) + (1 - fraction) / (1 + (omega * tau2) ** 2)
+	s = fraction * omega * tau1 / (1 + (omega * tau1) ** 2) + (1 - fraction) * omega * tau2 / (1 + (omega * tau2) ** 2)
+	return g, s
+
+
+def write_stack(file_name, tau1, tau2, fraction, photons, bins, freq=80, delay=0.5, noise=True, seed=0):
+	"""Writes the (bins, Y, X) uint16 stack of the decays into the tiff file file_name, one time bin at a time. The
+	bins span one laser period, so the bin width is 1000 / freq / bins ns"""
+	period = 1000 / freq
+	bin_width = period / bins
+	rng = np.random.default_rng(seed)
+
+	def planes():
+		for k in range(bins):
+			counts = expected_counts(k * bin_width, (k + 1) * bin_width, tau1, tau2, fraction, photons, period, delay)
+			counts = rng.poisson(counts) if noise else np.rint(counts)
+			yield np.minimum(counts, np.iinfo(np.uint16).max).astype(np.uint16)
+
+	shape = (bins,) + np.shape(photons)
+	tmp_name = file_name + '.part'
+	tifffile.imwrite(tmp_name, planes(), shape=shape, dtype=np.uint16, bigtiff=True)
+	os.replace(tmp_name, file_name)
+
+
+class SyntheticStack:
+	"""A synthetic sample stack of size x size pixels and bins time bins, and the calibration stack measured with the
+	same delay. The files are generated in folder unless they are there already"""
+
+	def __init__(self, size, bins, photons=1000, freq=80, delay=0.5, noise=True, seed=0, folder=DATA_DIR):
+		self.size = size
+		self.bins = bins
+		self.freq = float(freq)
+		self.bin_width = 1000 / self.freq / bins
+		self.tau1, self.tau2, self.fraction = lifetime_maps(size)
+		self.photons = brightness_map(size, photons)
+		name = f'synthetic_{size}_{bins}_{photons}_{freq:g}_{delay:g}_{int(noise)}_{seed}'
+		os.makedirs(folder, exist_ok=True)
+		self.filename = os.path.join(folder, name + '.tif')
+		self.calibration_filename = os.path.join(folder, name + '_calibration.tif')
+		if not os.path.exists(self.filename):
+			write_stack(self.filename, self.tau1, self.tau2, self.fraction, self.photons, bins, freq, delay, noise,
+						seed)
+		if not os.path.exists(self.calibration_filename):
+			tau = np.full((size, size), CALIBRATION_LIFETIME)
+			write_stack(self.calibration_filename, tau, tau, 1.0, self.photons, bins, freq, delay, noise, seed + 1)
+
+	def truth(self, harmonic=1):
+		"""Returns the expected g and s maps"""
+		return phasor_truth(self.tau1, self.tau2, self.fraction, self.freq, harmonic)
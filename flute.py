@@ -0,0 +1,233 @@
+# Command line entry point, which runs the same analysis as the GUI without starting Qt, e.g. on cluster nodes or in
+# scheduled jobs. Run "python -m flute batch --help" for the list of parameters.
+
+# imports
+import argparse
+import glob
+import os
+import pickle
+import sys
+import numpy as np
+import BatchProcessing
+import Calibration
+import PhasorCache
+import Unmixing
+
+
+def expand_inputs(patterns):
+	"""Returns the sorted tiff files matching the glob patterns, without duplicates"""
+	file_names = set()
+	for pattern in patterns:
+		matches = glob.glob(pattern, recursive=True)
+		file_names.update(name for name in matches if name.lower().endswith(('.tif', '.tiff')))
+	return sorted(file_names)
+
+
+def binning_size(value):
+	"""argparse type of the binning size, which must be odd and positive"""
+	size = int(value)
+	if size < 1 or size % 2 == 0:
+		raise argparse.ArgumentTypeError(f'must be odd and positive, e.g. 1, 3 or 5, not {size}')
+	return size
+
+
+def gate_bins(value):
+	"""argparse type of a time gate, start-stop bins as in the Time Gate entry of the GUI, e.g. 5-200 or 5-, which is
+	returned as (start, stop) with a stop of None for the end of the stack"""
+	try:
+		start, stop = value.split('-')
+		return int(start), int(stop) if stop.strip() else None
+	except ValueError:
+		raise argparse.ArgumentTypeError(f'must be start-stop bins, e.g. 5-200, not {value}')
+
+
+def batch_settings(args):
+	"""Builds the settings of BatchProcessing from the command line arguments. The values which aren't given are
+	taken from the GUI's saved_dict.pkl if --settings is given, and otherwise from the defaults"""
+	settings = dict(BatchProcessing.DEFAULT_SETTINGS)
+	if args.settings is not None:
+		with open(args.settings, 'rb') as f:
+			load_dict = pickle.load(f)
+		for key in ["Phi Cal", "M Cal", "Bin Width", "Freq", "Harmonic", "FractionX", "FractionY"]:
+			if key in load_dict:
+				settings[key] = load_dict[key]
+
+	arguments = {"Bin Width": args.bin_width, "Freq": args.freq, "Harmonic": args.harmonic, "Filters": args.filters,
+				 "Intensity Min": args.intensity_min, "Intensity Max": args.intensity_max, "Phi Min": args.phi_min,
+				 "Phi Max": args.phi_max, "M Min": args.m_min, "M Max": args.m_max, "FractionX": args.fraction_x,
+				 "FractionY": args.fraction_y, "Fraction Min": args.fraction_min, "Fraction Max": args.fraction_max,
+				 "Phi Cal": args.phi_cal, "M Cal": args.m_cal, "Save Type": args.save_type,
+				 "Export Format": args.format, "Gate Start": args.gate_start, "Gate Stop": args.gate_stop,
+				 "Binning": args.binning, "Binning Shape": args.binning_shape, "Clusters": args.clusters,
+				 "Cluster Method": args.cluster_method, "Cache Dir": '0' if args.no_cache else args.cache_dir,
+				 "Harmonics": args.harmonics}
+	settings.update({key: value for key, value in arguments.items() if value is not None})
+
+	if args.calibration is not None:
+		settings["Phi Cal"], settings["M Cal"] = Calibration.get_calibration_parameters(
+			args.calibration, settings["Bin Width"], settings["Freq"], settings["Harmonic"], args.tau_ref,
+			PhasorCache.cache_from_setting(settings["Cache Dir"]))
+	if args.fraction_lifetime is not None:
+		omega = 2 * np.pi * settings["Freq"] / 1000 * settings["Harmonic"]
+		settings["FractionX"] = 1 / (1 + np.power(omega * args.fraction_lifetime, 2))
+		settings["FractionY"] = omega * args.fraction_lifetime / (1 + np.power(omega * args.fraction_lifetime, 2))
+	if args.unmix is not None:
+		settings["Unmixing"] = [species_coordinates(species, settings) for species in args.unmix]
+	if args.unmix_range is not None:
+		settings["Unmixing Ranges"] = [tuple(limits) for limits in args.unmix_range]
+	return settings
+
+
+def species_coordinates(species, settings):
+	"""Returns the (g, s) of a species given on the command line, either as the lifetime in ns of a single exponential
+	decay, e.g. 0.4, or as its coordinates, e.g. 0.7,0.35"""
+	if ',' in species:
+		g, s = species.split(',')
+		return float(g), float(s)
+	omega = 2 * np.pi * settings["Freq"] / 1000 * settings["Harmonic"]
+	return Unmixing.lifetime_coordinates(float(species), omega)
+
+
+def batch(args):
+	"""Runs the batch command, and returns the exit code"""
+	file_names = expand_inputs(args.inputs)
+	if not file_names:
+		print('No tiff files match the inputs', file=sys.stderr)
+		return 2
+	if args.output is None and args.container is None:
+		print('Either --output or --container is needed', file=sys.stderr)
+		return 2
+	if args.output is not None:
+		os.makedirs(args.output, exist_ok=True)
+	if args.container is not None and os.path.dirname(args.container):
+		os.makedirs(os.path.dirname(args.container), exist_ok=True)
+	settings = batch_settings(args)
+	print(f'Calibration: phi = {float(settings["Phi Cal"]):.4f}, M = {float(settings["M Cal"]):.4f}', file=sys.stderr)
+
+	def progress(done, total, file_name, error):
+		status = 'failed' if error is not None else 'saved'
+		print(f'[{done}/{total}] {status}: {file_name}', file=sys.stderr)
+		if error is not None:
+			print(error, file=sys.stderr)
+
+	failed = BatchProcessing.run_batch(file_names, args.output, settings, args.workers, progress, args.container)
+	destination = args.output if args.container is None else args.container
+	print(f'{len(file_names) - len(failed)} of {len(file_names)} files saved to {destination}', file=sys.stderr)
+	return 1 if failed else 0
+
+
+def add_analysis_arguments(parser, gates=True):
+	"""Adds the arguments of the calibration, filters, thresholds, unmixing and clustering of the settings of
+	BatchProcessing, which are shared by the commands. The time gate is left out if gates is False"""
+	parser.add_argument('--settings', help="the GUI's saved_dict.pkl, to reuse its calibration and parameters")
+	cache = parser.add_mutually_exclusive_group()
+	cache.add_argument('--cache-dir', help='directory the phasor coordinates of the stacks are cached in (default: '
+										   '$FLUTE_CACHE or ~/.flute/cache)')
+	cache.add_argument('--no-cache', action='store_true', help='read every stack without the cache')
+
+	group = parser.add_argument_group('acquisition')
+	group.add_argument('--bin-width', type=float, help='width of the time bins in ns')
+	group.add_argument('--freq', type=float, help='laser repetition rate in MHz')
+	group.add_argument('--harmonic', type=float)
+	group.add_argument('--harmonics', type=float, nargs='+', metavar='HARMONIC',
+					   help='other harmonics whose g, s, TauP and TauM maps are saved as <file>_h<harmonic>_<map>.tiff')
+	if gates:
+		group.add_argument('--gate-start', type=int, help='first time bin which is summed (default: 0)')
+		group.add_argument('--gate-stop', type=int, help='time bin the sums stop before (default: the end of the '
+													  'stack)')
+
+	group = parser.add_argument_group('calibration')
+	group.add_argument('--phi-cal', type=float, help='phase calibration in radians')
+	group.add_argument('--m-cal', type=float, help='modulation calibration')
+	group.add_argument('--calibration', help='tiff stack of a reference sample, to calculate phi and M from')
+	group.add_argument('--tau-ref', type=float, default=4.0, help='lifetime of the reference sample in ns')
+
+	group = parser.add_argument_group('filters and thresholds')
+	group.add_argument('--binning', type=binning_size,
+					   help='sums the decays of the BINNING x BINNING pixels around every pixel, e.g. 3 for 3x3. The '
+							'size must be odd (default: 1, no binning)')
+	group.add_argument('--binning-shape', choices=['square', 'circle'], help='shape of the binned pixels')
+	group.add_argument('--filters', type=int, help='number of 3x3 median filters')
+	group.add_argument('--intensity-min', type=float)
+	group.add_argument('--intensity-max', type=float)
+	group.add_argument('--phi-min', type=float, help='in degrees')
+	group.add_argument('--phi-max', type=float, help='in degrees')
+	group.add_argument('--m-min', type=float)
+	group.add_argument('--m-max', type=float)
+	group.add_argument('--fraction-x', type=float, help='g coordinate the distance is measured from')
+	group.add_argument('--fraction-y', type=float, help='s coordinate the distance is measured from')
+	group.add_argument('--fraction-lifetime', type=float,
+					   help='lifetime in ns on the universal circle the distance is measured from, e.g. 0.4 for NADH')
+	group.add_argument('--fraction-min', type=float, help='minimum distance')
+	group.add_argument('--fraction-max', type=float, help='maximum distance')
+
+	group = parser.add_argument_group('unmixing')
+	group.add_argument('--unmix', nargs='+', metavar='SPECIES',
+					   help='2 or 3 species every pixel is unmixed into, each a lifetime in ns or g,s coordinates, e.g. '
+							'--unmix 0.4 3.4 0.7,0.2. The fraction of each species is saved as <file>_Species<n>.tiff')
+	group.add_argument('--unmix-range', nargs=2, type=float, action='append', metavar=('MIN', 'MAX'),
+					   help='fraction range of a species, the pixels outside of it are masked. Given once per species, '
+							'in the order of --unmix')
+
+	group = parser.add_argument_group('clustering')
+	group.add_argument('--clusters', type=int, help='number of clusters fitted to the phasor plot of each file (at most '
+													 '8). The labels are saved as <file>_Clusters.tiff and the '
+													 'statistics of each cluster as <file>_Clusters.csv')
+	group.add_argument('--cluster-method', choices=['kmeans', 'gmm'], help='k-means or a Gaussian mixture')
+
+
+def scan(args):
+	"""Runs the gate-scan command, and returns the exit code"""
+	settings = batch_settings(args)
+	try:
+		results = BatchProcessing.gate_scan(args.input, args.gate, settings)
+	except ValueError as error:
+		# a gate outside of the stack
+		print(error, file=sys.stderr)
+		return 2
+	text = '\n'.join(f'Gate {start}-{"" if stop is None else stop}\n' + ''.join(lines)
+					 for (start, stop), lines in zip(args.gate, results))
+	if args.output is None:
+		sys.stdout.write(text)
+	else:
+		with open(args.output, 'w') as f:
+			f.write(text)
+	return 0
+
+
+def build_parser():
+	parser = argparse.ArgumentParser(prog='flute', description='FLUTE phasor analysis of FLIM data without the GUI')
+	commands = parser.add_subparsers(dest='command', required=True)
+
+	parser_batch = commands.add_parser('batch', help='analyse tiff stacks and save the results, like bulk open')
+	parser_batch.add_argument('inputs', nargs='+', help='tiff files or glob patterns, e.g. "data/**/*.tif"')
+	parser_batch.add_argument('-o', '--output', help='directory the results are saved in')
+	parser_batch.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core)')
+	parser_batch.add_argument('--save-type', choices=['all', 'current'], default=None)
+	parser_batch.add_argument('--format', choices=['files', 'container'], default=None,
+							  help='save the images, maps and plots as separate files (default), or the maps, mask, '
+								   'histogram and parameters of each file as one compressed OME-TIFF container')
+	parser_batch.add_argument('--container', help='OME-TIFF file the data of the whole batch is saved in, instead '
+												  'of the files in --output')
+	add_analysis_arguments(parser_batch)
+	parser_batch.set_defaults(func=batch)
+
+	parser_scan = commands.add_parser('gate-scan', help='compare the averages of one stack summed over many time gates')
+	parser_scan.add_argument('input', help='tiff stack')
+	parser_scan.add_argument('--gate', type=gate_bins, action='append', required=True, metavar='START-STOP',
+							 help='time bins which are summed, e.g. 5-200, or 5- to sum to the end of the stack. Given '
+								  'once per gate')
+	parser_scan.add_argument('-o', '--output', help='text file the parameters of the gates are written to, instead of '
+													'the standard output')
+	add_analysis_arguments(parser_scan, gates=False)
+	parser_scan.set_defaults(func=scan, save_type=None, format=None, gate_start=None, gate_stop=None)
+	return parser
+
+
+def main(argv=None):
+	args = build_parser().parse_args(argv)
+	return args.func(args)
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -6,13 +6,17 @@ import sys
 from sys import platform
 from PyQt5 import QtWidgets
 from PyQt5 import uic, QtCore
-from PyQt5.QtCore import QPropertyAnimation, QRect, QEasingCurve, QTimer
+from PyQt5.QtCore import QPropertyAnimation, QRect, QEasingCurve
 from PyQt5.QtGui import QIcon, QIntValidator, QDoubleValidator
-from PyQt5.QtWidgets import QFileDialog
+from PyQt5.QtWidgets import QFileDialog, QMessageBox
 import DataWindows
 import os
 from ImageHandler import ImageHandler
 import Calibration
+import BatchProcessing
+import ExportPipeline
+from ComputeWorker import ComputeWorker
+import multiprocessing
 import pickle
 import numpy as np
 import MplWidget
@@ -38,10 +42,38 @@ def resource_path(relative_path):
 
     return os.path.join(base_path, relative_path)
 
+# (radius, shape) of the neighbourhoods of the binning options, in the order of the binning box
+BINNING_OPTIONS = [(0, 'square'), (1, 'square'), (2, 'square'), (3, 'square'), (1, 'circle'), (2, 'circle'),
+                   (3, 'circle')]
+
+# shown when the time gate entry can't be read
+GATE_FORMAT_MESSAGE = 'Enter the time gate as start-stop bins, e.g. 5-200'
+# methods of Clustering, in the order of the cluster fit box
+CLUSTER_METHODS = ['kmeans', 'gmm']
+
+class BatchThread(QtCore.QThread):
+    """Runs a batch of files through BatchProcessing outside of the GUI thread, and reports the progress back to the
+    main window with the progress signal"""
+    progress = QtCore.pyqtSignal(int, int, str, str)
+
+    def __init__(self, file_names, save_folder, settings, workers):
+        super().__init__()
+        self.file_names = file_names
+        self.save_folder = save_folder
+        self.settings = settings
+        self.workers = workers
+
+    def run(self):
+        BatchProcessing.run_batch(self.file_names, self.save_folder, self.settings, self.workers,
+                                  lambda done, total, name, error: self.progress.emit(done, total, name, error or ''))
+
 class MainWindow(QtWidgets.QMainWindow):
     """Main function that runs the front panel, and coordinates the user interactions with the images that they mean
     to be interacting with. All the buttons in the front panel are connected to their required functions here, and
     a list of images is used to keep track of which dataset the user is interacting with."""
+    # emitted by the writer threads of the export, and received in the GUI thread
+    export_progress = QtCore.pyqtSignal(int, int, int, str, str)
+
     def __init__(self, *args, **kwargs):
         """Initialize the buttons and connect the signals"""
         super().__init__(*args, **kwargs)
@@ -51,6 +83,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.menu_size = 135
         self.menu_x = self.current_frame.x()
         self.save_type = 'all'
+        self.save_harmonics = False
         self.LoadFLIM.clicked.connect(self.open_picture)
         self.LoadCalibr.clicked.connect(self.open_calibration)
         self.bulk_load.clicked.connect(self.bulk_open)
@@ -66,6 +99,8 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.tableWidget.setSelectionBehavior(QtWidgets.QTableView.SelectRows)
         self.tableWidget.itemSelectionChanged.connect(self.setActive)
+        self.tableWidget.horizontalHeader().sectionResized.connect(self.save_column_widths)
+        self.circleSelect.currentIndexChanged.connect(self.set_circle)
 
         self.circleSlider.setHigh(120)
         self.fractionSlider.setHigh(120)
@@ -99,6 +134,14 @@ class MainWindow(QtWidgets.QMainWindow):
         self.ApplyFilter.clicked.connect(self.applyAllFilters)
         self.Filters.returnPressed.connect(self.applyFilter)
         self.Filters.setValidator(QIntValidator())
+        self.HarmonicSelect.returnPressed.connect(self.harmonic_entry)
+        self.HarmonicSelect.setValidator(QDoubleValidator())
+        self.GateSelect.returnPressed.connect(self.gate_entry)
+        self.GatingSelect.toggled.connect(self.gating_entry)
+        self.BinningSelect.currentIndexChanged.connect(self.binning_entry)
+        self.ClusterSelect.returnPressed.connect(self.cluster_entry)
+        self.ClusterSelect.setValidator(QIntValidator(0, 8))
+        self.ClusterMethod.currentIndexChanged.connect(self.cluster_entry)
 
         self.Grey_Color.clicked.connect(lambda: self.set_colormap(0))
         self.TauM_Color.clicked.connect(lambda: self.set_colormap(1))
@@ -117,10 +160,18 @@ class MainWindow(QtWidgets.QMainWindow):
         else:
             self.load_dict = {'FLIM Load': '', "Cal Load": '', "Bin Width": 0.227, "Freq": 80.0, "Tau Ref": 4.0,
                               "Harmonic": 1.0, "Phi Cal": 0.0, "M Cal": 1.0,"Fraction": 0.4, "save_Dir": '', "FractionX": 1.0, "FractionY":0.0,
-                              "framex": 611, "framey": 510, "table0Width": 290, "table1Width": 50, "table2Width": 143}
+                              "framex": 611, "framey": 510, "table0Width": 290, "table1Width": 50, "table2Width": 143,
+                              "Workers": os.cpu_count()}
             with open('saved_dict.pkl', 'wb') as f:
                 pickle.dump(self.load_dict, f)
         f.close()
+        # keys added in later versions are missing from the dictionaries saved by older versions
+        if not self.load_dict.get('Workers'):
+            self.load_dict['Workers'] = os.cpu_count() or 1
+        # more workers than cores can help when the files are read from a slow disk
+        self.WorkersSelect.setMaximum(max(4 * (os.cpu_count() or 1), self.load_dict['Workers']))
+        self.WorkersSelect.setValue(self.load_dict['Workers'])
+        self.WorkersSelect.valueChanged.connect(self.workers_entry)
         self.resize(self.load_dict['framex'], self.load_dict['framey'])
         self.tableWidget.setColumnWidth(0, self.load_dict['table0Width'])
         self.tableWidget.setColumnWidth(1, self.load_dict['table1Width'])
@@ -130,26 +181,55 @@ class MainWindow(QtWidgets.QMainWindow):
         self.fraction_setting = 'coordinates'
         self.Phi_cal_box.setText("{:.4f}".format(self.load_dict['Phi Cal']))
         self.m_cal_box.setText("{:.4f}".format(self.load_dict['M Cal']))
-
-        # Runs self.update on a timer, which checks if windows have been closed and closes their partner plots/windows
-        timer = QTimer(self)
-        timer.timeout.connect(self.update)
-        timer.start(10)
+        self.HarmonicSelect.setText(str(self.load_dict['Harmonic']))
 
         # Keeps track of all the images that are opened
         self.image_arr = []
-
-    def update(self):
-        """Sets the colour of the circle for when the user clicks, and kills the parter windows/plots if the user
-        closes a data window"""
+        # The data is saved in the background, and the export can be cancelled from the status bar
+        # the exports which are running, and the (path, error) of their files which failed, by the number of the export
+        self.exports = {}
+        self.export_errors = {}
+        self.export_number = 0
+        self.export_progress.connect(self.show_export_progress)
+        self.cancel_export_button = QtWidgets.QPushButton('Cancel saving')
+        self.cancel_export_button.clicked.connect(self.cancel_export)
+        self.statusBar().addPermanentWidget(self.cancel_export_button)
+        self.cancel_export_button.hide()
+        # Shows the time taken by each stage and the memory of the images, see Instrumentation
+        self.status_panel = None
+        self.status_panel_button = QtWidgets.QPushButton('Performance')
+        self.status_panel_button.clicked.connect(self.show_status_panel)
+        self.statusBar().addPermanentWidget(self.status_panel_button)
+        # Calculates the images while the range sliders are dragged, outside of the GUI thread
+        self.worker = ComputeWorker()
+        self.worker.failed.connect(self.compute_failed)
+        self.worker.start()
+
+    def show_status_panel(self):
+        """Opens the panel of the timings and memory of the images"""
+        if self.status_panel is None:
+            self.status_panel = DataWindows.StatusPanel(lambda: self.image_arr)
+        self.status_panel.show()
+        self.status_panel.raise_()
+
+    def save_column_widths(self):
+        """Keeps the widths of the columns of the table, so that they are the same when FLUTE is opened again"""
         self.load_dict['table0Width'] = self.tableWidget.columnWidth(0)
         self.load_dict['table1Width'] = self.tableWidget.columnWidth(1)
         self.load_dict['table2Width'] = self.tableWidget.columnWidth(2)
-        for idx, image in enumerate(self.image_arr):
-            image.set_circle(self.circleSelect.currentIndex())
-            if image.dead():
-                del self.image_arr[idx]
-                self.tableWidget.removeRow(idx)
+
+    def set_circle(self, selection):
+        """Sets the colour of the circle drawn when the user clicks the plots"""
+        for image in self.image_arr:
+            image.set_circle(selection)
+
+    def remove_image(self, image):
+        """Removes the image from the table once its windows are closed. The windows are closed together, so this
+        runs once for each of them"""
+        if image in self.image_arr:
+            idx = self.image_arr.index(image)
+            del self.image_arr[idx]
+            self.tableWidget.removeRow(idx)
 
     def open_picture(self):
         """ Opens the file dialog and loads the data if the user selects a tiff file"""
@@ -164,30 +244,93 @@ class MainWindow(QtWidgets.QMainWindow):
             self.image_arr[i.row()].show_lines(self.ShowRangeLines.isChecked())
 
     def bulk_open(self):
-        """Opens a group of images, applies threshold, saves the data, and then closes the windows right away.
-        Allows the user to open hundreds of images without hundreds of windows opening up and cluttering"""
+        """Opens a group of images, applies threshold and saves the data without opening any windows. The files are
+        processed by a pool of worker processes in the background, so that the user can open hundreds of images at the
+        speed of all the cores of the computer"""
         self.load_frac_filter = False
+        try:
+            self.gate_bins()
+        except ValueError:
+            self.statusBar().showMessage(GATE_FORMAT_MESSAGE)
+            return
         save_folder = ''
         file = QFileDialog.getOpenFileNames(self, 'Open file', str(self.load_dict['FLIM Load']), 'Tiff (*.tif *.tiff)')
         if file[0]: # make sure the user selected a piece of data
             save_folder = QFileDialog.getExistingDirectory(self, directory = self.load_dict['save_Dir'])
         if save_folder != '':
-            for data in file[0]:
-                self.load_data(data)
-                self.image_arr[-1].fraction_coor_map(self.fraction_x, self.fraction_y)
-                self.save_type = 'all'
-                self.save_selected_data(save_folder)
-                selection = self.tableWidget.selectionModel().selectedRows()
-                for i in selection:
-                    self.image_arr[i.row()].kill()
+            self.load_dict['FLIM Load'] = os.path.dirname(file[0][0])
+            self.load_dict['save_Dir'] = save_folder
+            self.batch_errors = []
+            self.bulk_load.setEnabled(False)
+            self.batch_thread = BatchThread(file[0], save_folder, self.batch_settings(), self.load_dict['Workers'])
+            self.batch_thread.progress.connect(self.batch_progress)
+            self.batch_thread.finished.connect(self.batch_finished)
+            self.batch_thread.start()
+
+    def workers_entry(self, workers):
+        """Sets the number of worker processes of a bulk open, which is saved with the other settings"""
+        self.load_dict['Workers'] = workers
+
+    def batch_settings(self):
+        """Returns the parameters on the front panel which are applied to every file of a batch"""
+        gate_start, gate_stop = self.gate_bins()
+        return {"Phi Cal": self.load_dict['Phi Cal'], "M Cal": self.load_dict['M Cal'],
+                "Bin Width": self.load_dict['Bin Width'], "Freq": self.load_dict['Freq'],
+                "Harmonic": self.load_dict['Harmonic'], "Filters": int(float(self.Filters.text().replace(",","."))),
+                "Intensity Min": float(self.IntensityMin.text().replace(",",".")),
+                "Intensity Max": float(self.IntensityMax.text().replace(",",".")),
+                "Phi Min": float(self.Phi_min.text().replace(",",".")),
+                "Phi Max": float(self.Phi_max.text().replace(",",".")),
+                "M Min": float(self.M_min.text().replace(",",".")), "M Max": float(self.M_max.text().replace(",",".")),
+                "FractionX": self.fraction_x, "FractionY": self.fraction_y,
+                "Fraction Min": float(self.frac_min.text().replace(",",".")),
+                "Fraction Max": float(self.frac_max.text().replace(",",".")), "Save Type": 'all',
+                "Gate Start": gate_start, "Gate Stop": gate_stop,
+                "Binning": 2 * BINNING_OPTIONS[self.BinningSelect.currentIndex()][0] + 1,
+                "Binning Shape": BINNING_OPTIONS[self.BinningSelect.currentIndex()][1],
+                "Clusters": int(self.ClusterSelect.text() or 0),
+                "Cluster Method": CLUSTER_METHODS[self.ClusterMethod.currentIndex()]}
+
+    def batch_progress(self, done, total, name, error):
+        """Shows the progress of the batch which is running in the background"""
+        if error:
+            self.batch_errors.append((name, error))
+        self.statusBar().showMessage(f'Batch: {done}/{total} files, {len(self.batch_errors)} failed')
+
+    def batch_finished(self):
+        """Reports the files of the batch which failed once it is done"""
+        self.bulk_load.setEnabled(True)
+        message = 'Batch finished'
+        if self.batch_errors:
+            message += ', failed: ' + ', '.join(os.path.basename(name) for name, _ in self.batch_errors)
+            self.show_errors('Batch', self.batch_errors)
+        self.statusBar().showMessage(message)
+
+    def compute_failed(self, image, error):
+        """Reports a change to an image which failed in the worker, whose image shows the data from before it"""
+        self.statusBar().showMessage(f'Updating {image.name} failed')
+        self.show_errors('Calculation', [(image.name, error)], f'Updating {image.name} failed')
+
+    def show_errors(self, title, errors, text=None):
+        """Shows a warning with text, by default the number of files which failed, and the error of each of the
+        (file name, traceback) in errors, with their whole tracebacks under the details"""
+        text = f'{len(errors)} files failed' if text is None else text
+        box = QMessageBox(QMessageBox.Warning, title, text, QMessageBox.Ok, self)
+        box.setInformativeText('\n'.join(f'{os.path.basename(name)}: {error.strip().splitlines()[-1]}'
+                                          for name, error in errors))
+        box.setDetailedText('\n'.join(f'{name}:\n{error}' for name, error in errors))
+        box.show()
 
     def load_data(self, file_name):
         """loads a picture from the file_name location, and populates the table widget"""
         self.load_dict['FLIM Load'] = os.path.dirname(file_name)
         # keep track of the image
-        self.image_arr.append(ImageHandler(file_name, self.load_dict['Phi Cal'], self.load_dict['M Cal'],
-                                           self.load_dict['Bin Width'], self.load_dict['Freq'],
-                                           self.load_dict['Harmonic']))
+        image = ImageHandler(file_name, self.load_dict['Phi Cal'], self.load_dict['M Cal'], self.load_dict['Bin Width'],
+                             self.load_dict['Freq'], self.load_dict['Harmonic'], self.worker)
+        image.set_circle(self.circleSelect.currentIndex())
+        image.graph_window.closed.connect(lambda: self.remove_image(image))
+        image.image_window.closed.connect(lambda: self.remove_image(image))
+        self.image_arr.append(image)
         # bind the action when the user clicks the plot
         self.image_arr[-1].binding_id = \
             self.image_arr[-1].graph_window.Plot.canvas.mpl_connect('button_press_event', self.update_circle)
@@ -473,6 +616,64 @@ class MainWindow(QtWidgets.QMainWindow):
         for i in selection:
             self.image_arr[i.row()].convolution(filters)
 
+    def harmonic_entry(self):
+        """Switches the selected images to the harmonic entered. The harmonics calculated when the data was loaded are
+        switched to without reading the file again"""
+        harmonic = float(self.HarmonicSelect.text().replace(",","."))
+        selection = self.tableWidget.selectionModel().selectedRows()
+        for i in selection:
+            self.image_arr[i.row()].set_harmonic(harmonic)
+
+    def gate_bins(self):
+        """Returns the (start, stop) time bins of the gate entry, e.g. 5-200, where an empty stop is the end of the
+        stack and an empty entry is every bin. Raises a ValueError if it isn't in that form"""
+        text = self.GateSelect.text().strip()
+        if text == '':
+            return 0, None
+        start, stop = text.split('-')
+        return int(start), int(stop) if stop.strip() else None
+
+    def gate_entry(self):
+        """Sums only the time bins of the gate entered for the selected images. With Fast Gates checked, the first gate
+        of an image reads its stack once more, and after that the gate is changed without reading it"""
+        try:
+            start, stop = self.gate_bins()
+        except ValueError:
+            self.statusBar().showMessage(GATE_FORMAT_MESSAGE)
+            return
+        selection = self.tableWidget.selectionModel().selectedRows()
+        for i in selection:
+            try:
+                self.image_arr[i.row()].set_gate(start, stop, self.GatingSelect.isChecked())
+            except ValueError as error:
+                self.statusBar().showMessage(str(error))
+
+    def gating_entry(self, state):
+        """Drops the cumulative sums of every image when Fast Gates is unchecked. They are kept again from the next
+        gate once it is checked"""
+        if not state:
+            for image in self.image_arr:
+                image.disable_gating()
+
+    def binning_entry(self):
+        """Bins the decays of the selected images over the neighbourhood selected"""
+        radius, shape = BINNING_OPTIONS[self.BinningSelect.currentIndex()]
+        selection = self.tableWidget.selectionModel().selectedRows()
+        for i in selection:
+            self.image_arr[i.row()].set_binning(radius, shape)
+
+    def cluster_entry(self):
+        """Fits the number of clusters entered to the phasor plots of the selected images, and shows them over the
+        images"""
+        k = int(self.ClusterSelect.text() or 0)
+        method = CLUSTER_METHODS[self.ClusterMethod.currentIndex()]
+        selection = self.tableWidget.selectionModel().selectedRows()
+        for i in selection:
+            try:
+                self.image_arr[i.row()].cluster(k, method)
+            except ValueError as error:
+                self.statusBar().showMessage(str(error))
+
     def applyAllFilters(self):
         """Applies all the filters available on the front panel"""
         self.applyFilter()
@@ -516,6 +717,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def save_data(self, type):
         """Opens a save file dialog and saves the images and parameters"""
+        self.save_harmonics = self.save_window.Harmonics.isChecked()
         self.kill_save_window()
         file = QFileDialog.getExistingDirectory(self, directory = self.load_dict['save_Dir'])
         self.save_type = type
@@ -523,11 +725,53 @@ class MainWindow(QtWidgets.QMainWindow):
             self.save_selected_data(file)
 
     def save_selected_data(self, file_path):
-        """Saves all selected data in the table widget to file_path"""
+        """Saves all selected data in the table widget to file_path. The files are written in the background, from a
+        snapshot of the data, so the images can be changed while they are saved"""
         self.load_dict['save_Dir'] = file_path
         selection = self.tableWidget.selectionModel().selectedRows()
+        tasks = []
         for i in selection:
-            self.image_arr[i.row()].save_data(file_path, self.save_type)
+            tasks += self.image_arr[i.row()].export_tasks(file_path, self.save_type, self.save_harmonics)
+        if not tasks:
+            return
+        # an export which is still running carries on next to this one
+        self.export_number += 1
+        number = self.export_number
+        self.export_errors[number] = []
+        self.cancel_export_button.show()
+        self.exports[number] = ExportPipeline.Export(tasks, progress=lambda done, total, path, error:
+                                                     self.export_progress.emit(number, done, total, path, error or ''))
+
+    def show_export_progress(self, number, done, total, path, error):
+        """Shows the progress of the exports which are running in the background"""
+        if number not in self.exports:
+            # a file of an export which was cancelled
+            return
+        if error:
+            self.export_errors[number].append((path, error))
+        if done == total:
+            del self.exports[number]
+            errors = self.export_errors.pop(number)
+            message = 'Saving finished'
+            if errors:
+                message += ', failed: ' + ', '.join(os.path.basename(name) for name, _ in errors)
+                self.show_errors('Saving', errors)
+        else:
+            message = (f'Saving: {sum(export.done for export in self.exports.values())}/'
+                       f'{sum(len(export.tasks) for export in self.exports.values())} files, '
+                       f'{sum(len(errors) for errors in self.export_errors.values())} failed')
+        if not self.exports:
+            self.cancel_export_button.hide()
+        self.statusBar().showMessage(message)
+
+    def cancel_export(self):
+        """Stops saving once the files being written are finished"""
+        for export in self.exports.values():
+            export.cancel()
+        self.exports.clear()
+        self.export_errors.clear()
+        self.cancel_export_button.hide()
+        self.statusBar().showMessage('Saving cancelled')
 
     def kill_save_window(self):
         """closes the save selection window"""
@@ -552,20 +796,28 @@ class MainWindow(QtWidgets.QMainWindow):
         """closes all the widnows the user has selected on the table widget, to clean up the workspace"""
         del self.close
         selection = self.tableWidget.selectionModel().selectedRows()
-        for i in selection:
-            self.image_arr[i.row()].kill()
+        # closing the windows removes their rows from the table, so the images are found first
+        for image in [self.image_arr[i.row()] for i in selection]:
+            image.kill()
 
     def closeEvent(self, event):
         """Closes all open windows when the main window is closed"""
-        for window in self.image_arr:
+        self.worker.stop()
+        # the files which are being saved are finished before closing
+        for export in self.exports.values():
+            export.wait()
+        for window in list(self.image_arr):
             window.kill()
-            del window
+        if self.status_panel is not None:
+            self.status_panel.close()
         with open('saved_dict.pkl', 'wb') as f:
             pickle.dump(self.load_dict, f)
         sys.exit()
 
 # Executes the MainWindow
 if __name__ == "__main__":
+    # needed by the batch worker processes when FLUTE is compiled to an exe
+    multiprocessing.freeze_support()
     if platform.system() == "Windows":
         make_dpi_aware()
     if hasattr(QtCore.Qt, 'AA_EnableHighDpiScaling'):